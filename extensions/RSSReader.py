@@ -162,6 +162,9 @@ class FakeResponse(object):
     def return_file (self, typ, path, delete_on_close=False):
         raise ValueError("Can't return file from this kind of response")
 
+    def return_stream (self, typ, chunks, filename=None):
+        raise ValueError("Can't return stream from this kind of response")
+
     def fork_request(self, fn, *args):
         from uplib.plibUtil import uthread, note
         from uplib.service import run_fn_in_new_thread
@@ -17,111 +17,345 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 #
 
-import string, sys, os, hashlib, re, tempfile, shutil, httplib
+import string, sys, os, hashlib, re, tempfile, httplib, socket, time, traceback, Queue
 
 try:
-    from plibUtil import note, HTTPCodes, configurator, update_metadata, zipup, https_post_multipart, parse_URL, get_fqdn
+    from plibUtil import note, HTTPCodes, configurator, update_metadata, zipup_stream, zipup_stream_length, https_post_multipart, parse_URL, get_fqdn, uthread, htmlescape
     from basicPlugins import STANDARD_BACKGROUND_COLOR, STANDARD_LEGEND_COLOR, _doc_show_URL
-    import newFolder
 except ImportError:
-    from uplib.plibUtil import note, configurator, update_metadata, zipup, get_fqdn
-    from uplib.webutils import HTTPCodes, https_post_multipart, parse_URL
+    from uplib.plibUtil import note, configurator, update_metadata, zipup_stream, zipup_stream_length, get_fqdn, uthread
+    from uplib.webutils import HTTPCodes, https_post_multipart, parse_URL, htmlescape
     from uplib.basicPlugins import STANDARD_BACKGROUND_COLOR, STANDARD_LEGEND_COLOR, _doc_show_URL
-    import uplib.newFolder as newFolder 
 
+try:
+    # doesn't insist on a verifiable certificate, as UpLib's are usually self-signed
+    from uplib.webutils import OurHTTPSConnection as _HTTPSConnection
+except ImportError:
+    _HTTPSConnection = httplib.HTTPSConnection
 
-def _push_doc (doc, remote_repo_url, remote_password):
 
-    note(3, "pushing %s  (%s)...", doc.id, doc.get_metadata("title"))
-    tdir = tempfile.mktemp()
-    os.mkdir(tdir)
-    try:
-        if os.path.isdir(os.path.join(doc.folder(), "page-images")):
-            shutil.copytree(os.path.join(doc.folder(), "page-images"), os.path.join(tdir, "page-images"))
-        else:
-            shutil.copyfile(os.path.join(doc.folder(), "document.tiff"), os.path.join(tdir, "document.tiff"))
-        if os.path.exists(doc.text_path()):
-            shutil.copyfile(os.path.join(doc.folder(), "contents.txt"), os.path.join(tdir, "contents.txt"))
-        if os.path.exists(os.path.join(doc.folder(), "paragraphs.txt")):
-            shutil.copyfile(os.path.join(doc.folder(), "paragraphs.txt"), os.path.join(tdir, "paragraphs.txt"))
-        if os.path.exists(os.path.join(doc.folder(), "wordbboxes")):
-            shutil.copyfile(os.path.join(doc.folder(), "wordbboxes"), os.path.join(tdir, "wordbboxes"))
-        if os.path.exists(os.path.join(doc.folder(), "images")):
-            shutil.copytree(os.path.join(doc.folder(), "images"), os.path.join(tdir, "images"))
-        if os.path.exists(os.path.join(doc.folder(), "originals")):
-            shutil.copytree(os.path.join(doc.folder(), "originals"), os.path.join(tdir, "originals"))
-        if os.path.exists(os.path.join(doc.folder(), "links")):
-            shutil.copytree(os.path.join(doc.folder(), "links"), os.path.join(tdir, "links"))
-
-        # filter the metadata
-        conf = configurator()
-        md = doc.get_metadata()
-        newmd = {}
-        properties = string.split(conf.get('synchronizing-properties') or
-                                  conf.get('metadata-sharing-properties') or
-                                  conf.get('metadata-sharing-default-properties'), ':')
-
-        for property in ["title", "date", "authors", "citation"]:
-            if not property in properties:
-                properties.append(property)
-
-        for prop in properties:
-            if md.has_key(prop):
-                newmd[prop] = md[prop]
-        update_metadata(os.path.join(tdir, "metadata.txt"), newmd)
-
-        host, port, path = parse_URL(remote_repo_url)
-
-        # create zipfile of the folder
-        tmpfilename = zipup(tdir)
+# Documents are moved with a pool of worker threads, each with its own
+# keep-alive connection to the other repository.  A pushed document's folder
+# is zipped as it's sent, and a pulled one is written straight into the
+# pending folder, so neither is held in memory or in a temporary zip file.
+# Each finished transfer is checkpointed, so that an interrupted
+# synchronization doesn't transfer it again when it's re-run.
+
+# how many documents to transfer at once, if "synchronize-connections" isn't set
+_DEFAULT_CONNECTIONS = 4
+
+# how many seconds to wait for the next transfer to finish before giving up on the rest
+_STALL_TIMEOUT = 10 * 60
+
+# the parts of a document folder which are pushed, besides the metadata and page images
+_PUSHED_PARTS = ("contents.txt", "paragraphs.txt", "wordbboxes", "images", "originals", "links")
+
+_BOUNDARY = '----------ThIs_Is_tHe_sYnC_bouNdaRY_$'
+
+def _connection (remote_repo_url):
+    host, port, path = parse_URL(remote_repo_url)
+    return _HTTPSConnection(host, port)
+
+def _request (conn, method, path, password, headers=None, body=None):
+    # BODY is a function returning the chunks of the request body.  If a connection
+    # which has already been used turns out to have been closed by the other end,
+    # open it again and retry a GET, once.  Other requests aren't retried, as the
+    # other end may have acted on them before the connection went away.
+    reused = (conn.sock is not None) and (method == 'GET')
+    while True:
         try:
-            # send it to the repository
-            errcode, errmsg, headers, text = https_post_multipart(host, port, remote_password,
-                                                                  "/action/basic/repo_add",
-                                                                  (("password", remote_password,),
-                                                                   ("filetype", "zipped-folder",)),
-                                                                  (("newfile", tmpfilename),))
-            if errcode != 200:
-                raise ValueError("Posting of data to repository %s resulted in error %d (%s).\nReturned text was:\n%s" % (remote_repo_url, errcode, errmsg, text))
-            note(3, "text from remote repository was\n%s.\n", text)
-            note(3, "%s successfully posted to %s.", tdir, remote_repo_url)
+            conn.putrequest(method, path)
+            if password:
+                conn.putheader('Password', password)
+            for name, value in (headers or {}).items():
+                conn.putheader(name, value)
+            conn.endheaders()
+            if body is not None:
+                for chunk in body():
+                    conn.send(chunk)
+            return conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            reused = False
+
+def _form_field (name, value):
+    return string.join(['--' + _BOUNDARY,
+                        'Content-Disposition: form-data; name="%s"' % name,
+                        'Content-Type: application/octet-stream',
+                        'Content-Transfer-Encoding: binary',
+                        'Content-Length: %d' % len(value),
+                        '',
+                        value,
+                        ''], '\r\n')
+
+def _send_doc (conn, doc, remote_repo_url, remote_password):
+
+    # returns the remote doc ID, and the number of bytes sent
 
-        finally:
-            if os.path.exists(tmpfilename):
-                os.unlink(tmpfilename)
+    note(3, "pushing %s  (%s)...", doc.id, doc.get_metadata("title"))
+
+    # filter the metadata
+    conf = configurator()
+    md = doc.get_metadata()
+    newmd = {}
+    properties = string.split(conf.get('synchronizing-properties') or
+                              conf.get('metadata-sharing-properties') or
+                              conf.get('metadata-sharing-default-properties'), ':')
+
+    for property in ["title", "date", "authors", "citation"]:
+        if not property in properties:
+            properties.append(property)
+
+    for prop in properties:
+        if md.has_key(prop):
+            newmd[prop] = md[prop]
+
+    folder = doc.folder()
+    if os.path.isdir(os.path.join(folder, "page-images")):
+        parts = _PUSHED_PARTS + ("page-images",)
+    else:
+        parts = _PUSHED_PARTS + ("document.tiff",)
 
-        return text.strip()
+    fd, mdpath = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        update_metadata(mdpath, newmd)
+
+        def filefunc (path):
+            # send only the parts above, with the filtered metadata
+            part = path[len(folder):].lstrip(os.sep).split(os.sep)[0]
+            if part == "metadata.txt":
+                return mdpath
+            return ((part in parts) and path) or None
+
+        preamble = (_form_field("password", remote_password) +
+                    _form_field("filetype", "zipped-folder") +
+                    string.join(['--' + _BOUNDARY,
+                                 'Content-Disposition: form-data; name="newfile"; filename="%s.zip"' % doc.id,
+                                 'Content-Type: application/zip',
+                                 'Content-Transfer-Encoding: binary',
+                                 '', ''], '\r\n'))
+        epilogue = '\r\n--' + _BOUNDARY + '--\r\n'
+        length = len(preamble) + zipup_stream_length(folder, FILEFUNC=filefunc) + len(epilogue)
+
+        def body ():
+            yield preamble
+            for chunk in zipup_stream(folder, FILEFUNC=filefunc):
+                yield chunk
+            yield epilogue
+
+        # send it to the repository
+        response = _request(conn, 'POST', '/action/basic/repo_add', remote_password,
+                            { 'Content-Type' : 'multipart/form-data; boundary=%s' % _BOUNDARY,
+                              'Content-Length' : str(length) },
+                            body)
+        text = response.read()
+        if response.status != 200:
+            raise ValueError("Posting of data to repository %s resulted in error %d (%s).\nReturned text was:\n%s" % (remote_repo_url, response.status, response.reason, text))
+        note(3, "text from remote repository was\n%s.\n", text)
+        note(3, "%s successfully posted to %s.", doc.id, remote_repo_url)
+        return text.strip(), length
 
     finally:
-        if os.path.exists(tdir):
-            shutil.rmtree(tdir)
+        if os.path.exists(mdpath):
+            os.unlink(mdpath)
+
+
+class _CountingReader (object):
+
+    # counts the bytes read through it from a file-like object
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.count += len(data)
+        return data
+
+
+def _get_doc_to_file (conn, local_repo, password, path):
 
+    # returns the local doc ID, and the number of bytes received
 
-def _get_doc_to_file (local_repo, host, port, password, path):
-    h = httplib.HTTPS(host, port)
-    h.putrequest('GET', path)
-    if password:
-        h.putheader('Password', password)
-    h.endheaders()
-    errcode, errmsg, headers = h.getreply()
+    response = _request(conn, 'GET', path, password)
+    errcode = response.status
     if errcode == 200:
-        bits = h.file.read()
-        return newFolder.create(local_repo, bits, "zipped-folder", {})
-    elif errcode == 302:
+        bits = _CountingReader(response)
+        id = local_repo.create_new_document(bits, "zipped-folder", {}, "bulk")
+        # the reply has to be read through before the connection can be used again
+        while response.read(1 << 16):
+            pass
+        return id, bits.count
+    response.read()
+    if errcode == 302:
         # moved temporarily
-        newpath = headers.get("Location")
+        newpath = response.getheader("Location")
         if newpath:
-            return _get_doc_to_file(local_repo, host, port, password, newpath)
+            return _get_doc_to_file(conn, local_repo, password, newpath)
         else:
             raise ValueError('Temporary redirect (302) without a Location header while fetching ' + path)
     elif errcode == 401:
         raise ValueError("bad reply code 401 (not authorized) from remote repository")
     else:
-        raise ValueError('bad status %d (%s) received while fetching %s' % (errcode, errmsg, path))
+        raise ValueError('bad status %d (%s) received while fetching %s' % (errcode, response.reason, path))
 
-def _pull_doc (local_repo, doc_id, remote_repo_url, remote_password):
-    host, port, path = parse_URL(remote_repo_url)
-    return _get_doc_to_file(local_repo, host, port, remote_password, '/action/externalAPI/fetch_folder?doc_id=%s' % doc_id)
+def _fetch_doc (conn, local_repo, doc_id, remote_password):
+    return _get_doc_to_file(conn, local_repo, remote_password, '/action/externalAPI/fetch_folder?doc_id=%s' % doc_id)
+
+
+class _Checkpoints (object):
+
+    # Records the documents transferred to or from a remote repository, by
+    # "L" + local doc ID or "R" + remote doc ID, with the ID the document got
+    # on the other side.  The record is dropped when a synchronization finishes
+    # without failures.
+
+    def __init__(self, repo, remote_repo_url):
+        self.path = os.path.join(repo.overhead_folder(), "sync-checkpoints",
+                                 hashlib.sha1(remote_repo_url).hexdigest() + ".txt")
+        self.done = {}
+        if os.path.exists(self.path):
+            for line in open(self.path, 'r'):
+                parts = line.split()
+                if len(parts) == 2:
+                    self.done[parts[0]] = parts[1]
+
+    def record(self, key, new_id):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        fp = open(self.path, 'a')
+        try:
+            fp.write("%s %s\n" % (key, new_id))
+        finally:
+            fp.close()
+        self.done[key] = new_id
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.done = {}
+
+
+def _transfer_worker (repo, remote_repo_url, remote_password, jobs, results):
+
+    # Posts a result for every job it takes, however the job ends, and None
+    # when it stops, so that _transfer never waits on a worker that's gone.
+
+    conn = None
+    try:
+        while True:
+            try:
+                key, title = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            result = (key, title, None, 0, "transfer abandoned")
+            try:
+                try:
+                    if conn is None:
+                        conn = _connection(remote_repo_url)
+                    if key[0] == 'L':
+                        new_id, nbytes = _send_doc(conn, repo.get_document(key[1:]), remote_repo_url, remote_password)
+                    else:
+                        new_id, nbytes = _fetch_doc(conn, repo, key[1:], remote_password)
+                    result = (key, title, new_id, nbytes, None)
+                except:
+                    excn = sys.exc_info()
+                    note(0, "transferring %s:\n%s", key, ''.join(traceback.format_exception(*excn)))
+                    result = (key, title, None, 0, ''.join(traceback.format_exception_only(*excn[:2])).strip())
+                    # start over with a fresh connection
+                    if conn is not None:
+                        conn.close()
+            finally:
+                results.put(result)
+    finally:
+        if conn is not None:
+            conn.close()
+        results.put(None)
+
+def _transfer (repo, remote_repo_url, remote_password, items, fp):
+
+    """Push and pull documents, several at a time.  ITEMS is a list of (key, title), where
+    the key is "L" + the ID of a local document to push, or "R" + the ID of a remote document
+    to pull.  Documents which an earlier, interrupted call already transferred are skipped.
+    A line is written to FP (an HTML page) for each document, with the throughput so far and
+    an estimate of the time left.  Returns the number of documents which couldn't be transferred.
+    """
+
+    checkpoints = _Checkpoints(repo, remote_repo_url)
+    todo = [item for item in items if item[0] not in checkpoints.done]
+    if len(todo) < len(items):
+        fp.write("<p>%d documents were already transferred by an earlier synchronization.<br>\n" %
+                 (len(items) - len(todo)))
+    nworkers = configurator.default_configurator().get_int("synchronize-connections", _DEFAULT_CONNECTIONS)
+    nworkers = max(1, min(nworkers, len(todo)))
+    jobs = Queue.Queue()
+    results = Queue.Queue()
+    for item in todo:
+        jobs.put(item)
+    for i in range(nworkers):
+        uthread.start_new_thread(_transfer_worker, (repo, remote_repo_url, remote_password, jobs, results),
+                                 name="sync-transfer-%d" % i)
+    start = time.time()
+    total = failures = count = 0
+    while (count < len(todo)) and (nworkers > 0):
+        try:
+            result = results.get(timeout=_STALL_TIMEOUT)
+        except Queue.Empty:
+            fp.write("<p><b>No transfer finished in %d seconds; giving up on the rest.</b><br>\n" % _STALL_TIMEOUT)
+            # let the workers stop after what they're doing now
+            while not jobs.empty():
+                try:
+                    jobs.get_nowait()
+                except Queue.Empty:
+                    break
+            break
+        if result is None:
+            # a worker has stopped
+            nworkers -= 1
+            continue
+        count += 1
+        key, title, new_id, nbytes, error = result
+        verb = ((key[0] == 'L') and "push") or "pull"
+        title = (title and (" (%s)" % htmlescape(title))) or ""
+        if error:
+            failures += 1
+            fp.write("<b>couldn't %s doc %s%s:</b>  %s<br>\n" % (verb, key[1:], title, htmlescape(error)))
+            continue
+        checkpoints.record(key, new_id)
+        total += nbytes
+        elapsed = max(time.time() - start, 0.001)
+        fp.write("%sed doc %s%s as %s...  %d of %d, %.1f KB/sec, about %d seconds left<br>\n" %
+                 (verb, key[1:], title, new_id, count, len(todo), total / 1024.0 / elapsed,
+                  elapsed / count * (len(todo) - count)))
+    # the ones which never finished count as failures, to be retried next time
+    failures += len(todo) - count
+    elapsed = time.time() - start
+    fp.write("<p>Transferred %d documents, %.1f MB, in %.1f seconds" %
+             (len(todo) - failures, total / 1048576.0, elapsed))
+    if failures:
+        fp.write(";  %d couldn't be transferred.  Synchronizing again will retry them.<br>\n" % failures)
+    else:
+        fp.write(".<br>\n")
+        checkpoints.clear()
+    return failures
+
+def _transfer_items (hash_dict, remote_matches, codes):
+    # the (key, title) items for _transfer, from the differences returned by _check_hashes
+    items = []
+    for match in remote_matches:
+        note(4, "hash is %s, match_code is %s", match[0], match[1])
+        if match[1] not in codes:
+            continue
+        if match[1] == 'L':
+            doc = hash_dict[match[0]]
+            items.append(("L" + doc.id, doc.get_metadata("title") or ""))
+        elif match[1] == 'R':
+            items.append(("R" + match[2], ((len(match) > 3) and re.sub("`", " ", match[3])) or ""))
+    return items
 
 def _calculate_doc_hash (doc):
 
@@ -152,16 +386,20 @@ def _calculate_doc_hash (doc):
     return key
 
 
-def _check_hashes (hashes, remote_repo, remote_password):
+def _check_hashes (hashes, remote_repo, remote_password, prefixes=None):
 
     host, port, path = parse_URL(remote_repo)
 
     hashtext = string.join(hashes, "\n")
+    fields = [("hashes", hashtext),]
+    if prefixes is not None:
+        # only compare the fingerprints in these buckets
+        fields.append(("prefixes", _encode_prefixes(prefixes)))
 
     # create zipfile of the folder
     errcode, errmsg, headers, text = https_post_multipart(host, port, remote_password,
                                                           "/action/SynchronizeRepositories/check_hashes",
-                                                          [("hashes", hashtext),],
+                                                          fields,
                                                           ())
     if errcode != 200:
         note("Errcode %s received.  Error text from repository was\n%s.\n", errcode, errmsg)
@@ -177,10 +415,120 @@ def _check_hashes (hashes, remote_repo, remote_password):
         return results
 
 
-def _build_hash_dict (repo):
-    # build a list of document fingerprints
-    docs = repo.generate_docs()
+# Rather than sending every fingerprint to the other repository, we compare
+# summaries of the two repositories' fingerprint indices, bucketed by hex
+# prefix, a level at a time, and only look into the buckets which differ.
+# Buckets no bigger than this are compared fingerprint by fingerprint...
+_LEAF_BUCKET_SIZE = 64
+# ...as are buckets with prefixes this long
+_MAX_PREFIX_LENGTH = 8
+
+def _encode_prefixes (prefixes):
+    # the empty prefix (all the fingerprints) is sent as "-"
+    return string.join([(x or "-") for x in prefixes], "\n")
+
+def _decode_prefixes (text):
+    return [(((x != "-") and x) or "") for x in string.split(text)]
+
+def _fingerprint_index (repo):
+    # the repository's fingerprint index, with any documents it hasn't gotten to yet added
+    index = repo.fingerprints()
+    if len(index) < repo.docs_count():
+        known = index.fingerprints()
+        for doc in repo.generate_docs():
+            if doc.id not in known:
+                index.add(doc.id, doc.sha_hash())
+    return index
+
+def _remote_summary (prefixes, remote_repo, remote_password):
+
+    host, port, path = parse_URL(remote_repo)
+    errcode, errmsg, headers, text = https_post_multipart(host, port, remote_password,
+                                                          "/action/SynchronizeRepositories/summary",
+                                                          [("prefixes", _encode_prefixes(prefixes)),],
+                                                          ())
+    if errcode != 200:
+        note(3, "Errcode %s received asking %s for a fingerprint summary:  %s", errcode, remote_repo, errmsg)
+        return None
+    results = {}
+    for line in text.split("\n"):
+        parts = line.split()
+        if len(parts) == 3:
+            results[_decode_prefixes(parts[0])[0]] = (int(parts[1]), parts[2])
+    return results
+
+def _differing_buckets (index, remote_repo, remote_password):
+
+    """Find the fingerprint buckets which differ between this repository and the remote one,
+    asking for the remote summaries of all the buckets at one level in a single request.
+    Returns a list of prefixes, or None if the remote repository can't summarize its fingerprints.
+    """
+
+    differing = []
+    # maps each bucket to look at to the bucket it's part of
+    pending = { "" : None }
+    # maps each bucket being looked into to its (local, remote) fingerprint counts
+    expanded = {}
+    while pending:
+        prefixes = pending.keys()
+        remote = _remote_summary(prefixes, remote_repo, remote_password)
+        if remote is None:
+            return None
+        local = index.summary(prefixes)
+        counts = {}
+        for prefix in prefixes:
+            theirs = remote.get(prefix, (0, None))
+            parent = counts.setdefault(pending[prefix], [0, 0])
+            parent[0] += local[prefix][0]
+            parent[1] += theirs[0]
+            if local[prefix] == theirs:
+                continue
+            if ((max(local[prefix][0], theirs[0]) <= _LEAF_BUCKET_SIZE) or
+                (len(prefix) >= _MAX_PREFIX_LENGTH)):
+                differing.append(prefix)
+            else:
+                expanded[prefix] = (local[prefix][0], theirs[0])
+        # if a bucket's parts don't add up to it, some fingerprints aren't hex; compare it whole
+        for parent, parts in counts.items():
+            if (parent is not None) and (tuple(parts) != expanded[parent]):
+                differing.append(parent)
+        pending = {}
+        for prefix in [x for x in prefixes if x in expanded]:
+            for digit in "0123456789abcdef":
+                pending[prefix + digit] = prefix
+    return differing
+
+def _compare_with_remote (repo, remote_repo, remote_password):
+
+    """Returns a dict mapping fingerprints to local documents, and the differences between the
+    repositories, as returned by _check_hashes.  The dict holds at least the local documents
+    which aren't in the remote repository.
+    """
+
+    if hasattr(repo, "fingerprints"):
+        prefixes = _differing_buckets(_fingerprint_index(repo), remote_repo, remote_password)
+        if prefixes is not None:
+            note(3, "%d fingerprint buckets differ", len(prefixes))
+            if not prefixes:
+                return {}, []
+            hash_dict = _build_hash_dict(repo, prefixes)
+            return hash_dict, _check_hashes(hash_dict.keys(), remote_repo, remote_password, prefixes)
+        note(3, "%s can't summarize its fingerprints; sending all of them", remote_repo)
+    hash_dict = _build_hash_dict(repo)
+    return hash_dict, _check_hashes(hash_dict.keys(), remote_repo, remote_password)
+
+
+def _build_hash_dict (repo, prefixes=None):
+    # build a list of document fingerprints, from the fingerprint index if there is one
     hash_dict = {}
+    if hasattr(repo, "fingerprints"):
+        contents = _fingerprint_index(repo).bucket_contents(prefixes or ("",))
+        for hashvalue, doc_ids in contents.iteritems():
+            doc_ids = [x for x in doc_ids if repo.valid_doc_id(x)]
+            if doc_ids:
+                hash_dict[hashvalue] = repo.get_document(doc_ids[0])
+        return hash_dict
+    docs = repo.generate_docs()
     for doc in docs:
         if hasattr(doc, "sha_hash"):
             hashvalue = doc.sha_hash()
@@ -190,6 +538,27 @@ def _build_hash_dict (repo):
     return hash_dict
 
 
+def summary (repo, response, params):
+
+    """Return lines of
+    <prefix> <count> <digest>
+    summarizing the fingerprints starting with each of the (whitespace-separated)
+    prefixes in the "prefixes" parameter, as in uplib.fingerprints.FingerprintIndex.summary.
+    The empty prefix, for all the fingerprints, is written as "-".
+    """
+
+    if not hasattr(repo, "fingerprints"):
+        response.error(HTTPCodes.NOT_IMPLEMENTED, "<p>No fingerprint index in this repository.")
+        return
+    prefixes = _decode_prefixes(params.get("prefixes") or "-")
+    results = _fingerprint_index(repo).summary(prefixes)
+    fp = response.open("text/plain")
+    for prefix in prefixes:
+        count, digest = results[prefix]
+        fp.write("%s %d %s\n" % (prefix or "-", count, digest))
+    fp.close()
+
+
 def check_hashes (repo, response, params):
 
     """Return values are one of
@@ -198,14 +567,16 @@ def check_hashes (repo, response, params):
     """
 
     remote_hashes = params.get("hashes")
+    prefixes = params.get("prefixes")
     note("checking hashes...")
-    if not remote_hashes:
+    if (not remote_hashes) and (not prefixes):
         response.error(HTTPCodes.BAD_REQUEST, "<p>No hashes specified.")
         note("no hashes")
         return
     note("hashes are %s", remote_hashes)
-    hash_dict = _build_hash_dict(repo)
-    remote_hash_list = string.split(remote_hashes, "\n")
+    # if prefixes are given, only the fingerprints in those buckets are compared
+    hash_dict = _build_hash_dict(repo, (prefixes and _decode_prefixes(prefixes)) or None)
+    remote_hash_list = string.split(remote_hashes or "")
     retval = ""
     for hash in remote_hash_list:
         note("checking remote hash %s", hash)
@@ -241,13 +612,8 @@ def sync (repo, response, params):
 
     remote_password = params.get('password', "")
 
-    # build a list of document fingerprints
-    hash_dict = _build_hash_dict(repo)
-
-    note("hash dict is %s", hash_dict)
-
-    # check each fingerprint with remote repository
-    remote_matches = _check_hashes (hash_dict.keys(), remote_repo, remote_password)
+    # find the fingerprints which differ between the repositories
+    hash_dict, remote_matches = _compare_with_remote(repo, remote_repo, remote_password)
 
     note("remote matches are %s", remote_matches)
 
@@ -255,19 +621,8 @@ def sync (repo, response, params):
     if not remote_matches:
         fp.write("<P>Both repositories match.<br>\n")
     else:
-        # push across all matches that aren't on the remote side
-        for match in remote_matches:
-            note("hash is %s, match_code is %s", match[0], match[1])
-            if match[1] == 'L':
-                _push_doc (hash_dict[match[0]], remote_repo, remote_password)
-                doc = hash_dict[match[0]]
-                note("doc is %s", doc)
-                fp.write("pushed doc %s (%s)...<br>" % (doc.id, doc.get_metadata("title")))
-            elif match[1] == 'R':
-                _pull_doc (repo, match[2], remote_repo, remote_password)
-                note("remote doc ID is %s", match[2])
-                title = ((len(match) > 3) and re.sub("`", " ", match[3])) or ""
-                fp.write("pulled doc %s (%s)...<br>" % (match[2], title))
+        # push across all matches that aren't on the remote side, and pull the ones only there
+        _transfer(repo, remote_repo, remote_password, _transfer_items(hash_dict, remote_matches, "LR"), fp)
     fp.close()
 
 def syncdocs (repo, response, params):
@@ -290,18 +645,15 @@ def syncdocs (repo, response, params):
     pushing = params.has_key('both') or params.has_key('push')
     pulling = params.has_key('both') or params.has_key('pull')
 
-    fp = response.open()
-
+    items = []
     for doc_id in doc_ids:
         if doc_id[0] == 'R' and pulling:
-            id = _pull_doc (repo, doc_id[1:], remote_repo, remote_password)
-            fp.write("<p>Pulled %s from remote repository, local ID is %s\n" % (doc_id[1:], id))
+            items.append((doc_id, ""))
         if doc_id[0] == 'L' and pushing:
-            doc = repo.get_document(doc_id[1:])
-            id = _push_doc (doc, remote_repo, remote_password)
-            title = doc.get_metadata("title")
-            title = (title and (" (" + title + ")")) or ""
-            fp.write("<p>Pushed %s%s to remote repository; remote ID is %s\n" % (doc_id[1:], title, id))
+            items.append((doc_id, repo.get_document(doc_id[1:]).get_metadata("title") or ""))
+
+    fp = response.open()
+    _transfer(repo, remote_repo, remote_password, items, fp)
     fp.close()
 
 def push (repo, response, params):
@@ -314,13 +666,8 @@ def push (repo, response, params):
 
     remote_password = params.get('password', "")
 
-    # build a list of document fingerprints
-    hash_dict = _build_hash_dict(repo)
-
-    note("hash dict is %s", hash_dict)
-
-    # check each fingerprint with remote repository
-    remote_matches = _check_hashes (hash_dict.keys(), remote_repo, remote_password)
+    # find the fingerprints which differ between the repositories
+    hash_dict, remote_matches = _compare_with_remote(repo, remote_repo, remote_password)
 
     note("remote matches are %s", remote_matches)
 
@@ -329,13 +676,7 @@ def push (repo, response, params):
         fp.write("<P>Both repositories match.<br>\n")
     else:
         # push across all matches that aren't on the remote side
-        for match in remote_matches:
-            note("hash is %s, match_code is %s", match[0], match[1])
-            if match[1] == 'L':
-                _push_doc (hash_dict[match[0]], remote_repo, remote_password)
-                doc = hash_dict[match[0]]
-                note("doc is %s", doc)
-                fp.write("pushed doc %s (%s)...<br>" % (doc.id, doc.get_metadata("title")))
+        _transfer(repo, remote_repo, remote_password, _transfer_items(hash_dict, remote_matches, "L"), fp)
     fp.close()
 
 def pull (repo, response, params):
@@ -348,13 +689,8 @@ def pull (repo, response, params):
 
     remote_password = params.get('password', "")
 
-    # build a list of document fingerprints
-    hash_dict = _build_hash_dict(repo)
-
-    note("hash dict is %s", hash_dict)
-
-    # check each fingerprint with remote repository
-    remote_matches = _check_hashes (hash_dict.keys(), remote_repo, remote_password)
+    # find the fingerprints which differ between the repositories
+    hash_dict, remote_matches = _compare_with_remote(repo, remote_repo, remote_password)
 
     note("remote matches are %s", remote_matches)
 
@@ -362,13 +698,8 @@ def pull (repo, response, params):
     if not remote_matches:
         fp.write("<P>Both repositories match.<br>\n")
     else:
-        # push across all matches that aren't on the remote side
-        for match in remote_matches:
-            note("hash is %s, match_code is %s", match[0], match[1])
-            if match[1] == 'R':
-                _pull_doc (repo, match[2], remote_repo, remote_password)
-                note("remote doc ID is %s", match[2])
-                fp.write("pulled doc %s...<br>" % match[2])
+        # pull across all matches that aren't on the local side
+        _transfer(repo, remote_repo, remote_password, _transfer_items(hash_dict, remote_matches, "R"), fp)
     fp.close()
 
 
@@ -405,14 +736,9 @@ def synchronize (repo, response, params):
     local_checked = test_boolean_param(params.get("localchecked", "false"))
     remote_checked = test_boolean_param(params.get("remotechecked", "false"))
 
-    # build a list of document fingerprints
-    hash_dict = _build_hash_dict(repo)
-
-    note("hash dict is %s", hash_dict)
-
-    # check each fingerprint with remote repository
+    # find the fingerprints which differ between the repositories
     remote_password = params.get("password", "")
-    remote_matches = _check_hashes (hash_dict.keys(), repository_url, remote_password)
+    hash_dict, remote_matches = _compare_with_remote(repo, repository_url, remote_password)
     note("remote_matches are %s", remote_matches)
 
     if remote_matches is None:
@@ -203,15 +203,58 @@ def patient_mod_time(repo, response, params):
 def _bg_mod_time(repo, response, last, max_delay):
     """Reports mod_time to web client shortly after max_delay seconds, typically.
 
-    Upon noticing a mod_time change, this background thread will report at once. 
+    Upon noticing a mod_time change, this background thread will report at once.
+    It sleeps on the repository's change feed, so a change to a document wakes
+    it immediately; other changes are noticed within MOD_TIME_RECHECK seconds.
     """
+    feed = repo.changes()
+    seq = feed.sequence()
     deadline = time.time() + max_delay
     while repo.database() and time.time() < deadline and repo.mod_time() == last:
-        time.sleep(0.080)  # human perceptual threshold
+        seq = feed.changes(seq, min(deadline - time.time(), MOD_TIME_RECHECK))[0]
     response.reply(str(repo.mod_time()), 'text/plain')
-    # At shutdown time, first __database becomes None, then hooks are called.
-    # We exit immediately at shutdown time, but it would be better to register
-    # a UVFS shutdown hook which simply advances mod_time.
+    # At shutdown time, first __database becomes None, then hooks are called,
+    # and the change feed's shutdown hook wakes us.
+
+# seconds between checks for changes which aren't in the change feed
+MOD_TIME_RECHECK = 1.0
+
+def changes(repo, response, params):
+    """Report the changes to documents since the caller last asked.
+
+    The caller specifies the 'epoch' and 'since' sequence number from the
+    first line of the previous reply, and 'max_delay'.  The first line of the
+    reply is 'epoch seqno'; each following line is 'seqno kind doc_id', where
+    kind is 'add', 'delete', 'touch', or 'metadata'.  If there are no changes
+    yet, we wait up to max_delay seconds for one.  If the caller's epoch isn't
+    the current one (the repository has restarted), or the changes since then
+    are no longer kept, the first line is 'epoch seqno reset', and the caller
+    should discard everything it knows about the repository.
+    """
+    feed = repo.changes()
+    max_delay = min(int(params.get('max_delay') or 0), 300)  # Clamp to 5 minutes.
+    try:
+        since = int(params.get('since'))
+    except (TypeError, ValueError):
+        since = None
+    if (params.get('epoch') != feed.epoch) or (since is None):
+        return response.reply('%s %d reset\n' % (feed.epoch, feed.sequence()), 'text/plain')
+    seq, events = feed.changes(since)
+    if (not events) and (events is not None) and (max_delay > 0):
+        response.fork_request(_bg_changes, repo, response, since, max_delay)
+    _reply_changes(response, feed, seq, events)
+
+def _bg_changes(repo, response, since, max_delay):
+    feed = repo.changes()
+    seq, events = feed.changes(since, max_delay)
+    _reply_changes(response, feed, seq, events)
+
+def _reply_changes(response, feed, seq, events):
+    if events is None:
+        lines = ['%s %d reset' % (feed.epoch, seq)]
+    else:
+        lines = ['%s %d' % (feed.epoch, seq)] + ['%d %s %s' % event for event in events]
+    response.reply('\n'.join(lines) + '\n', 'text/plain')
 
 def matching_docids(repo, response, params):
     """Search for documents matching query=terms and return zero or more ids.
@@ -497,6 +540,50 @@ def metadata_for_category(repo, response, params):
     result.sort()
     response.reply('\n'.join(result), 'text/plain')
 
+def metadata_for_categories(repo, response, params):
+    """Return the documents in many categories, and their metadata, in one reply.
+
+    For each category there's a line 'category<TAB>name<TAB>id1 id2 ... idN',
+    and then there's a metadata line (as from metadata_for_docs) for each
+    document in any of them, except those listed in 'known', whose metadata
+    the caller already has.  The categories are those named by the 'category'
+    parameters, or all of them if there are none; if 'subcategories' is
+    'true', those below them (like 'a/b' and 'a/b/c' below 'a') are included
+    too, and if it's 'children', just those one level below them (like 'a/b').
+    A category which is asked for is listed even if nothing is tagged with it.
+    """
+    wanted = params.get('category') or []
+    if type(wanted) in types.StringTypes:
+        wanted = [wanted,]
+    wanted = [x.strip().lower() for x in wanted]
+    below = params.get('subcategories')
+    known = set((params.get('known') or '').split())
+    categories = repo.get_categories_with_docs()
+    def is_below(cat, x):
+        rest = cat.startswith(x + '/') and cat[len(x) + 1:]
+        return rest and ((below == 'true') or ('/' not in rest))
+    if (below in ('true', 'children')) or (not wanted):
+        names = [cat for cat in categories if cat and
+                 ((not wanted) or [x for x in wanted if is_below(cat, x)])] + wanted
+    else:
+        names = wanted
+    lines = []
+    docs = {}
+    for cat in sorted(set(names)):
+        ids = []
+        for id in categories.get(cat) or []:
+            if id not in docs:
+                docs[id] = get_document_if_valid(repo, id)
+            if docs[id]:
+                ids.append(id)
+        # a category which tags only deleted documents isn't listed unless asked for
+        if ids or (cat in wanted):
+            lines.append('category\t%s\t%s' % (cat, ' '.join(sorted(ids))))
+    for id in sorted(docs):
+        if docs[id] and (id not in known):
+            _add_metadata(docs[id], lines)
+    response.reply('\n'.join(lines), 'text/plain')
+
 def categories_for_doc(repo, response, params):
     """Returns all category strings that doc_id is tagged with."""
     id = params.get('id') or params['doc_id']
@@ -145,10 +145,10 @@ def _add_internal (ostream, percent_done_fn, repo, response, params, content, wa
             uploadloc = tempf
         if suppress_duplicates:
             hash = calculate_originals_fingerprint(tempf)
-            results = repo.do_query("sha-hash:"+hash)
+            results = repo.find_duplicates(hash)
             if results:
                 # it's a duplicate
-                doc = results[0][1]
+                doc = results[0]
                 if os.path.isdir(tempf):
                     shutil.rmtree(tempf)
                 elif os.path.exists(tempf):
@@ -195,6 +195,9 @@ def _add_internal (ostream, percent_done_fn, repo, response, params, content, wa
                 cmd += ' --categories=%s' % pipes.quote(doccats)
             if mdtmpfile:
                 cmd += ' --metadata="%s"' % mdtmpfile
+            priority = params.get("priority") or (bury and "bulk")
+            if priority:
+                cmd += ' --priority=%s' % pipes.quote(priority)
             cmd += ' "%s"' % uploadloc
             if ostream:
                 _rewrite_job_output(ostream, '{state: 0, msg: "' + urllib.quote(cmd) + '"}')
@@ -313,6 +316,9 @@ def add(repo, response, params):
            the newly added document to be "buried" in the history list, so that it \
            won't show up in the most-recently-used listing, as it normally would
     :type bury: boolean
+    :param priority: optional, "interactive", "normal", or "bulk"; defaults to "bulk" if `bury` is "true", \
+           "normal" otherwise.  Controls how soon the repository incorporates the document.
+    :type priority: string
     :param md-title: title to put in the document metadata
     :type md-title: string
     :param md-authors: standard UpLib authors line (" and "-separated) to put in the document metadata
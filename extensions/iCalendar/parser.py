@@ -451,7 +451,7 @@ else:
                         fp.close()
                         fingerprint = calculate_originals_fingerprint(filename)
                         # look up fingerprint in repo to see if we already have it
-                        hits = repo.do_query('sha-hash:%s' % fingerprint)
+                        hits = repo.find_duplicates(fingerprint)
                         if hits:
                             # already there, so skip this one
                             note(3, "skipping '%s', already in repo...", identifier)
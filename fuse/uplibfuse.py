@@ -34,7 +34,6 @@ import mimetypes
 import os
 import Queue
 import re
-import sha
 import stat
 import string
 import StringIO
@@ -52,7 +51,7 @@ import xattr
 import zipfile
 import zlib
 from errno import EACCES, EEXIST, EFAULT, EINVAL, ENODATA, ENOENT, ENOSYS, \
-    EOPNOTSUPP as ENOTSUP, EBADF
+    EOPNOTSUPP as ENOTSUP, EBADF, EIO
 from stat import S_IFDIR, S_IFLNK, S_IFREG, S_IRUSR, S_IWUSR, S_IXUSR, S_IRWXU
 from time import gmtime, mktime, strftime, sleep
 from pprint import pprint as pp
@@ -61,7 +60,7 @@ from uplib.fuse.ctypesfuse import FUSE, FuseError, FuseOperations
 from uplib.addDocument import CONTENT_TYPES
 from uplib.webutils import fetch_url, get_content_type, \
     get_extension_for_type, https_post_multipart, HTTPCodes
-from uplib.plibUtil import note, parse_date, read_metadata, DOC_ID_RE  # MutexLock
+from uplib.plibUtil import note, parse_date, read_metadata, configurator, OrderedDict, DOC_ID_RE  # MutexLock
 
 import LaunchServices           # to look up OSType
 
@@ -81,6 +80,12 @@ NON_STRING_METADATA_KEYS = ("is_wpc",)
 
 CONTENT_CACHER = None
 
+# Originals are fetched a block at a time, as they're read, and the blocks
+# are kept on disk in a cache of this many kilobytes, unless the
+# "uvfs-block-cache-size" configuration option says otherwise.
+BLOCK_SIZE = 1 << 20
+BLOCK_CACHE_SIZE = 512 * 1024
+
 def _build_statinfo(size, extra_fields={}):
     now = time.time()
     stat = {'st_mode':  S_IRUSR,
@@ -370,6 +375,216 @@ class ContentCacher(object):
         return FileContent(Pathname(filepath))
 
 
+class BlockCache(object):
+    """An on-disk cache of fixed-size blocks of files, keyed by the file's content hash and
+    the block's index, which drops the least recently used blocks when it gets too big."""
+
+    def __init__(self, cache_root, maxbytes, blocksize=BLOCK_SIZE):
+        if not os.path.exists(cache_root):
+            os.makedirs(cache_root)
+        elif not os.path.isdir(cache_root):
+            raise ValueError("cache_root (%s) must be a directory we can write" % cache_root)
+        self.__root = cache_root
+        self.maxbytes = maxbytes
+        self.blocksize = blocksize
+        self.__lock = threading.Lock()
+        # block filename => size, least recently used first
+        self.__blocks = OrderedDict()
+        self.nbytes = 0
+        names = [x for x in os.listdir(cache_root) if not x.endswith('.new')]
+        names.sort(key=lambda x: os.path.getmtime(os.path.join(cache_root, x)))
+        for name in names:
+            size = os.path.getsize(os.path.join(cache_root, name))
+            self.__blocks[name] = size
+            self.nbytes += size
+        self.__lock.acquire()
+        try:
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    def __str__(self):
+        return '<BlockCache %s, %d blocks, %d bytes>' % (self.__root, len(self.__blocks), self.nbytes)
+
+    def __evict(self):
+        # called with the lock held
+        while (self.nbytes > self.maxbytes) and self.__blocks:
+            name, size = self.__blocks.popitem(last=False)
+            self.nbytes -= size
+            try:
+                os.unlink(os.path.join(self.__root, name))
+            except OSError:
+                pass
+
+    def get(self, key, index):
+        """Returns the bytes of the block, or None if it isn't cached."""
+        name = '%s-%d' % (key, index)
+        self.__lock.acquire()
+        try:
+            size = self.__blocks.pop(name, None)
+            if size is None:
+                return None
+            # move it to the most-recently-used end, here and on disk
+            self.__blocks[name] = size
+            filepath = os.path.join(self.__root, name)
+            try:
+                os.utime(filepath, None)
+                fp = open(filepath, 'rb')
+                try:
+                    return fp.read()
+                finally:
+                    fp.close()
+            except (OSError, IOError):
+                self.nbytes -= self.__blocks.pop(name)
+                return None
+        finally:
+            self.__lock.release()
+
+    def put(self, key, index, data):
+        if self.maxbytes <= 0:
+            return
+        name = '%s-%d' % (key, index)
+        filepath = os.path.join(self.__root, name)
+        self.__lock.acquire()
+        try:
+            if name in self.__blocks:
+                return
+            fp = open(filepath + '.new', 'wb')
+            try:
+                fp.write(data)
+            finally:
+                fp.close()
+            os.rename(filepath + '.new', filepath)
+            self.__blocks[name] = len(data)
+            self.nbytes += len(data)
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+
+class RemoteContent(object):
+
+    """Read-only FileContent for a file in the repository, which fetches the
+    blocks it's asked for with HTTP range requests, and keeps them in a
+    BlockCache rather than in memory.  If the server ignores the range and
+    returns the whole file, all the blocks are cached as they arrive."""
+
+    def __init__(self, url, size, key, cache, password=''):
+        self.url = url
+        self.size = size
+        self.key = key
+        self.cache = cache
+        self.password = password
+        self.__pos = 0
+
+    def __str__(self):
+        return '<RemoteContent %s (%d bytes) as %s>' % (self.url, self.size, self.key)
+
+    def __nonzero__(self):
+        return True
+
+    def __len__(self):
+        return self.size
+
+    def tell(self):
+        return self.__pos
+
+    def seek(self, pos, kind=0):
+        if kind == 1:
+            pos += self.__pos
+        elif kind == 2:
+            pos += self.size
+        self.__pos = max(0, pos)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def read(self, nbytes=-1):
+        start = self.__pos
+        if (nbytes < 0) or (start + nbytes > self.size):
+            end = self.size
+        else:
+            end = start + nbytes
+        if start >= end:
+            return ''
+        blocksize = self.cache.blocksize
+        first, last = start // blocksize, (end - 1) // blocksize
+        blocks = {}
+        missing = []
+        for index in range(first, last + 1):
+            data = self.cache.get(self.key, index)
+            if data is None:
+                missing.append(index)
+            else:
+                blocks[index] = data
+        # fetch each run of consecutive missing blocks with one request
+        while missing:
+            run = 1
+            while (run < len(missing)) and (missing[run] == missing[0] + run):
+                run += 1
+            blocks.update(self.__fetch(missing[0], missing[run - 1]))
+            missing = missing[run:]
+        data = ''.join([blocks[index] for index in range(first, last + 1)])
+        offset = start - (first * blocksize)
+        self.__pos = end
+        return data[offset:offset + (end - start)]
+
+    def write(self, value):
+        raise IOError(EACCES, "%s is read-only" % self)
+
+    def getvalue(self):
+        pos = self.__pos
+        self.__pos = 0
+        try:
+            return self.read()
+        finally:
+            self.__pos = pos
+
+    def __fetch(self, first, last):
+        """Returns a dict mapping block index to the bytes of that block, for FIRST through LAST."""
+        blocksize = self.cache.blocksize
+        req = urllib2.Request(self.url)
+        if self.password:
+            req.add_header('Password', self.password)
+        req.add_header('Range', 'bytes=%d-%d' % (first * blocksize,
+                                                 min(self.size, (last + 1) * blocksize) - 1))
+        logging.debug("fetching blocks %d-%d of %s", first, last, self)
+        response = urllib2.urlopen(req)
+        try:
+            if response.getcode() == 206:
+                m = re.match(r'bytes\s+(\d+)-', response.info().getheader('Content-Range') or '')
+                if (not m) or (int(m.group(1)) != first * blocksize):
+                    raise IOError(EIO, 'bad Content-Range %s for %s' % (
+                        response.info().getheader('Content-Range'), self))
+                index = first
+            else:
+                # the whole file
+                index = 0
+            blocks = {}
+            while True:
+                data = response.read(blocksize)
+                while data and (len(data) < blocksize):
+                    more = response.read(blocksize - len(data))
+                    if not more:
+                        break
+                    data += more
+                if not data:
+                    break
+                self.cache.put(self.key, index, data)
+                if first <= index <= last:
+                    blocks[index] = data
+                index += 1
+        finally:
+            response.close()
+        for index in range(first, last + 1):
+            if index not in blocks:
+                raise IOError(EIO, 'block %d of %s not returned' % (index, self))
+        return blocks
+
+
 class UvfsFileObject(object):
     def __init__(self, filename):
         self.filename = Filename(filename)  # Just a hint, for debugging; the .dir keys hold the "real" filenames.
@@ -422,7 +637,7 @@ class UvfsFile(UvfsFileObject):
 
         self.writer_lock = threading.Lock()  # protects .writer manipulations
         self.write_request = Queue.Queue()
-        if isinstance(contents, FileContent):
+        if isinstance(contents, (FileContent, RemoteContent)):
             self.content = contents
         else:
             self.content = FileContent(StringIO.StringIO(contents))
@@ -497,6 +712,10 @@ class UbidocsBackingStore():
         # As cache entries age, they are either rejuvenated or reaped.
         self.fresh = PriorityQueue()  # We *don't* want it to fill up.
         self.docs = {}  # metadata cache, indexed by doc_id
+        # category => (time fetched, doc_ids), as last fetched
+        self.listings = {}
+        # all the category names, with the levels above them, as of the last listing of categories/
+        self.category_names = set()
         #icon_path = '/Library/UbiDocs/1.0/ContextBar/ContextBar.app/Contents/Resources/ubidocs-logo.icns'  # Must process with 'sips -i'.
         #self.ubi_icns = xattr.getxattr(icon_path, 'com.apple.ResourceFork')
         line = self._extension_result('/UVFS/repo_root_and_most_recent_docid')
@@ -510,6 +729,7 @@ class UbidocsBackingStore():
         self._init_top_level()
         self._init_logging()
         # self._init_caching()
+        self._init_block_cache()
         mimetypes.init()
         id = line.split()[0]
         if len(id)==17 and DOC_ID_RE.search(id):
@@ -518,18 +738,28 @@ class UbidocsBackingStore():
     def _init_top_level(self):
         """Replace top level directories with empty/deferred ones so the repo will be queried for fresh data."""
         self.fresh = PriorityQueue()  # Should carefully delete old entries.
-        for dir_name, hook in [('search', self.content_for_search),
-                               ('categories', self.content_for_categories)]:
-            if self.root.dir.get(Filename(dir_name)):
-                del(self.root.dir[Filename(dir_name)])
-            dir = DeferredDirectory(dir_name, hook)
-            dir.set_nonexpiring()
-            self.add(self.root, dir)
+        self.listings = {}
+        for dir_name in ('search', 'categories'):
+            self._defer_top_level(dir_name)
+
+    def _defer_top_level(self, dir_name):
+        """Replace one top level directory with an empty/deferred one."""
+        hook = {'search': self.content_for_search,
+                'categories': self.content_for_categories}[dir_name]
+        if self.root.dir.get(Filename(dir_name)):
+            del(self.root.dir[Filename(dir_name)])
+        dir = DeferredDirectory(dir_name, hook)
+        dir.set_nonexpiring()
+        self.add(self.root, dir)
 
     def _init_caching(self):
         global CONTENT_CACHER
         CONTENT_CACHER = ContentCacher(os.path.join(self._repo_uvfs_dir(), "cache"))
 
+    def _init_block_cache(self):
+        kbytes = configurator.default_configurator().get_int("uvfs-block-cache-size", BLOCK_CACHE_SIZE)
+        self.blocks = BlockCache(os.path.join(self._repo_uvfs_dir(), "blocks"), kbytes * 1024)
+
     def _init_logging(self):
         """Make this daemon log to overhead/UVFS/request.log by default."""
         logger = logging.getLogger()
@@ -563,6 +793,19 @@ class UbidocsBackingStore():
             result = '[x]'  # huge HTML elided
         return result
 
+    def _extension_post(self, url_ending, fields):
+        """Like _extension_result, but POSTs the (name, value) FIELDS, which may be too long for a URL."""
+        assert url_ending.startswith('/')
+        selector = '/action' + url_ending
+        parsed_url = urlparse.urlparse(urlparse.urljoin(self.repo_url, selector))
+        status, ok, httpMessageInstance, result = \
+            https_post_multipart(parsed_url.hostname, parsed_url.port,
+                                 self.password, selector, fields, [])
+        if int(status) != HTTPCodes.OK:  # 200
+            logging.error('Failed to retrieve result for %s  %s %s', selector, status, ok)
+            raise UvfsError('%s failed, %s %s; %s' % (selector, status, ok, result))
+        return result
+
     def _is_cached(self, path):
         """Predicate, returns True if a valid (fresh) cache entry was found.
 
@@ -953,27 +1196,33 @@ class UbidocsBackingStore():
 
     def content_for_categories(self, path):
         """/categories/
+        Only the category names are fetched here; each category's directory
+        is filled in when it's first looked at.
         """
         categories_dir = UvfsDirectory('categories')
         categories_dir.stat['st_mode'] |= S_IWUSR
         self.add(self.root, categories_dir)
+        self.category_names = set()
         for category in self._extension_result('/UVFS/get_categories').split('\n'):
-            parent_path = '/categories'
-            parts = category.split('/')
-            for part in parts:
-                parent = self.get(parent_path)
-                dirpath = os.path.join(parent_path, part)
-                logging.debug("looking at %s", dirpath)
-                dir = self.get(dirpath)
-                # This would be better modeled by having the content method
-                # add entries rather than replacing.
-                if not dir:
-                    dir = self.content_for_a_category_level(dirpath)
-                    logging.debug("added %s", dirpath)
-                dir.stat['st_mode'] |= S_IWUSR
-                parent_path = dirpath
+            # Levels like 'a' of 'a/b' get directories even if nothing is tagged 'a'.
+            parts = [part for part in category.split('/') if part]
+            for i in range(1, len(parts) + 1):
+                self.category_names.add('/'.join(parts[:i]))
+        for name in self._subcategories(''):
+            self._add_category_dir(categories_dir, name)
         return categories_dir
 
+    def _subcategories(self, category):
+        """Return the names of the categories one level below CATEGORY ('' for the top level)."""
+        prefix = category and (category + '/')
+        return sorted(set([c[len(prefix):].split('/')[0]
+                           for c in self.category_names if c.startswith(prefix)]))
+
+    def _add_category_dir(self, parent, name):
+        dir = DeferredDirectory(name, self.content_for_a_category_level)
+        dir.stat['st_mode'] |= S_IWUSR
+        self.add(parent, dir)
+
 
     def content_for_a_specific_category(self, path):
         """/categories/a/b/c/
@@ -1004,7 +1253,8 @@ class UbidocsBackingStore():
         dir.stat['st_mode'] |= S_IWUSR
         if parent.dir.get(basename):
             self.remove(path)
-        # no paths for this sub-category now
+        for name in self._subcategories(category):
+            self._add_category_dir(dir, name)
         for f in self.links_for_a_category_level(category):
             if f.filename not in dir.dir:
                 self.add(dir, f)
@@ -1042,32 +1292,48 @@ class UbidocsBackingStore():
         f.icns = zlib.decompress(base64.b64decode(md['icns']))
         return f
 
+    def _category_listings(self, category):
+        """Fetch the doc_ids in CATEGORY and in the categories one level below it,
+        and the metadata of any of those docs we don't know yet, in one request.
+        The listings are kept in self.listings, and returned as a dict of
+        category => doc_ids."""
+        categories = [category] + [category + '/' + name for name in self._subcategories(category)]
+        # Only the docs last seen in these categories are worth mentioning as known.
+        known = set()
+        for c in categories:
+            known.update([id for id in self.listings.get(c, (0, []))[1] if id in self.docs])
+        fields = [('category', category), ('subcategories', 'children'), ('known', ' '.join(sorted(known)))]
+        now = time.time()
+        listings = {}
+        for line in self._extension_post('/UVFS/metadata_for_categories', fields).split('\n'):
+            if line.startswith('category\t'):
+                junk, c, ids = line.split('\t')
+                listings[c] = ids.split()
+            elif line:
+                md = self._parse_metadata(line)
+                self.docs[md['id']] = md
+        for c in categories:
+            # Levels like 'a' of 'a/b' aren't listed if nothing is tagged 'a'.
+            listings.setdefault(c, [])
+        for c, ids in listings.items():
+            self.listings[c] = (now, ids)
+        return listings
+
     def links_for_a_category_level(self, category):
         """Return a list of UvfsSymlinks."""
         #logging.debug("  links_for_a_category_level(%s):\n%s", category,
         #              ''.join(traceback.format_stack()[:-1]))
 
+        fetched, ids = self.listings.get(category, (0, None))
+        if ((ids is None) or (time.time() > fetched + self.max_unused_interval) or
+            [name for name in self._subcategories(category) if (category + '/' + name) not in self.listings]):
+            # Fetch the level below it too, as it's likely to be looked at next.
+            ids = self._category_listings(category).get(category, [])
         result = []
-        docs4cat = '/UVFS/docs_for_category?category=' + urllib.quote_plus(category)
-        need_metadata_for = []
-        for line in self._extension_result(docs4cat).split('\n'):
-            if not line:
-                continue  # There were no matching documents for that category.
-            id, hash = line.strip().split()
-            if id not in self.docs:
-                need_metadata_for.append(id)
-            else:
-                result.append(
-                    self._new_symlink_for_category_doc(category, self.docs[id]))
-        # now get md for docs we don't know about yet
-        if need_metadata_for:
-            md4docs = '/UVFS/metadata_for_docs?id=' + '&id='.join(need_metadata_for)
-            for line in self._extension_result(md4docs).split('\n'):
-                if not line:
-                    continue
-                md = self._parse_metadata(line)
+        for id in ids:
+            md = self.docs.get(id)
+            if md:
                 result.append(self._new_symlink_for_category_doc(category, md))
-                self.docs[md['id']] = md
         return result
 
 
@@ -1127,7 +1393,15 @@ class UbidocsBackingStore():
         logging.debug("content_for_originals_dir(%s), CONTENT_CACHER is %s", path, CONTENT_CACHER)
         md = self.get_metadata(id)
         f = None
-        if CONTENT_CACHER:
+        if not md['is_wpc']:
+            # a single file, read a block at a time as it's needed
+            if md.get('sha-hash'):
+                key = md['sha-hash']
+            else:
+                key = hashlib.sha1('%s %s %s' % (id, md['mtime'], md['size'])).hexdigest()
+            f = RemoteContent(urlparse.urljoin(self.repo_url, '/action/externalAPI/fetch_original?doc_id=' + id),
+                              int(md['size']), key, self.blocks, password=self.password)
+        elif CONTENT_CACHER:
             if "sha-hash" in md:
                 logging.debug("   get_cached_hash(%s)", md["sha-hash"])
                 f = CONTENT_CACHER.get_cached_hash(md["sha-hash"])
@@ -1186,11 +1460,10 @@ class UbidocsBackingStore():
             # single file
             assert not md['is_wpc']
             f = UvfsFile(fname, ctime=ctime, contents=f)
-            f.stat['st_mode'] |= S_IWUSR
-            digest = sha.new()  # Single files are mutable; zips are not.
+            f.stat['st_mode'] |= S_IWUSR  # Single files are mutable; zips are not.
             logging.debug("f.content is %s", f.content)
-            digest.update(f.content.read())
-            f.digest = digest.hexdigest()
+            # the repository's fingerprint of a single-file original is the SHA-1 of the file
+            f.digest = md.get('sha-hash') or hashlib.sha1(f.content.getvalue()).hexdigest()
             self.add(orig_dir, f)
 
         # now fill out page-images skeleton
@@ -1308,7 +1581,37 @@ class UbidocsBackingStore():
 
 
     def _poller(self):
-        """Thread polls repo in the background, looking for changes."""
+        """Thread follows the repo's change feed in the background, applying each change to our tree."""
+        epoch, seq = '', 0
+        refreshed = time.time()
+        while self.bg:
+            time.sleep(0.2)  # Limit our attempted poll rate during net fail.
+            r = '/UVFS/changes?max_delay=119&epoch=%s&since=%d'  # every 2 minutes, at most
+            try:
+                result = self._extension_result(r % (epoch, seq))
+            except urllib2.HTTPError, e:
+                if epoch:
+                    raise
+                logging.info('No change feed in the repository (%s); polling its mod_time instead', e)
+                return self._poll_mod_time()
+            if not result:
+                # EOF if repository shuts down
+                self.bg = False
+                break
+            lines = result.split('\n')
+            header = lines[0].split()
+            if len(header) > 2:  # 'reset':  we've missed changes, or just started
+                self._init_top_level()
+                refreshed = time.time()
+            else:
+                self._apply_changes([line.split() for line in lines[1:] if line.strip()])
+            epoch, seq = header[0], int(header[1])
+            if time.time() > refreshed + 3600:
+                refreshed = time.time()
+                self._init_top_level()  # Don't cache for more than an hour.
+
+    def _poll_mod_time(self):
+        """Polls a repo without a change feed, starting over on any change."""
         prev = 0.0
         while self.bg:
             time.sleep(0.2)  # Limit our attempted poll rate during net fail.
@@ -1326,6 +1629,105 @@ class UbidocsBackingStore():
                 prev = time.time()
                 self._init_top_level()  # Don't cache for more than an hour. 
 
+    def _apply_changes(self, changes):
+        """Bring our tree up to date with a batch of [seqno, kind, doc_id] changes.
+
+        Rather than throwing the whole tree away, we redo just the pieces
+        showing the changed documents:  their docs/ folders are dropped (to be
+        re-created when next looked at), their category links are replaced,
+        and any expanded searches are re-queried when next looked at."""
+        kinds = {}  # maps doc_id to the set of kinds of change to it
+        for change in changes:
+            if len(change) == 3:
+                kinds.setdefault(change[2], set()).add(change[1])
+        deleted = [id for id in kinds if 'delete' in kinds[id]]
+        # Touching a document (viewing it, say) seldom changes it, but a re-rip
+        # might; we check the ones we know about.
+        refresh = [id for id in kinds if id not in deleted and
+                   ((kinds[id] - set(['touch'])) or (id in self.docs))]
+        changed = []
+        for id in deleted:
+            self.docs.pop(id, None)
+            self._forget_doc(id)
+            changed.append(id)
+        if refresh:
+            fields = [('id', id) for id in refresh]
+            for line in self._extension_post('/UVFS/metadata_for_docs', fields).split('\n'):
+                if not line:
+                    continue
+                md = self._parse_metadata(line)
+                id = md.get('id')
+                if (not id) or ((kinds[id] == set(['touch'])) and (self.docs.get(id) == md)):
+                    continue
+                self.docs[id] = md
+                self._forget_doc(id)
+                categories = self._extension_result('/UVFS/categories_for_doc?doc_id=' + id)
+                self._link_doc_in_categories(md, [c for c in categories.split(', ') if c])
+                changed.append(id)
+        if changed:
+            logging.debug('applied changes to %s', changed)
+            self.listings = {}  # Prefetched listings may be out of date now.
+            self._reset_searches()
+            self.display_tree_to_file()
+
+    def _expanded_category_dirs(self):
+        """Return (category, UvfsDirectory) for each category directory we've filled in."""
+        categories = self.root.dir.get(Filename('categories'))
+        if type(categories) != UvfsDirectory:
+            return []
+        result = []
+        pending = [('', categories)]
+        while pending:
+            prefix, directory = pending.pop()
+            for name, f in directory.dir.items():
+                if type(f) == UvfsDirectory:
+                    category = (prefix and (prefix + '/' + name)) or name
+                    result.append((category, f))
+                    pending.append((category, f))
+        return result
+
+    def _forget_doc(self, doc_id):
+        """Drop a document's docs/ folder, and its links in categories/."""
+        docs = self.root.dir.get(Filename('docs'))
+        if docs and (Filename(doc_id) in docs.dir):
+            del(docs.dir[Filename(doc_id)])
+            docs.stat['st_mtime'] = time.time()
+        for category, directory in self._expanded_category_dirs():
+            for name, f in directory.dir.items():
+                if isinstance(f, UvfsSymlink) and (getattr(f, 'doc_id', None) == doc_id):
+                    del(directory.dir[name])
+                    directory.stat['st_mtime'] = time.time()
+
+    def _link_doc_in_categories(self, md, categories):
+        """Add links to a document to the directories of its categories."""
+        if type(self.root.dir.get(Filename('categories'))) != UvfsDirectory:
+            return  # Not filled in yet; it will be, with fresh data.
+        expanded = dict([(c.lower(), d) for c, d in self._expanded_category_dirs()])
+        known = set([c.lower() for c in self.category_names])
+        for category in categories:
+            directory = expanded.get(category.lower())
+            if (directory is None) and (category.lower() in known):
+                continue  # Not filled in yet; it will be, with fresh data.
+            if directory is None:
+                # a new category; simplest to start categories/ over
+                self._defer_top_level('categories')
+                return
+            f = self._new_symlink_for_category_doc(category, md)
+            if f.filename not in directory.dir:
+                self.add(directory, f)
+
+    def _reset_searches(self):
+        """Make any searches we've done be re-done when next looked at."""
+        search_dir = self.root.dir.get(Filename('search'))
+        if type(search_dir) != UvfsDirectory:
+            return
+        for query, f in search_dir.dir.items():
+            if type(f) == UvfsDirectory:
+                del(search_dir.dir[query])
+                query_dir = DeferredDirectory(query, self.content_for_a_specific_search)
+                query_dir.stat['st_mode'] |= S_IWUSR
+                self.add(search_dir, query_dir)
+
     def file_writer(self, path, contents, old_docid, new_category):
         """Thread adds document to repo, then exits.
 
@@ -1551,8 +1953,12 @@ class UVFS(FuseOperations):
         assert isinstance(f, UvfsFile)
         if f:
             content = f.content
-            content.seek(offset)
-            return content.read(size)
+            try:
+                content.seek(offset)
+                return content.read(size)
+            except (urllib2.URLError, httplib.HTTPException, IOError), e:
+                logging.error("reading %s:  %s", path, e)
+                raise FuseError(EIO)
         raise FuseError(EACCES)
 
     def readdir(self, path, fh):
@@ -49,6 +49,7 @@ import java.io.File;
 import java.io.IOException;
 import java.io.FileReader;
 import java.io.BufferedReader;
+import java.io.InputStreamReader;
 import java.io.StringReader;
 import java.util.Date;
 import java.util.Map;
@@ -445,11 +446,10 @@ class LuceneIndexing {
     }
 
 
-    private static Searcher search (File index_file, String querystring) {
+    private static void run_search (Searcher s, String querystring)
+        throws ParseException, IOException {
 
-        StringBuffer query_buffer = new StringBuffer();
         HeaderField[] query_terms;
-        String[] header_names =  null;
         QueryParser.Operator search_operator = QueryParser.AND_OPERATOR;
 
         String z = System.getProperties().getProperty("com.parc.uplib.indexing.defaultSearchProperties");
@@ -466,49 +466,51 @@ class LuceneIndexing {
                 search_operator = QueryParser.AND_OPERATOR;
         }
 
-        try {
-            Searcher s = new IndexSearcher(index_file.getCanonicalPath());
-            StandardAnalyzer analyzer = new StandardAnalyzer();
+        StandardAnalyzer analyzer = new StandardAnalyzer();
 
-            // form the query
-            query_buffer.append(querystring);
-            
-            // run the query
-            UpLibQueryParser p = new UpLibQueryParser(query_terms, analyzer, userAbbrevs);
-            if (debug_mode)
-                p.debug_mode = true;
-            p.setDefaultOperator(search_operator);
-            Query query = p.parse(query_buffer.toString());
-            if (debug_mode)
-                System.err.println("query is " + query);
-            Hits hits = s.search(query);
-            if (debug_mode)
-                System.err.println("" + hits.length() + " hits");
+        // run the query
+        UpLibQueryParser p = new UpLibQueryParser(query_terms, analyzer, userAbbrevs);
+        if (debug_mode)
+            p.debug_mode = true;
+        p.setDefaultOperator(search_operator);
+        Query query = p.parse(querystring);
+        if (debug_mode)
+            System.err.println("query is " + query);
+        Hits hits = s.search(query);
+        if (debug_mode)
+            System.err.println("" + hits.length() + " hits");
             
-            // output the results
-            for (int i = 0;  i < hits.length();  i++) {
-                Document doc = hits.doc(i);
-                float score = hits.score(i);
-                String number = doc.get("id");
-                if (number != null) {
-                    String type = doc.get("uplibtype");
-                    if ((type == null) || type.equals("whole"))
-                        if (debug_mode) {
-                            // explanations still fairly useless
-                            // org.apache.lucene.search.Explanation explanation = s.explain(query, i);
-                            // System.out.println(number + " " + score + " <" + explanation.toString() + ">");
-                            System.out.println(number + " " + score);
-                        } else {
-                            System.out.println(number + " " + score);
-                        }
-                } else {
-                    System.out.println("* No document ID in result returned from Lucene");
-                }
+        // output the results
+        for (int i = 0;  i < hits.length();  i++) {
+            Document doc = hits.doc(i);
+            float score = hits.score(i);
+            String number = doc.get("id");
+            if (number != null) {
+                String type = doc.get("uplibtype");
+                if ((type == null) || type.equals("whole"))
+                    if (debug_mode) {
+                        // explanations still fairly useless
+                        // org.apache.lucene.search.Explanation explanation = s.explain(query, i);
+                        // System.out.println(number + " " + score + " <" + explanation.toString() + ">");
+                        System.out.println(number + " " + score);
+                    } else {
+                        System.out.println(number + " " + score);
+                    }
+            } else {
+                System.out.println("* No document ID in result returned from Lucene");
             }
+        }
+    }
+
+    private static Searcher search (File index_file, String querystring) {
+
+        try {
+            Searcher s = new IndexSearcher(index_file.getCanonicalPath());
+            run_search(s, querystring);
             return s;
                 
         } catch (ParseException e) {
-            System.out.println("* Invalid search expression '" + query_buffer.toString() + "' specified");
+            System.out.println("* Invalid search expression '" + querystring + "' specified");
             System.err.println(" caught a " + e.getClass() +
                                "\n with message: " + e.getMessage());
             System.out.flush();
@@ -527,11 +529,10 @@ class LuceneIndexing {
     }
 
 
-    private static void pagesearch (Object index_file, String querystring, boolean show_whole_docs) {
+    private static void run_pagesearch (IndexSearcher s, String querystring, boolean show_whole_docs)
+        throws ParseException, IOException {
 
-        StringBuffer query_buffer = new StringBuffer();
         HeaderField[] query_terms;
-        String[] header_names =  null;
         QueryParser.Operator search_operator = QueryParser.AND_OPERATOR;
 
         query_terms = HeaderField.parseUserHeaders("pagecontents");
@@ -544,6 +545,49 @@ class LuceneIndexing {
                 search_operator = QueryParser.AND_OPERATOR;
         }
 
+        StandardAnalyzer analyzer = new StandardAnalyzer();
+
+        // run the query
+        UpLibQueryParser p = new UpLibPageQueryParser(query_terms, analyzer, userAbbrevs);
+        if (debug_mode)
+            p.debug_mode = true;
+        p.setDefaultOperator(search_operator);
+        Query query = p.parse(querystring);
+        if (query != null) {
+            if (debug_mode)
+                System.err.println("query.class is " + query.getClass());
+            if (debug_mode)
+                System.err.println("query is " + query);
+            Hits hits = s.search(query);
+            if (debug_mode)
+                System.err.println("" + hits.length() + " hits");
+            
+            // output the results
+            for (int i = 0;  i < hits.length();  i++) {
+                Document doc = hits.doc(i);
+                float score = hits.score(i);
+                String number = doc.get("id");
+                String type = doc.get("uplibtype");
+                if (number != null) {
+                    if ((type == null) || type.equals("whole")) {
+                        if (show_whole_docs)
+                            System.out.println(number + "/* " + score);
+                    } else if (type.equals("page")) {
+                        String pageid = doc.get("pagenumber");
+                        System.out.println(number + "/" + pageid + " " + score);
+                    }
+                } else {
+                    System.out.println("* No document ID in result returned from Lucene");
+                }
+            }
+        } else {
+            if (debug_mode)
+                System.err.println("no valid page query");
+        }
+    }
+
+    private static void pagesearch (Object index_file, String querystring, boolean show_whole_docs) {
+
         try {
             IndexSearcher s;
 
@@ -554,52 +598,11 @@ class LuceneIndexing {
             else
                 throw new java.io.IOException("index_file " + index_file + " must be either File or IndexSearcher");
 
-            StandardAnalyzer analyzer = new StandardAnalyzer();
-
-            // form the query
-            query_buffer.append(querystring);
-            
-            // run the query
-            UpLibQueryParser p = new UpLibPageQueryParser(query_terms, analyzer, userAbbrevs);
-            if (debug_mode)
-                p.debug_mode = true;
-            p.setDefaultOperator(search_operator);
-            Query query = p.parse(query_buffer.toString());
-            if (query != null) {
-                if (debug_mode)
-                    System.err.println("query.class is " + query.getClass());
-                if (debug_mode)
-                    System.err.println("query is " + query);
-                Hits hits = s.search(query);
-                if (debug_mode)
-                    System.err.println("" + hits.length() + " hits");
-            
-                // output the results
-                for (int i = 0;  i < hits.length();  i++) {
-                    Document doc = hits.doc(i);
-                    float score = hits.score(i);
-                    String number = doc.get("id");
-                    String type = doc.get("uplibtype");
-                    if (number != null) {
-                        if ((type == null) || type.equals("whole")) {
-                            if (show_whole_docs)
-                                System.out.println(number + "/* " + score);
-                        } else if (type.equals("page")) {
-                            String pageid = doc.get("pagenumber");
-                            System.out.println(number + "/" + pageid + " " + score);
-                        }
-                    } else {
-                        System.out.println("* No document ID in result returned from Lucene");
-                    }
-                }
-            } else {
-                if (debug_mode)
-                    System.err.println("no valid page query");
-            }
+            run_pagesearch(s, querystring, show_whole_docs);
             s.close();
                 
         } catch (ParseException e) {
-            System.out.println("* Invalid search expression '" + query_buffer.toString() + "' specified");
+            System.out.println("* Invalid search expression '" + querystring + "' specified");
             System.err.println(" caught a " + e.getClass() +
                                "\n with message: " + e.getMessage());
             System.out.flush();
@@ -615,11 +618,85 @@ class LuceneIndexing {
     }
 
 
+    /*
+      Long-running search service.  Reads requests from stdin, one per line, of the form
+
+          OPERATION QUERY
+
+      where OPERATION is one of "search", "pagesearch", or "bothsearch", and writes the
+      same result lines the one-shot commands would write to stdout, followed by a line
+      containing just a single period.  The IndexSearcher is kept open between requests,
+      and is only re-opened when the index has been changed by some writer.  Errors are
+      reported with a leading "*", as usual, but don't terminate the service.  The
+      service exits when stdin is closed.
+    */
+
+    private static void serve (File index_file) throws IOException {
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        IndexSearcher s = null;
+        String line;
+
+        while ((line = in.readLine()) != null) {
+
+            int space = line.indexOf(' ');
+            String operation = (space < 0) ? line.trim() : line.substring(0, space);
+            String querystring = (space < 0) ? "" : line.substring(space + 1);
+
+            try {
+                if ((s == null) || (!s.getIndexReader().isCurrent())) {
+                    if (s != null) {
+                        if (debug_mode)
+                            System.err.println("index has changed; re-opening searcher");
+                        s.close();
+                        s = null;
+                    }
+                    s = new IndexSearcher(index_file.getCanonicalPath());
+                }
+                if (operation.equals("search")) {
+                    run_search(s, querystring);
+                } else if (operation.equals("pagesearch")) {
+                    run_pagesearch(s, querystring, true);
+                } else if (operation.equals("bothsearch")) {
+                    run_search(s, querystring);
+                    run_pagesearch(s, querystring, false);
+                } else {
+                    System.out.println("* Invalid search operation '" + operation + "' specified");
+                }
+
+            } catch (ParseException e) {
+                System.out.println("* Invalid search expression '" + querystring + "' specified");
+                System.err.println(" caught a " + e.getClass() +
+                                   "\n with message: " + e.getMessage());
+            } catch (Exception e) {
+                System.out.println("* Lucene search engine raised " + e.getClass() + " with message " + e.getMessage());
+                System.err.println(" 'serve' caught a " + e.getClass() +
+                                   "\n with message: " + e.getMessage());
+                e.printStackTrace(System.err);
+                // force a re-open on the next request
+                if (s != null) {
+                    try {
+                        s.close();
+                    } catch (IOException x) {
+                        // ignore
+                    }
+                    s = null;
+                }
+            }
+            System.out.println(".");
+            System.out.flush();
+        }
+        if (s != null)
+            s.close();
+    }
+
+
     private static void usage () {
         // print usage message to stderr
         System.err.println("Usage:  LuceneIndexing INDEXDIR search 'QUERY'");
         System.err.println("   or:  LuceneIndexing INDEXDIR pagesearch 'QUERY'");
         System.err.println("   or:  LuceneIndexing INDEXDIR bothsearch 'QUERY'");
+        System.err.println("   or:  LuceneIndexing INDEXDIR serve");
         System.err.println("   or:  LuceneIndexing INDEXDIR update DOCROOTDIR DOCID [DOCID...]");
         System.err.println("   or:  LuceneIndexing INDEXDIR batchupdate DOCROOTDIR TEMPFILENAME");
         System.err.println("   or:  LuceneIndexing INDEXDIR remove DOCID [DOCID...]");
@@ -627,7 +704,7 @@ class LuceneIndexing {
 
     public static void main(String[] args) {
 
-        if (args.length < 3) {
+        if ((args.length < 3) && !((args.length == 2) && args[1].equals("serve"))) {
             usage();
             System.exit(INVALID_ARGS);
         }
@@ -741,6 +818,17 @@ class LuceneIndexing {
                 // ignore
             }
 
+        } else if (args[1].equals("serve")) {
+
+            try {
+                serve(index_file);
+            } catch (IOException x) {
+                System.err.println(" 'serve' caught a " + x.getClass() +
+                                   "\n with message: " + x.getMessage());
+                x.printStackTrace(System.err);
+                System.exit(JAVA_EXCEPTION);
+            }
+
         } else {
             usage();
             System.exit(INVALID_ARGS);
@@ -27,6 +27,7 @@ from uplib.plibUtil import false, true, PATH_SEPARATOR, Error, note, configurato
 from uplib.webutils import Fetcher, Cache, get_cookies, get_htmldoc_cookies, htmlescape, parse_URL_with_scheme, parse_URL, https_post_multipart, http_post_multipart, TitleFinder, set_cookies_source, ParsingDone
 
 from uplib.links import pdflinksParser
+from uplib.tiffpages import tiff_pages, tiff_save_options
 
 from HTMLParser import HTMLParser, HTMLParseError
 import htmlentitydefs
@@ -81,6 +82,8 @@ TAR_CMD = None
 
 ASSUME_NO_PASSWORD = None
 
+UPLOAD_PRIORITY = None          # incorporation priority to ask the repository for, if any
+
 SCORETEXT = None
 SCORETEXT_MODEL = None
 SCORETEXT_CMD = None
@@ -368,6 +371,32 @@ def black_and_white (color1, color2):
     return false
 
 
+# big enough to keep the per-call overhead down, small enough that hashing a
+# multi-hundred-megabyte scan doesn't pull it all into memory
+FINGERPRINT_CHUNK_SIZE = 1 << 20
+
+def hash_file_contents (hasher, path, chunk_size=FINGERPRINT_CHUNK_SIZE):
+    """Feed the contents of a file to a hash object, a chunk at a time.
+
+    :param hasher: the hash object, e.g. from ``hashlib.sha1()``
+    :type hasher: hashlib hash object
+    :param path: the file to read
+    :type path: string
+    :param chunk_size: number of bytes to read at a time
+    :type chunk_size: int
+    :return: ``hasher``
+    :rtype: hashlib hash object
+    """
+    fp = open(path, 'rb')
+    try:
+        data = fp.read(chunk_size)
+        while data:
+            hasher.update(data)
+            data = fp.read(chunk_size)
+    finally:
+        fp.close()
+    return hasher
+
 def calculate_originals_fingerprint (originals_path):
 
     # called to create a quick hash of the document's content
@@ -384,14 +413,7 @@ def calculate_originals_fingerprint (originals_path):
     for dirpath, junk, files in dirs:
         files.sort()
         for filename in files:
-            fp = open(os.path.join(dirpath, filename), 'rb')
-            try:
-                data = fp.read(1 << 16)
-                while data:
-                    s.update(data)
-                    data = fp.read(1 << 16)
-            finally:
-                fp.close()
+            hash_file_contents(s, os.path.join(dirpath, filename))
     return s.hexdigest()
 
 
@@ -489,30 +511,20 @@ def clean_wordboxes_overlays (folder, debug=False):
 
 def optimize_tiff_compression (tiff_file_path, save_blank_pages):
 
-    global TIFFSPLIT, TIFFCP, TIFF_SPLIT_CMD, TIFF_COMPRESS_CMD
+    global TIFFCP, TIFF_COMPRESS_CMD
 
     tmpdir = mktempdir()
     os.chmod(tmpdir, 0700)
     try:
-        tiffmaster = os.path.join(tmpdir, "master.tiff")
-        split_command = (TIFF_SPLIT_CMD
-                         % (TIFFCP, tiff_file_path, tiffmaster,
-                            TIFFSPLIT, tiffmaster, os.path.join(tmpdir, "x")))
-        status, output, tsignal = subproc(split_command)
-        if status != 0:
-            raise Error("Command '%s' failed with output <%s>" % (split_command, output))
-        files = os.listdir(tmpdir)
-        files.sort()
         newfiles = []
         pageno = 1
         monochrome_pagecount = 0
         paletted_pagecount = 0
         fullcolor_pagecount = 0
-        for file in files:
-            if file[0] != 'x':
-                continue
-            path = os.path.join(tmpdir, file)
-            im = Image.open(path)
+        for im in tiff_pages(tiff_file_path):
+            path = os.path.join(tmpdir, "x%05d.tiff" % pageno)
+            # keep the page's resolution, whatever form it's re-saved in
+            options = tiff_save_options(im)
             if im.mode in ('L', 'P'):
                 im2 = im
             elif im.mode == '1':
@@ -533,10 +545,9 @@ def optimize_tiff_compression (tiff_file_path, save_blank_pages):
             if len(b) == 1:
                 if save_blank_pages:
                     compression = 'g4'
-                    args['compression'] = 'g4'
                     # store out the file as a monochrome image
                     im = im.convert('1', dither=Image.NONE)
-                    im.save(path, 'TIFF')
+                    im.save(path, 'TIFF', **options)
                     note(3, "   page %d is blank", pageno)
                     monochrome_pagecount = monochrome_pagecount + 1
                 else:
@@ -549,15 +560,16 @@ def optimize_tiff_compression (tiff_file_path, save_blank_pages):
                 # store out the file as a monochrome image
                 if im.mode != '1':
                     im = im.convert('1', dither=Image.NONE)
-                im.save(path, 'TIFF')
+                im.save(path, 'TIFF', **options)
                 note(3, "   page %d is monochrome", pageno)
                 monochrome_pagecount = monochrome_pagecount + 1
             elif (len(b) < 256):
                 im = im2.convert('P', dither=Image.NONE)
-                im.save(path, 'TIFF')
+                im.save(path, 'TIFF', **options)
                 note(3, "   page %d is paletted color (buckets = %d)", pageno, len(b))
                 paletted_pagecount = paletted_pagecount + 1
             else:
+                im.save(path, 'TIFF', **options)
                 note(3, "   page %d is full color (buckets = %d)", pageno, len(b))
                 fullcolor_pagecount = fullcolor_pagecount + 1
             compress_command = TIFF_COMPRESS_CMD % (TIFFCP, compression, path, new_filename)
@@ -944,6 +956,9 @@ def submit_to_repository (repository, password, directory, metadata=(), cookie=N
         else:
             cookies = None
 
+        if UPLOAD_PRIORITY:
+            metadata = tuple(metadata) + (("priority", UPLOAD_PRIORITY),)
+
         # send it to the repository
         note(2, "About to submit the fully processed document to repository %s %s %s" % (repository[2], repository[0], repository[1]))
         try:
@@ -1117,26 +1132,10 @@ def do_ocr_tiff (tiff_file, contents_path, xdoc=false):
 def convert_tiff_to_png (tiff_file, png_directory):
 
     note(3, "converting TIFF file '%s' to PNG...", tiff_file)
-    tmpdir = tempfile.mktemp()
-    try:
-        from PIL import Image
-        os.mkdir(tmpdir)
-        tiffmaster = os.path.join(tmpdir, "master.tiff")
-        split_command = (TIFF_SPLIT_CMD
-                         % (TIFFCP, tiff_file, tiffmaster,
-                            TIFFSPLIT, tiffmaster, os.path.join(tmpdir, "x")))
-        status, output, tsignal = subproc(split_command)
-        if status != 0: raise Error ("'%s' signals non-zero exit status %d in %s => %s" %
-                                     (split_command, tiff_file, tmpdir))
-        counter = 1
-        tiff_files = os.listdir(tmpdir)
-        tiff_files.sort()
-        for file in tiff_files:
-            if file[0] == 'x':
-                Image.open(os.path.join(tmpdir, file)).save(os.path.join(png_directory, "page%05d.png" % counter), 'PNG')
-                counter = counter + 1
-    finally:
-        if os.path.isdir(tmpdir): shutil.rmtree(tmpdir)
+    counter = 1
+    for im in tiff_pages(tiff_file):
+        im.save(os.path.join(png_directory, "page%05d.png" % counter), 'PNG')
+        counter = counter + 1
 
 
 ############################################################
@@ -4057,7 +4056,7 @@ def update_configuration(conf=None):
 
 def main (argv):
 
-    global AssemblyLine, SCORETEXT_THRESHOLD, IMAGE_SIZE_LIMIT
+    global AssemblyLine, SCORETEXT_THRESHOLD, IMAGE_SIZE_LIMIT, UPLOAD_PRIORITY
 
     repository = None
     preserve_color = true
@@ -4094,7 +4093,7 @@ def main (argv):
                      "nopassword", "nooptimize", "keepblankpages", "ocr",
                      "verbosity=", "first-page=", "tiff-dpi=", "extra-parsers=", "metadata=",
                      "deskew", "cookies=", "dryclean", "source=", "format=", "icon-file=",
-                     "image-size-limit=", ]
+                     "image-size-limit=", "priority=", ]
 
     note(4, "Starting parameter processing in addDocument.main")
     try:
@@ -4154,6 +4153,8 @@ def main (argv):
                 threshold = int(a)
             elif o == "--image-size-limit":
                 image_size_limit = int(a)
+            elif o == "--priority":
+                UPLOAD_PRIORITY = a
             elif o == "--ocr":
                 ocr = true
             elif o == "--icon-file":
@@ -4202,6 +4203,7 @@ def main (argv):
                          "  --early-upload -- upload originals before processing page images\n"
                          "  --icon-file=FILENAME -- put icon in FILENAME as soon as possible\n"
                          "  --format=PARSER -- use parser named PARSER for this document\n"
+                         "  --priority=PRIORITY -- 'interactive', 'normal', or 'bulk' incorporation priority\n"
                          "  --verbosity=LEVEL -- use LEVEL as the verbosity for debugging statements\n")
         sys.exit(1)
 
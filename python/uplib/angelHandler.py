@@ -43,7 +43,7 @@ from medusa.counter import counter
 
 from uplib.plibUtil import note, configurator, true, false, PATH_SEPARATOR, uthread
 from uplib.extensions import find_and_load_extension, is_hierarchical_extension
-from uplib.webutils import htmlescape, HTTPCodes, get_content_type
+from uplib.webutils import htmlescape, HTTPCodes, get_content_type, make_etag, etag_matches
 
 CONTENT_LENGTH = re.compile ('Content-Length: ([0-9]+)', re.IGNORECASE)
 CONTENT_TYPE = re.compile ('Content-Type: (.+)', re.IGNORECASE)
@@ -51,6 +51,7 @@ USER_AGENT = re.compile ('User-Agent: (.+)', re.IGNORECASE)
 HOST_HEADER = re.compile ('Host: (.+)', re.IGNORECASE)
 ACCEPTS_HEADER = re.compile ('Accept: (.+)', re.IGNORECASE)
 DOC_CHANGES_SINCE_HEADER = re.compile ('X-UpLib-Docs-Modified-Since: (.+)', re.IGNORECASE)
+IF_NONE_MATCH = re.compile ('If-None-Match: (.+)', re.IGNORECASE)
 TOUCHPATH = re.compile('/docs/(?P<docid>[^/]+)/(.*\.(html|pdf|tiff)|contents.txt)')
 DOCPATH = re.compile('/docs/(?P<docid>[^/]+)/.*\.(html|pdf|tiff|txt|png|bboxes)')
 COOKIE = re.compile('Cookie: (.+)', re.IGNORECASE)
@@ -315,6 +316,30 @@ class SelfDeletingFileObject (object):
         os.unlink(self.__filename)
 
 
+class iterator_producer (object):
+
+    """A Medusa producer which sends the strings generated by an iterator."""
+
+    def __init__(self, iterable):
+        self.__iterator = iter(iterable)
+
+    def more(self):
+        # an empty string signals the end, so skip over any empty chunks
+        while self.__iterator is not None:
+            try:
+                data = self.__iterator.next()
+            except StopIteration:
+                self.__iterator = None
+            except:
+                note(0, "Exception producing response data:\n%s",
+                     ''.join(traceback.format_exception(*sys.exc_info())))
+                self.__iterator = None
+            else:
+                if data:
+                    return data
+        return ''
+
+
 ############################################################
 ###
 ###  Exception ForkRequestInNewThread
@@ -423,6 +448,27 @@ class response (object):
         if (self.request.command != "HEAD"):
             self.request.push(producers.file_producer(fp))
 
+    def return_stream (self, typ, chunks, filename=None):
+        # the length isn't known ahead of time, so there's no Content-Length;
+        # Medusa closes the connection (or for HTTP/1.1, uses chunked encoding) to mark the end
+        self.request['Content-Type'] = (isinstance(typ, unicode) and typ.encode("ASCII", "replace")) or typ
+        add_last_modified_headers(self.request, self.repo)
+        if filename:
+            filename = (isinstance(filename, unicode) and filename.encode("ASCII", "replace")) or filename
+            self.request["Content-Disposition"] = "inline; filename=%s" % filename
+        if (self.request.command != "HEAD"):
+            self.request.push(iterator_producer(chunks))
+
+    def not_modified (self, etag):
+        # Give the response the entity tag ETAG.  If the client's copy has that tag,
+        # reply "not modified" and return True, in which case the caller is done.
+        self.request['ETag'] = etag
+        self.request['Cache-Control'] = 'no-cache'
+        if etag_matches(get_header(IF_NONE_MATCH, self.request.header), etag):
+            self.request.reply_code = HTTPCodes.NOT_MODIFIED
+            return True
+        return False
+
     def fork_request(self, fn, *args):
         note(3, "forking %s in new thread...", fn)
         id = uthread.start_new_thread(run_fn_in_new_thread, (self, fn, args),
@@ -556,7 +602,14 @@ class folder_handler (default_handler.default_handler):
                         doc = self.__repo__.get_document(docid)
                         bits, mime_type = doc.get_requested_part(path, params, query, fragment)
                         if bits:
-                            return_bits(request, bits, mime_type, 200)
+                            # generated each time, but often the same, so let the client check
+                            etag = make_etag(bits)
+                            request['ETag'] = etag
+                            request['Cache-Control'] = 'no-cache'
+                            if etag_matches(get_header(IF_NONE_MATCH, request.header), etag):
+                                request.reply_code = HTTPCodes.NOT_MODIFIED
+                            else:
+                                return_bits(request, bits, mime_type, 200)
                             request.done()
                             return
             p = os.path.join(self.__repo__.root(), path[1:])
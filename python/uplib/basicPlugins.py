@@ -31,13 +31,15 @@ __version__ = "$Revision: 1.322 $"
 
 import sys, os, re, string, cgi, time, traceback, urllib, types, zipfile, tempfile, shutil, codecs, struct, urlparse, hashlib
 
-from uplib.plibUtil import subproc, configurator, Error, read_metadata, true, false, note, update_metadata, split_categories_string, id_to_time, read_metadata, MutexLock, wordboxes_page_iterator, uthread, get_fqdn, find_JAVAHOME
+from uplib.plibUtil import subproc, configurator, Error, read_metadata, true, false, note, update_metadata, split_categories_string, id_to_time, read_metadata, MutexLock, wordboxes_page_iterator, get_fqdn, find_JAVAHOME
 from uplib.plibUtil import MONTHNAMES, format_date, parse_date, next_day, ensure_file, LimitedOrderedDict
 
-from uplib.webutils import HTTPCodes, parse_URL, http_post_multipart, htmlescape
+from uplib.webutils import HTTPCodes, parse_URL, http_post_multipart, htmlescape, make_etag
 
 from uplib.collection import Collection, QueryCollection, PrestoCollection
 
+from uplib.addDocument import hash_file_contents
+
 VERSION = "$Id: basicPlugins.py,v 1.322 2011/02/13 06:55:19 janssen Exp $"
 
 ############################################################
@@ -765,17 +767,23 @@ def _doc_show_URL (id, pageno=None, selection=None):
         else:
             return "/docs/" + id + "/index.html"
 
-def __output_document_icon(doc_id, title, fp, sensible_browser=false, width=None, height=None, menuid=None):
+def __output_document_icon(doc_id, title, fp, sensible_browser=false, width=None, height=None, menuid=None, sprite=None):
     if menuid is None: menuid = "DocumentIconClickMenu"
+    if sprite:
+        # a piece of the listing's sprite sheet, from _listing_icon_sprites()
+        imgsrc = ('src="/html/images/transparent.png" '
+                  'style="background: url(/action/basic/icon_sprite?sheet=%s) -%dpx -%dpx no-repeat" ' % sprite)
+    else:
+        imgsrc = 'src="/docs/%s/thumbnails/first.png" ' % doc_id
     if (sensible_browser and WANTS_DOC_ICON_MENUS):
-        fp.write('<img class="documentIcon" src="/docs/%s/thumbnails/first.png" ' % doc_id +
+        fp.write('<img class="documentIcon" ' + imgsrc +
                  'alt="%s" title="%s" %s%s' % (title, title, (width and 'width="%s" ' % width) or "", (height and 'height="%s" ' % height) or "") +
                  'onMouseOver="highlightIcon(this)" '
                  'onMouseOut="highlightIcon(null)" '
                  'onMouseDown="menushow(\'%s\', \'%s\', this, event)">\n' % (doc_id, menuid))
     else:
         fp.write('<a href="%s" border=0 title="%s">' % (_doc_show_URL(doc_id), title) +
-                 '<img class="documentIcon" src="/docs/%s/thumbnails/first.png" ' % doc_id +
+                 '<img class="documentIcon" ' + imgsrc +
                  '%s%s' % ((width and 'width="%s" ' % width) or "", (height and 'height="%s" ' % height) or "") +
                  'onMouseOver="highlightIcon(this)" ' +
                  'onMouseOut="highlightIcon(null)" ' +
@@ -796,6 +804,49 @@ def __output_document_title(doc_id, title, fp, sensible_browser=false, menuid=No
 def _is_sensible_browser (user_agent):
     return (SENSIBLE_BROWSERS.search(user_agent) != None)
 
+def _listing_icon_sprites (repo, docs):
+    # maps doc ID to (sprite sheet, x, y) for the icons of a listing page;
+    # empty if the repository doesn't use sprite sheets
+    sprites = repo.icon_sprites()
+    if (sprites is None) or (not docs):
+        return {}
+    try:
+        sheet, positions = sprites.layout(docs)
+    except:
+        note(0, "can't lay out icon sprite sheet:\n%s", ''.join(traceback.format_exception(*sys.exc_info())))
+        return {}
+    return dict([(doc_id, (sheet, x, y)) for doc_id, (x, y, w, h) in positions.items()])
+
+def _icon_sprite (repo, response, params):
+    """
+    Return a sprite sheet of document icons, as laid out for a listing page.
+
+    :param sheet: the name of the sheet
+    :type sheet: string
+    :return: the sheet image
+    :rtype: image/png
+    """
+    sheet = params.get("sheet")
+    sprites = repo.icon_sprites()
+    # a sheet is named by its contents, so one the browser has is still good
+    if sprites and sheet and response.not_modified(make_etag(sheet)):
+        return
+    path = sprites and sprites.sheet(sheet, build=False)
+    if path:
+        response.return_file("image/png", path)
+    elif sprites:
+        # building the sheet reads every icon on the page, so do it off the server's main thread
+        response.fork_request(_build_and_return_icon_sprite, sprites, response, sheet)
+    else:
+        response.error(HTTPCodes.NOT_FOUND, "No such sprite sheet %s.\n" % htmlescape(str(sheet)))
+
+def _build_and_return_icon_sprite (sprites, response, sheet):
+    path = sprites.sheet(sheet)
+    if not path:
+        response.error(HTTPCodes.NOT_FOUND, "No such sprite sheet %s.\n" % htmlescape(str(sheet)))
+        return
+    response.return_file("image/png", path)
+
 def __show_stats (repo, response, params):
 
     from math import log10, floor, pow
@@ -852,14 +903,10 @@ def __show_stats (repo, response, params):
     darkcolor = "#99acb9"
     black = "#000000"
 
-    size = 0
-    sizes = {}
-    dcount = 0
-    for doc in repo.generate_docs():
-        dsize = int(doc.get_metadata("pagecount") or doc.get_metadata("page-count") or 1)
-        sizes[dsize] = sizes.get(dsize, 0) + 1
-        size = size + dsize
-        dcount += 1
+    summary = repo.statistics().summary()
+    size = summary['pages']
+    sizes = summary['page_histogram']
+    dcount = summary['docs']
     avg_size = float(size)/max(1, dcount)
     if not sizes:
         max_pages = 0
@@ -875,6 +922,12 @@ def __show_stats (repo, response, params):
     format = repo.get_param("default-listing-format", "Icon MRU")
     output_tools_block (repo, fp, 'Stats for Repository "%s"' % name, format, None, None)
     fp.write('<p>%d documents, %d pages -- average page size %.1f, max page size %d, %d one-page documents\n' % (dcount, size, avg_size, max_pages, sizes.get(1, 0)))
+    if summary['bytes_by_type']:
+        fp.write('<p>Disk space by document type: %s\n' %
+                 string.join(['%s %.1f MB' % (htmlescape(ctype), nbytes / (1024.0 * 1024.0))
+                              for ctype, nbytes in sorted(summary['bytes_by_type'].items())], ', '))
+    if not summary['ready']:
+        fp.write('<p><i>(still counting)</i>\n')
 
     if 0:
         fp.write('<p><pre><font color="red">\n')
@@ -1009,35 +1062,21 @@ def __show_stats (repo, response, params):
 
 def figure_stats (repo):
 
-    # in the background, figure out how many docs we have, and how many pages
+    # pick up the counts the repository keeps as documents come and go
     global STATS_PAGES, STATS_TIME, STATS_LOCK, STATS_DOCS, NEED_STATS_PAGES, NEED_STATS
 
     if NEED_STATS:
         STATS_LOCK.acquire()
         # we are holding STATS_LOCK, so be sure to release it upon finishing
         try:
+            summary = repo.statistics().summary()
             STATS_TIME = repo.mod_time()
-            if NEED_STATS_PAGES:
-                size = 0
-                sizes = {}
-                dcount = 0
-                for doc in repo.generate_docs():
-                    dsize = int(doc.get_metadata("pagecount") or doc.get_metadata("page-count") or 1)
-                    sizes[dsize] = sizes.get(dsize, 0) + 1
-                    size = size + dsize
-                    dcount += 1
-                STATS_DOCS = dcount
-                if dcount > 0:
-                    max_pages = max(sizes.keys())
-                    max_docs = max(sizes.values())
-                    avg_size = float(size)/dcount
-                else:
-                    max_pages = 0
-                    max_docs = 0
-                    avg_size = 0
-                STATS_PAGES = size
-                note("finished counting pages -- %d" % STATS_PAGES)
+            if summary['ready']:
+                STATS_DOCS = summary['docs']
+                if NEED_STATS_PAGES:
+                    STATS_PAGES = summary['pages']
             else:
+                # still being calculated
                 STATS_DOCS = repo.docs_count()
         finally:
             STATS_LOCK.release()
@@ -1049,11 +1088,7 @@ def output_tools_block(repo, fp, page_title, listing_format, coll, name, existin
     # if the repo is huge, figuring out the document count might be very time-consuming
     if NEED_STATS:
         if STATS_DOCS == None or repo.mod_time() > STATS_TIME:
-            STATS_DOCS = repo.docs_count()
-        if NEED_STATS_PAGES and (STATS_PAGES == None or repo.mod_time() > STATS_TIME):
-            if NEED_STATS_PAGES:
-                # new thread will acquire and release STATS_LOCK when done
-                uthread.start_new_thread(figure_stats, (repo,))
+            figure_stats(repo)
         if STATS_PAGES == None:
             stats = "%d" % STATS_DOCS
         else:
@@ -1514,17 +1549,19 @@ def repo_show_thumbnails (repo, format, response, form_values, coll, docs, name,
     fp.write('<p>')
     if docs:
         count = 0
+        sprites = _listing_icon_sprites(repo, docs)
         for doc in docs:
             tooltip = htmlescape(_get_thumbnail_tooltip(doc, scores), true)
             iwidth, iheight = doc.icon_size()
-            __output_document_icon(doc.id, tooltip, fp, _is_sensible_browser(response.user_agent), width=iwidth, height=iheight)
+            __output_document_icon(doc.id, tooltip, fp, _is_sensible_browser(response.user_agent), width=iwidth, height=iheight,
+                                   sprite=sprites.get(doc.id))
     else:
         fp.write("No documents in " + ((isinstance(coll, Collection) and "collection") or "repository") + ".\n")
     output_footer(repo, fp, coll, response.logged_in)
     fp.write("</body>\n")
     fp.close()
 
-def show_abstract (repo, doc, fp, sensible_browser, score=None, pages=None, query=None, maxpages=10, showpagesearch=true, showid=False):
+def show_abstract (repo, doc, fp, sensible_browser, score=None, pages=None, query=None, maxpages=10, showpagesearch=true, showid=False, sprite=None):
     dict = doc.get_metadata()
     pubdate = dict.get("date")
     date = re.sub(" 0|^0", " ",
@@ -1542,7 +1579,7 @@ def show_abstract (repo, doc, fp, sensible_browser, score=None, pages=None, quer
     fp.write('<center>')
     if score != None:
         fp.write('<small>score:</small> <font color="red">%5.2f</font><br>&nbsp;<br>' % (score * 100))
-    __output_document_icon(doc.id, name, fp, sensible_browser, width=iwidth, height=iheight)
+    __output_document_icon(doc.id, name, fp, sensible_browser, width=iwidth, height=iheight, sprite=sprite)
     fp.write('<br><small><font color="%s">(added %s)</font></small></center></td><td>&nbsp;</td>'
              % (STANDARD_DARK_COLOR, date))
     fp.write('<td valign=top><h3>%s</h3>' % name)
@@ -1703,13 +1740,15 @@ def repo_show_abstracts (repo, format, response, form_values, coll, docs, name,
 
     if docs:
         count = 0
+        sprites = _listing_icon_sprites(repo, docs)
         for doc in docs:
             score = scores and scores.get(doc.id)
             if count > 0:
                 fp.write('<hr>\n')
             pages = isinstance(coll, QueryCollection) and coll.pages(doc)
             query = isinstance(coll, QueryCollection) and coll.query
-            show_abstract(repo, doc, fp, _is_sensible_browser(response.user_agent), score, pages, query)
+            show_abstract(repo, doc, fp, _is_sensible_browser(response.user_agent), score, pages, query,
+                          sprite=sprites.get(doc.id))
             count = count + 1
     else:
         fp.write("No documents in " + ((isinstance(coll, Collection) and "collection") or "repository") + ".\n")
@@ -1904,7 +1943,11 @@ def _repo_show (repo, response, form):
         coll = None
         docsorder = (form and form.get("listorder")) or repo.get_param("default-listing-order")
         if docsorder == "lastadded":
-            docs = [x for x in repo.generate_docs(count=(isinstance(defcount, int) and defcount or 0))]
+            catalog = repo.catalog()
+            if catalog is not None:
+                docs = [repo.get_document(x) for x in catalog.recently_added(isinstance(defcount, int) and defcount or 0)]
+            else:
+                docs = [x for x in repo.generate_docs(count=(isinstance(defcount, int) and defcount or 0))]
         elif docsorder == "lastused":
             docs = repo.history()
         else:
@@ -1937,6 +1980,16 @@ def _repo_show (repo, response, form):
     note(3, "repo_show:  coll is %s, name is \"%s\", title is \"%s\"",
          (isinstance(coll, Collection) and coll.id) or "(none)", name, title)
 
+    # The page depends only on which documents are listed, and how; the repository's
+    # mod time changes whenever a document is added, deleted, or touched, or has its
+    # metadata changed.  So let a browser which already has this version of the page
+    # skip re-fetching it.
+    form_items = (form and form.items()) or []
+    form_items.sort()
+    if response.not_modified(make_etag(repr((repo.mod_time(), format, title, [doc.id for doc in docs], form_items,
+                                             response.logged_in, response.user_agent)))):
+        return
+
     if (format.endswith(" DP") or format.endswith(" DA")):
         repo_show_timescale(repo, format, response, form, coll, docs, name, title, scores)
     elif format.startswith('Abstract'):
@@ -2712,7 +2765,7 @@ def _calculate_folder_hash (folder):
                 doc_path = os.path.join(originals_dir, files[0])
 
     if not doc_path or not os.path.exists(doc_path):
-        doc_path = os.path.join(doc.folder(), "document.tiff")
+        doc_path = os.path.join(folder, "document.tiff")
         if not os.path.exists(doc_path):
             prefix = os.path.join(folder, "page-images")
             if os.path.isdir(prefix):
@@ -2729,10 +2782,7 @@ def _calculate_folder_hash (folder):
 
     s = hashlib.sha1()
     for filename in files:
-        fp = open(os.path.join(prefix, filename), 'rb')
-        data = fp.read()
-        fp.close()
-        s.update(data)
+        hash_file_contents(s, os.path.join(prefix, filename))
     key = s.hexdigest()
     return key
 
@@ -3082,9 +3132,8 @@ def _repo_categorize (repo, response, form):
                 doc.update_metadata(new_metadata, false)
                 fp.write('<p>Updated categories of "%s" to <b>%s</b>.\n' % (doc.get_metadata('title') or id, string.join(doc_categories, ', ')))
         # re-index all the documents in one fell swoop
-        from uplib.createIndexEntry import index_folders
-        newthread = uthread.start_new_thread(index_folders, (repo.docs_folder(), ids, repo.index_path()))
-        note(3, "reindexing %s in %s", ids, str(newthread))
+        repo.queue_for_indexing(ids)
+        note(3, "queued %s for reindexing", ids)
         fp.write('<center><form method=GET action="/action/basic/repo_show">\n')
         if coll_id:
             fp.write('<input type=hidden name="coll" value="%s">\n' % coll_id)
@@ -3316,7 +3365,29 @@ def _repo_status_json (repo, response, params):
         pagescount = 0
         if STATS_PAGES is not None:
             pagescount = STATS_PAGES
-        fp.write('{ history : "%s",\n  docs : %s, pages : %s,\n  rippers: [' % (j, docscount, pagescount))
+        summary = repo.statistics().summary()
+        if summary['ready']:
+            docscount = summary['docs']
+            pagescount = summary['pages']
+        fp.write('{ history : "%s",\n  docs : %s, pages : %s,\n' % (j, docscount, pagescount))
+        if summary['ready']:
+            fp.write('  bytes : { %s },\n' % string.join(['"%s" : %d' % (ctype, nbytes)
+                                                         for ctype, nbytes in summary['bytes_by_type'].items()], ', '))
+        qstats = repo.query_cache_stats()
+        fp.write('  querycache : { hits : %d, misses : %d, size : %d },\n'
+                 % (qstats['hits'], qstats['misses'], qstats['size']))
+        bstats = repo.page_bboxes_cache().stats()
+        fp.write('  bboxescache : { hits : %d, misses : %d, pages : %d, bytes : %d },\n'
+                 % (bstats['hits'], bstats['misses'], bstats['pages'], bstats['bytes']))
+        scheduler = repo.incorporation_scheduler()
+        if scheduler:
+            fp.write('  waiting : %d,\n' % scheduler.qsize())
+        iq = repo.indexing_queue()
+        if iq:
+            istats = iq.stats()
+            fp.write('  indexing : { depth : %d, commits : %d, latency : %.3f, averagelatency : %.3f },\n'
+                     % (istats['depth'], istats['commits'], istats['last-commit-latency'], istats['average-commit-latency']))
+        fp.write('  rippers: [')
         for rippername in ripper_names:
             fp.write('"' + rippername + '", ')
         fp.write('],\n  pending : [')
@@ -3799,39 +3870,27 @@ def _doc_pageimages (repo, response, form):
         filepath = os.path.join(repo.doc_location(doc_id), "document.tiff")
         if os.path.exists(filepath):
             # do tiff part
-            # first, copy the tiff file and remove compression
-            tmpdir = tempfile.mktemp()
+            # write each page out as a PNG, straight into the zip file
+            import StringIO
+            from uplib.tiffpages import tiff_pages
+            zf = zipfile.ZipFile(pageimagespath, 'w', zipfile.ZIP_STORED)
+            finished = false
             try:
-                from PIL import Image
-
-                os.mkdir(tmpdir)
-                tiffmaster = os.path.join(tmpdir, "master.tiff")
-
-                conf = configurator.default_configurator()
-
-                TIFFSPLIT = conf.get("tiffsplit")
-                TIFFCP = conf.get("tiffcp")
-                TIFF_SPLIT_CMD = conf.get("tiff-split-command")
-
-                split_command = (TIFF_SPLIT_CMD
-                                 % (TIFFCP, filepath, tiffmaster,
-                                    TIFFSPLIT, tiffmaster, os.path.join(tmpdir, "x")))
-                status, output, tsignal = subproc(split_command)
-                if status != 0: raise Error ("'%s' signals non-zero exit status %d in %s => %s" %
-                                             (split_command, dirpath, tmpdir))
-                note(3, "pages are %s", str(os.listdir(tmpdir)))
-                zf = zipfile.ZipFile(pageimagespath, 'w', zipfile.ZIP_STORED)
                 counter = 1
-                for file in os.listdir(tmpdir):
-                    if file[0] == 'x':
-                        note(3, "converting TIFF file %s to PNG and adding it", file)
-                        Image.open(os.path.join(tmpdir, file)).save(os.path.join(tmpdir, file + ".png"), 'PNG')
-                        zf.write(os.path.join(tmpdir, file + '.png'),  ('%06d' % counter) + ".png")
-                        counter = counter + 1
-                response.return_file("application/x-uplib-page-images;filename=%s-page-images.zip" % doc_id, pageimagespath)
-                repo.touch_doc(doc_id)
+                for im in tiff_pages(filepath):
+                    note(3, "converting TIFF page %d to PNG and adding it", counter)
+                    fp = StringIO.StringIO()
+                    im.save(fp, 'PNG')
+                    zf.writestr(('%06d' % counter) + ".png", fp.getvalue())
+                    counter = counter + 1
+                finished = true
             finally:
-                if os.path.isdir(tmpdir): shutil.rmtree(tmpdir)
+                zf.close()
+                # don't leave a partial zip file to be returned from the cache
+                if (not finished) and os.path.exists(pageimagespath):
+                    os.unlink(pageimagespath)
+            response.return_file("application/x-uplib-page-images;filename=%s-page-images.zip" % doc_id, pageimagespath)
+            repo.touch_doc(doc_id)
             return
 
         # check for PNG master file
@@ -3842,6 +3901,7 @@ def _doc_pageimages (repo, response, form):
             for file in os.listdir(filepath):
                 if file[0] != '.':
                     zf.write(os.path.join(filepath, file), ('%06d' % int(re.findall('[0-9]+', file)[0])) + '.png')
+            zf.close()
             response.return_file("application/x-uplib-page-images;filename=%s-page-images.zip" % doc_id, pageimagespath)
             repo.touch_doc(doc_id)
             return
@@ -4287,6 +4347,7 @@ def _figure_file_name (doc, ext):
 
 _actions = {
     "repo_show"         : _repo_show,
+    "icon_sprite"       : _icon_sprite,
     "repo_show_category": _repo_show_categories,
     "repo_search"       : _repo_search,
     "repo_add"          : _repo_add_document,
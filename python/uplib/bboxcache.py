@@ -0,0 +1,137 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+A repository-wide cache of decoded page bounding boxes.
+
+Highlighting search hits means finding the page containing each hit, and
+that page's boxes.  Rather than have every Document keep every page it has
+ever looked at (documents stay in the repository's history for a long
+time), the decoded ``PageBBoxes`` of all documents share one
+least-recently-used cache with a limit on the memory they take up, set by
+the ``page-bboxes-cache-size`` configuration option, in kilobytes.  Each
+Document keeps just the small index which maps text positions to pages.
+"""
+
+import os
+
+from uplib.plibUtil import MutexLock, OrderedDict
+from uplib.createPageBboxes import get_page_bboxes
+
+class PageBBoxesCache (object):
+
+    """Maps (doc ID, page index) to the decoded PageBBoxes of that page."""
+
+    def __init__(self, maxbytes):
+        """
+        :param maxbytes: roughly how much memory the cached pages may use; 0 disables the cache
+        :type maxbytes: int
+        """
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # maps (doc ID, page index) to (PageBBoxes, size), least recently used first
+        self.__pages = OrderedDict()
+        self.__lock = MutexLock("PageBBoxesCache")
+
+    def __len__(self):
+        return len(self.__pages)
+
+    def get(self, doc, page_index):
+        """
+        :param doc: the document
+        :type doc: uplib.document.Document
+        :param page_index: the 0-based page index
+        :type page_index: int
+        :return: the boxes of the page, or None if the page has none
+        :rtype: uplib.createPageBboxes.PageBBoxes
+        """
+        key = (doc.id, page_index)
+        self.__lock.acquire()
+        try:
+            record = self.__pages.pop(key, None)
+            if record is not None:
+                # move it to the most-recently-used end
+                self.__pages[key] = record
+                self.hits += 1
+                return record[0]
+            self.misses += 1
+        finally:
+            self.__lock.release()
+        boxes = get_page_bboxes(os.path.join(doc.folder(), "thumbnails"), page_index)
+        if boxes is not None:
+            self.add(doc.id, boxes)
+        return boxes
+
+    def add(self, doc_id, boxes):
+        """Add the boxes of a page which the caller has already read.
+
+        :param doc_id: the document ID
+        :type doc_id: string
+        :param boxes: the boxes of one page of the document
+        :type boxes: uplib.createPageBboxes.PageBBoxes
+        """
+        if self.maxbytes <= 0:
+            return
+        size = boxes.nbytes()
+        key = (doc_id, boxes.page_index)
+        self.__lock.acquire()
+        try:
+            old = self.__pages.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self.__pages[key] = (boxes, size)
+            self.nbytes += size
+            while (self.nbytes > self.maxbytes) and (len(self.__pages) > 1):
+                self.nbytes -= self.__pages.popitem(last=False)[1][1]
+        finally:
+            self.__lock.release()
+
+    def discard(self, doc_id):
+        """Drop all the cached pages of a document, as when it's re-ripped or deleted."""
+        self.__lock.acquire()
+        try:
+            for key in [x for x in self.__pages if x[0] == doc_id]:
+                self.nbytes -= self.__pages.pop(key)[1]
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__pages.clear()
+            self.nbytes = 0
+        finally:
+            self.__lock.release()
+
+    def stats(self):
+        """
+        :return: "hits", "misses", "pages", and "bytes" (roughly, the memory used by the cached pages)
+        :rtype: dict
+        """
+        return { 'hits' : self.hits,
+                 'misses' : self.misses,
+                 'pages' : len(self.__pages),
+                 'bytes' : self.nbytes,
+                 }
+
+    # document watcher callback, for both addition and deletion
+
+    def on_change(self, doc):
+        self.discard(doc.id)
@@ -0,0 +1,332 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+The repository catalog, kept in the SQLite database in the ``overhead`` folder.
+
+The catalog records, for every document, when it was added and last used,
+which categories (including the implied parent categories of hierarchical
+ones) and authors it has, and which explicit collections it belongs to.
+It's updated a document at a time as documents are touched, edited, or
+deleted, so nothing needs to rewrite the whole category or author lists on
+every change, and lookups by category or author use an index instead of
+scanning.
+
+Older repositories kept this information in ``categories.txt`` and
+``authors.txt``; the repository migrates those into the catalog the first
+time it opens it.
+"""
+
+import time
+
+from uplib.plibUtil import note, MutexLock, id_to_time
+
+SCHEMA_VERSION = 1
+
+# A document is touched every time it's looked at, and a lost touch time does
+# little harm, so touches are committed in batches:  with the next other update,
+# after this many touches, or after this many seconds, whichever comes first.
+_TOUCH_BATCH = 100
+_TOUCH_DELAY = 30
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS catalog_info (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, added REAL, touched REAL)",
+    "CREATE INDEX IF NOT EXISTS docs_added ON docs (added)",
+    "CREATE INDEX IF NOT EXISTS docs_touched ON docs (touched)",
+    "CREATE TABLE IF NOT EXISTS categories (name TEXT PRIMARY KEY)",
+    "CREATE TABLE IF NOT EXISTS doc_categories (category TEXT, doc TEXT, PRIMARY KEY (category, doc))",
+    "CREATE INDEX IF NOT EXISTS doc_categories_doc ON doc_categories (doc)",
+    "CREATE TABLE IF NOT EXISTS doc_authors (author TEXT COLLATE NOCASE, doc TEXT, PRIMARY KEY (author, doc))",
+    "CREATE INDEX IF NOT EXISTS doc_authors_doc ON doc_authors (doc)",
+    "CREATE TABLE IF NOT EXISTS collection_members (collection TEXT, doc TEXT, PRIMARY KEY (collection, doc))",
+    "CREATE INDEX IF NOT EXISTS collection_members_doc ON collection_members (doc)",
+    )
+
+def open_catalog(repo):
+    """Open (creating, if necessary) the catalog in the repository's database.
+
+    :param repo: the repository
+    :type repo: uplib.repository.Repository
+    :return: the catalog, or None if SQLite isn't available
+    :rtype: Catalog
+    """
+    db = repo.database()
+    if db is None:
+        return None
+    return Catalog(db)
+
+
+class Catalog (object):
+
+    """Per-document index records, stored in an SQLite database."""
+
+    def __init__(self, connection):
+        self.__db = connection
+        self.__lock = MutexLock("Catalog")
+        # number of touches not yet committed, and when the first of them was made
+        self.__touches = 0
+        self.__first_touch = 0
+        self.__lock.acquire()
+        try:
+            c = self.__db.cursor()
+            # the catalog can always be rebuilt from the documents, so favor speed
+            c.execute("PRAGMA synchronous = NORMAL")
+            for statement in _SCHEMA:
+                c.execute(statement)
+            c.execute("INSERT OR IGNORE INTO catalog_info (key, value) VALUES ('schema-version', ?)",
+                      (str(SCHEMA_VERSION),))
+            self.__db.commit()
+        finally:
+            self.__lock.release()
+
+    def __query(self, statement, args=()):
+        self.__lock.acquire()
+        try:
+            return self.__db.execute(statement, args).fetchall()
+        finally:
+            self.__lock.release()
+
+    def __update(self, fn, *args):
+        self.__lock.acquire()
+        try:
+            try:
+                fn(self.__db.cursor(), *args)
+                self.__db.commit()
+            except:
+                self.__db.rollback()
+                raise
+        finally:
+            self.__touches = 0
+            self.__lock.release()
+
+    def is_populated(self):
+        """
+        :return: whether the catalog has been filled in, either by migration or by a rescan
+        :rtype: boolean
+        """
+        return bool(self.__query("SELECT value FROM catalog_info WHERE key = 'populated'"))
+
+    # updating
+
+    def __set_document(self, c, doc_id, categories, authors, touched):
+        c.execute("INSERT OR IGNORE INTO docs (id, added, touched) VALUES (?, ?, ?)",
+                  (doc_id, id_to_time(doc_id), touched))
+        if touched is not None:
+            c.execute("UPDATE docs SET touched = ? WHERE id = ?", (touched, doc_id))
+        if categories is not None:
+            c.execute("DELETE FROM doc_categories WHERE doc = ?", (doc_id,))
+            c.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)", [(x,) for x in categories])
+            c.executemany("INSERT OR IGNORE INTO doc_categories (category, doc) VALUES (?, ?)",
+                          [(x, doc_id) for x in categories])
+        if authors is not None:
+            c.execute("DELETE FROM doc_authors WHERE doc = ?", (doc_id,))
+            c.executemany("INSERT OR IGNORE INTO doc_authors (author, doc) VALUES (?, ?)",
+                          [(x, doc_id) for x in authors])
+
+    def update_document(self, doc_id, categories=None, authors=None, touched=None):
+        """Record a document's current categories, authors, and last-use time.
+
+        :param doc_id: the document ID
+        :type doc_id: string
+        :param categories: all the (lower-cased) categories of the document, \
+               including the parents of hierarchical categories; None to leave them as they are
+        :type categories: sequence of strings
+        :param authors: the authors of the document; None to leave them as they are
+        :type authors: sequence of strings
+        :param touched: time the document was last used; None to leave it as it is
+        :type touched: float
+        """
+        self.__update(self.__set_document, doc_id, categories, authors, touched)
+
+    def note_touched(self, doc_id, touched):
+        """Record a document's last-use time, and nothing else.  The change is
+        committed along with later ones; see ``flush``.
+
+        :param doc_id: the document ID
+        :type doc_id: string
+        :param touched: time the document was last used
+        :type touched: float
+        """
+        self.__lock.acquire()
+        try:
+            try:
+                c = self.__db.execute("UPDATE docs SET touched = ? WHERE id = ?", (touched, doc_id))
+                if c.rowcount == 0:
+                    self.__db.execute("INSERT OR IGNORE INTO docs (id, added, touched) VALUES (?, ?, ?)",
+                                      (doc_id, id_to_time(doc_id), touched))
+            except:
+                self.__db.rollback()
+                self.__touches = 0
+                raise
+            if self.__touches == 0:
+                self.__first_touch = time.time()
+            self.__touches += 1
+            if (self.__touches >= _TOUCH_BATCH) or (time.time() > self.__first_touch + _TOUCH_DELAY):
+                self.__db.commit()
+                self.__touches = 0
+        finally:
+            self.__lock.release()
+
+    def flush(self):
+        """Commit any touches recorded with ``note_touched`` which haven't been committed yet."""
+        self.__lock.acquire()
+        try:
+            if self.__touches:
+                self.__db.commit()
+                self.__touches = 0
+        finally:
+            self.__lock.release()
+
+    def remove_document(self, doc_id):
+        """Remove all record of the document from the catalog."""
+        def remove(c, doc_id):
+            for table, column in (("docs", "id"), ("doc_categories", "doc"),
+                                  ("doc_authors", "doc"), ("collection_members", "doc")):
+                c.execute("DELETE FROM %s WHERE %s = ?" % (table, column), (doc_id,))
+        self.__update(remove, doc_id)
+
+    def add_category(self, name):
+        """Add a category, which may not (yet) have any documents."""
+        self.__update(lambda c: c.execute("INSERT OR IGNORE INTO categories (name) VALUES (?)", (name,)))
+
+    def set_collection(self, name, doc_ids):
+        """Record the documents which are explicit members of a collection.
+
+        :param name: the collection name
+        :type name: string
+        :param doc_ids: the IDs of the documents in the collection
+        :type doc_ids: sequence of strings
+        """
+        def set_members(c, name, doc_ids):
+            c.execute("DELETE FROM collection_members WHERE collection = ?", (name,))
+            c.executemany("INSERT OR IGNORE INTO collection_members (collection, doc) VALUES (?, ?)",
+                          [(name, x) for x in doc_ids])
+        self.__update(set_members, name, doc_ids)
+
+    def remove_collection(self, name):
+        self.__update(lambda c: c.execute("DELETE FROM collection_members WHERE collection = ?", (name,)))
+
+    def rebuild(self, doc_ids, categories, authors, touched=None):
+        """Replace the document, category, and author records wholesale.
+        Used for migration from the flat files, and after a rescan.
+
+        :param doc_ids: all the documents in the repository
+        :type doc_ids: iterable of doc ID strings
+        :param categories: mapping of category name to IDs of documents in that category
+        :type categories: dict
+        :param authors: mapping of author name to IDs of documents by that author
+        :type authors: dict
+        :param touched: mapping of doc ID to last-use time, for those that are known
+        :type touched: dict
+        """
+        touched = touched or {}
+        def rebuild(c):
+            t = time.time()
+            for table in ("docs", "categories", "doc_categories", "doc_authors"):
+                c.execute("DELETE FROM %s" % table)
+            c.executemany("INSERT OR IGNORE INTO docs (id, added, touched) VALUES (?, ?, ?)",
+                          [(x, id_to_time(x), touched.get(x)) for x in doc_ids])
+            c.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)", [(x,) for x in categories])
+            for name, ids in categories.items():
+                c.executemany("INSERT OR IGNORE INTO doc_categories (category, doc) VALUES (?, ?)",
+                              [(name, x) for x in ids])
+            for name, ids in authors.items():
+                c.executemany("INSERT OR IGNORE INTO doc_authors (author, doc) VALUES (?, ?)",
+                              [(name, x) for x in ids])
+            c.execute("INSERT OR REPLACE INTO catalog_info (key, value) VALUES ('populated', ?)", (str(t),))
+        self.__update(rebuild)
+        note(3, "rebuilt catalog with %d categories and %d authors", len(categories), len(authors))
+
+    # querying
+
+    def categories(self):
+        """
+        :return: all the category names, sorted
+        :rtype: list of strings
+        """
+        return [x[0] for x in self.__query("SELECT name FROM categories ORDER BY name")]
+
+    def category_map(self):
+        """
+        :return: mapping of category name to list of doc IDs, with an entry for every category
+        :rtype: dict
+        """
+        d = dict([(x, []) for x in self.categories()])
+        for category, doc_id in self.__query("SELECT category, doc FROM doc_categories"):
+            d.setdefault(category, []).append(doc_id)
+        return d
+
+    def author_map(self):
+        """
+        :return: mapping of author name to list of doc IDs
+        :rtype: dict
+        """
+        d = {}
+        for author, doc_id in self.__query("SELECT author, doc FROM doc_authors"):
+            d.setdefault(author, []).append(doc_id)
+        return d
+
+    def docs_in_category(self, name):
+        """
+        :return: the IDs of the documents in the specified category, most recently added first
+        :rtype: list of strings
+        """
+        return [x[0] for x in self.__query("SELECT doc FROM doc_categories WHERE category = ? ORDER BY doc DESC",
+                                           (name.strip().lower(),))]
+
+    def docs_by_author(self, name):
+        """
+        :return: the IDs of the documents by the specified author (compared case-insensitively), \
+                 most recently added first
+        :rtype: list of strings
+        """
+        return [x[0] for x in self.__query("SELECT doc FROM doc_authors WHERE author = ? ORDER BY doc DESC",
+                                           (name.strip(),))]
+
+    def document_categories(self, doc_id):
+        return [x[0] for x in self.__query("SELECT category FROM doc_categories WHERE doc = ?", (doc_id,))]
+
+    def document_collections(self, doc_id):
+        """
+        :return: the names of the collections which explicitly contain the document
+        :rtype: list of strings
+        """
+        return [x[0] for x in self.__query("SELECT collection FROM collection_members WHERE doc = ?", (doc_id,))]
+
+    def recently_added(self, count=0):
+        """
+        :param count: max number of IDs to return; 0 means all of them
+        :type count: int
+        :return: doc IDs, most recently added first
+        :rtype: list of strings
+        """
+        return [x[0] for x in self.__query("SELECT id FROM docs ORDER BY added DESC LIMIT ?", (count or -1,))]
+
+    def recently_touched(self, count=0):
+        """
+        :param count: max number of IDs to return; 0 means all of them
+        :type count: int
+        :return: doc IDs of documents which have been used, most recently used first
+        :rtype: list of strings
+        """
+        return [x[0] for x in self.__query("SELECT id FROM docs WHERE touched IS NOT NULL ORDER BY touched DESC LIMIT ?",
+                                           (count or -1,))]
+
+    def docs_count(self):
+        return self.__query("SELECT COUNT(*) FROM docs")[0][0]
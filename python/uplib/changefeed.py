@@ -0,0 +1,136 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+A feed of the changes to a repository's documents.
+
+Clients which keep a copy of some of the repository's state, like the UVFS
+file system, need to know what has changed since they last looked.  Each
+change -- a document added, deleted, touched, or its metadata updated -- is
+given the next number in a sequence, and the most recent changes are kept
+in memory.  A client remembers the last sequence number it saw, and asks for
+the changes after that; if there aren't any yet, it can wait for one on a
+condition variable, rather than polling.  Sequence numbers start over when
+the repository restarts, so each run has its own ``epoch``; a client with a
+different epoch, or a sequence number older than the changes kept, has to
+start over.
+"""
+
+import time, threading
+
+# the kinds of changes
+ADDED = "add"
+DELETED = "delete"
+TOUCHED = "touch"
+METADATA = "metadata"
+
+class ChangeFeed (object):
+
+    """A sequence of (sequence number, kind, doc ID) changes, with the most recent ones kept."""
+
+    def __init__(self, maxlen=10000):
+        """
+        :param maxlen: how many of the most recent changes to keep
+        :type maxlen: int
+        """
+        self.maxlen = max(1, maxlen)
+        self.epoch = "%x" % int(time.time() * 1000)
+        self.__seq = 0
+        # (sequence number, kind, doc ID), oldest first, with consecutive sequence numbers
+        self.__changes = []
+        self.__condition = threading.Condition()
+        self.__closed = False
+
+    def sequence(self):
+        """
+        :return: the sequence number of the most recent change
+        :rtype: int
+        """
+        return self.__seq
+
+    def record(self, doc_id, kind):
+        """Add a change to the feed, and wake anyone waiting for one.
+
+        :param doc_id: the document which changed
+        :type doc_id: string
+        :param kind: one of ADDED, DELETED, TOUCHED, or METADATA
+        :type kind: string
+        """
+        self.__condition.acquire()
+        try:
+            self.__seq += 1
+            self.__changes.append((self.__seq, kind, doc_id))
+            # trim occasionally, rather than on every change
+            if len(self.__changes) > (self.maxlen + self.maxlen // 2):
+                del self.__changes[:-self.maxlen]
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+
+    def changes(self, since, timeout=0):
+        """Find the changes after a given point, waiting for one if there aren't any yet.
+
+        :param since: the sequence number of the last change the caller has seen
+        :type since: int
+        :param timeout: how many seconds to wait for a change, if there are none after ``since``
+        :type timeout: float
+        :return: the current sequence number, and the changes after ``since``, oldest first, \
+                 as (sequence number, kind, doc ID); the changes are None if some of them \
+                 are no longer kept, and the caller should start over
+        :rtype: (int, list or None)
+        """
+        deadline = time.time() + timeout
+        self.__condition.acquire()
+        try:
+            while (self.__seq == since) and (not self.__closed):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(remaining)
+            if since > self.__seq:
+                # from some other run of the repository
+                return self.__seq, None
+            if self.__changes:
+                first = self.__changes[0][0]
+            else:
+                first = self.__seq + 1
+            if since < (first - 1):
+                return self.__seq, None
+            return self.__seq, self.__changes[since - first + 1:]
+        finally:
+            self.__condition.release()
+
+    def close(self):
+        """Wake anyone waiting for a change, as when the repository shuts down."""
+        self.__condition.acquire()
+        try:
+            self.__closed = True
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+
+    # document watcher callbacks
+
+    def on_add(self, doc):
+        self.record(doc.id, ADDED)
+
+    def on_delete(self, doc):
+        self.record(doc.id, DELETED)
+
+    def on_touch(self, doc):
+        self.record(doc.id, TOUCHED)
@@ -245,6 +245,12 @@ class HTMLRipper (Ripper):
     def rip (self, location, doc_id):
         htmlize_folder(self.repository(), location, doc_id)
 
+    def requires(self):
+        return ("ThumbnailRipper", "SimpleSummaryRipper")
+
+    def declares_dependencies(self):
+        return True
+
     def rerun_after_metadata_changes(self, changed_fields=None):
         if changed_fields:
             return ("name" in changed_fields or
@@ -20,9 +20,9 @@
 #
 #
 
-import re, os, sys, string, time, shutil, tempfile, stat, traceback, cgi
+import re, os, sys, string, time, shutil, tempfile, stat, traceback, cgi, threading, itertools
 
-from uplib.plibUtil import false, true, Error, note, configurator, set_verbosity, subproc, MutexLock, HAVE_PYLUCENE
+from uplib.plibUtil import false, true, Error, note, configurator, set_verbosity, subproc, MutexLock, HAVE_PYLUCENE, uthread, OrderedDict
 from uplib.plibUtil import lock_folder, unlock_folder
 import uplib.plibUtil as plibUtil
 from uplib.ripper import Ripper
@@ -85,6 +85,31 @@ def get_context (repo_index_dir):
             LUCENE_CONTEXT = uplib.indexing.LuceneContext(repo_index_dir)
     return LUCENE_CONTEXT
 
+# counts the changes this process has made to each index, so that cached search
+# results can be recognized as stale
+_INDEX_GENERATIONS = {}
+
+def _index_changed (repo_index_dir):
+    key = os.path.normpath(repo_index_dir)
+    _INDEX_GENERATIONS[key] = _INDEX_GENERATIONS.get(key, 0) + 1
+
+def index_generation (repo_index_dir):
+    """Return a value which changes whenever the index is modified.  Search results
+    obtained under one generation are still valid as long as the generation is the same.
+
+    :param repo_index_dir: the index directory
+    :type repo_index_dir: string
+    :return: count of changes made by this process, plus the modification time of the index directory \
+             (which catches changes made by other processes)
+    :rtype: (int, float)
+    """
+    key = os.path.normpath(repo_index_dir)
+    try:
+        mtime = os.path.getmtime(key)
+    except OSError:
+        mtime = 0
+    return (_INDEX_GENERATIONS.get(key, 0), mtime)
+
 def index_folder (folder, repo_index_dir):
 
     update_configuration()
@@ -104,6 +129,7 @@ def index_folder (folder, repo_index_dir):
             note(0, "Can't index folder %s:\n%s",
                  folder, ''.join(traceback.format_exception(*sys.exc_info())))
     finally:
+        _index_changed(repo_index_dir)
         SECTION_LOCK.release()
     if LUCENE != 'jcc':
         note(3, "  indexing output is <%s>", output)
@@ -136,6 +162,7 @@ def index_folders (docs_dir, doc_ids, repo_index_dir):
                         unlock_folder(folderpath)
             c.reopen()
         finally:
+            _index_changed(repo_index_dir)
             SECTION_LOCK.release()
         return
 
@@ -155,6 +182,7 @@ def index_folders (docs_dir, doc_ids, repo_index_dir):
             try:
                 status, output, tsignal = subproc(indexingcmd)
             finally:
+                _index_changed(repo_index_dir)
                 SECTION_LOCK.release()
                 os.unlink(fname)
             note(3, "  indexing output is <%s>", output)
@@ -170,6 +198,7 @@ def index_folders (docs_dir, doc_ids, repo_index_dir):
             try:
                 status, output, tsignal = subproc(indexingcmd)
             finally:
+                _index_changed(repo_index_dir)
                 SECTION_LOCK.release()
             note(3, "  indexing output is <%s>", output)
             if status != 0:
@@ -186,6 +215,7 @@ def remove_from_index (repo_index_dir, doc_id):
             c = get_context(repo_index_dir)
             c.remove(doc_id)
         finally:
+            _index_changed(repo_index_dir)
             SECTION_LOCK.release()
 
     else:
@@ -196,11 +226,179 @@ def remove_from_index (repo_index_dir, doc_id):
         try:
             status, output, tsignal = subproc(indexingcmd)
         finally:
+            _index_changed(repo_index_dir)
             SECTION_LOCK.release()
         note(3, "  indexing output is <%s>", output)
         if status != 0:
             raise Error ("%s signals non-zero exit status %d attempting to remove %s:\n%s" % (JAVA, status, doc_id, output))
 
+class IndexingQueue (object):
+    """
+    Collects document IDs which need to be re-indexed, and indexes them in
+    batches on a background thread, via ``index_folders``, so that a burst of
+    edits costs one index update (and one searcher re-open) instead of one
+    per document.  Repeated requests for the same document are coalesced.
+    No document waits longer than ``max_staleness`` seconds, and a batch is
+    committed early if ``batch_size`` documents are waiting.
+    """
+
+    def __init__(self, repo, max_staleness=None, batch_size=None):
+        conf = configurator.default_configurator()
+        self.repo = repo
+        if max_staleness is None:
+            max_staleness = float(conf.get("indexing-queue-max-staleness", "2.0"))
+        if batch_size is None:
+            batch_size = conf.get_int("indexing-queue-batch-size", 100)
+        self.max_staleness = max(0.0, max_staleness)
+        self.batch_size = max(1, batch_size)
+        # maps doc ID to the time it was first queued
+        self.__pending = OrderedDict()
+        self.__condition = threading.Condition(threading.Lock())
+        self.__busy = False
+        self.__commits = 0
+        self.__docs_indexed = 0
+        self.__last_latency = 0.0
+        self.__total_latency = 0.0
+        self.__max_wait = 0.0
+        self.__thread = uthread.start_new_thread(self.__run, (), name="IndexingQueue")
+
+    def add(self, doc_ids):
+        """Queue documents for re-indexing.
+
+        :param doc_ids: the documents to index
+        :type doc_ids: sequence of doc ID strings
+        """
+        now = time.time()
+        self.__condition.acquire()
+        try:
+            for doc_id in doc_ids:
+                if doc_id not in self.__pending:
+                    self.__pending[doc_id] = now
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+
+    def depth(self):
+        """Number of documents waiting to be indexed."""
+        return len(self.__pending)
+
+    def stats(self):
+        """
+        :return: queue depth, number of batches committed, documents indexed, \
+                 latency of the last commit, average commit latency, and the longest time a \
+                 document has waited in the queue, all times in seconds
+        :rtype: dict
+        """
+        self.__condition.acquire()
+        try:
+            return { 'depth' : len(self.__pending),
+                     'busy' : self.__busy,
+                     'commits' : self.__commits,
+                     'docs-indexed' : self.__docs_indexed,
+                     'last-commit-latency' : self.__last_latency,
+                     'average-commit-latency' : (self.__commits and (self.__total_latency / self.__commits)) or 0.0,
+                     'max-wait' : self.__max_wait,
+                     'max-staleness' : self.max_staleness,
+                     }
+        finally:
+            self.__condition.release()
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been indexed.
+
+        :param timeout: max number of seconds to wait, or None to wait indefinitely
+        :type timeout: float
+        :return: True if the queue drained, False if we timed out
+        :rtype: boolean
+        """
+        deadline = (timeout is not None) and (time.time() + timeout)
+        self.__condition.acquire()
+        try:
+            self.__condition.notifyAll()
+            while self.__pending or self.__busy:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.__condition.wait(remaining)
+                else:
+                    self.__condition.wait(1.0)
+            return True
+        finally:
+            self.__condition.release()
+
+    def shutdown(self, timeout=30.0):
+        """Give the documents already queued up to ``timeout`` seconds to be
+        indexed, as the repository shuts down.
+
+        :param timeout: max number of seconds to wait
+        :type timeout: float
+        :return: True if the queue drained, False if we timed out
+        :rtype: boolean
+        """
+        if self.flush(timeout):
+            return True
+        note(0, "IndexingQueue:  gave up waiting for re-indexing at shutdown; %d more documents were queued", self.depth())
+        return False
+
+    def __next_batch(self):
+        # called with the condition held; returns a list of doc IDs to index
+        while True:
+            if not self.__pending:
+                self.__condition.wait()
+                continue
+            oldest = self.__pending[iter(self.__pending).next()]
+            wait = oldest + self.max_staleness - time.time()
+            if (wait <= 0) or (len(self.__pending) >= self.batch_size):
+                break
+            self.__condition.wait(wait)
+        batch = list(itertools.islice(self.__pending, self.batch_size))
+        now = time.time()
+        for doc_id in batch:
+            self.__max_wait = max(self.__max_wait, now - self.__pending[doc_id])
+            del self.__pending[doc_id]
+        self.__busy = True
+        return batch
+
+    def __commit(self, batch):
+        # group by parent directory, to cope with hierarchical doc directories
+        groups = {}
+        for doc_id in batch:
+            if self.repo.valid_doc_id(doc_id):
+                docs_dir, name = os.path.split(self.repo.doc_location(doc_id))
+                groups.setdefault(docs_dir, []).append(name)
+        for docs_dir, names in groups.items():
+            index_folders(docs_dir, names, self.repo.index_path())
+
+    def __run(self):
+        while True:
+            self.__condition.acquire()
+            try:
+                batch = self.__next_batch()
+            finally:
+                self.__condition.release()
+            start = time.time()
+            try:
+                try:
+                    self.__commit(batch)
+                except:
+                    note(0, "IndexingQueue:  exception indexing %s:\n%s", batch,
+                         ''.join(traceback.format_exception(*sys.exc_info())))
+            finally:
+                latency = time.time() - start
+                note(3, "IndexingQueue:  indexed %d documents in %.3f seconds", len(batch), latency)
+                self.__condition.acquire()
+                try:
+                    self.__busy = False
+                    self.__commits += 1
+                    self.__docs_indexed += len(batch)
+                    self.__last_latency = latency
+                    self.__total_latency += latency
+                    self.__condition.notifyAll()
+                finally:
+                    self.__condition.release()
+
+
 class LuceneRipper (Ripper):
 
     def requires (self):
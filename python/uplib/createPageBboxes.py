@@ -20,7 +20,7 @@
 #
 #
 
-import re, os, sys, time, shutil, tempfile, stat, traceback, cgi, socket, codecs, struct, math, StringIO, zlib
+import re, os, sys, time, shutil, tempfile, stat, traceback, cgi, socket, codecs, struct, math, StringIO, zlib, mmap, array
 from bisect import bisect
 
 from PIL import Image, ImageOps            # python image library (PIL)
@@ -275,11 +275,19 @@ class POSTag:
         return fragments
     parse_parseinfo=staticmethod(parse_parseinfo)
 
-def get_page_bboxes (dirpath, page_index):
+def get_page_bboxes (dirpath, page_index, store=None):
 
     if (not os.path.isdir(dirpath)):
         return None
 
+    # callers reading many pages can pass in an already-open store
+    if store is None:
+        store = open_page_bboxes_store(dirpath)
+    if store is not None:
+        if page_index < len(store):
+            return PageBBoxes(page_index=page_index, store=store)
+        return None
+
     bbox_files = [int(os.path.splitext(x)[0]) for x in os.listdir(dirpath) if x.endswith(".bboxes")]
     bbox_files.sort()
     if ((page_index + 1) in bbox_files):
@@ -291,7 +299,10 @@ def find_page (dirpath, text_pos):
     if (not os.path.isdir(dirpath)):
         return None
 
-    # this could be improved by at the least doing a binary search
+    store = open_page_bboxes_store(dirpath)
+    if store is not None:
+        page_index = store.find_page(text_pos)
+        return (page_index is not None) and PageBBoxes(page_index=page_index, store=store) or None
 
     bbox_files = [int(os.path.splitext(x)[0]) for x in os.listdir(dirpath) if x.endswith(".bboxes")]
     bbox_files.sort()
@@ -302,7 +313,48 @@ def find_page (dirpath, text_pos):
             return boxes
     return None
             
-class PageBBox:
+# The fields of a 16-byte box record in a ".bboxes" or "bboxes.pbc" file
+_BOX_RECORD = ">HHHHBBBBBBH"
+_BOX_FIELDS = ("ulx", "uly", "lrx", "lry", "nchars", "font_size", "flags", "text_len", None, "poscode", "text_position")
+# the memory taken by one box, once unpacked into a BoxColumns
+_UNPACKED_BOX_SIZE = sum([array.array(_BOX_RECORD[i + 1]).itemsize for i in range(len(_BOX_FIELDS)) if _BOX_FIELDS[i]])
+
+class BoxColumns (object):
+
+    """The boxes of a page, kept as parallel arrays, one for each field of the box records.
+    ``font_size`` is in half-points, and ``poscode`` has the sentence/paragraph start
+    flags in its top two bits and the part-of-speech code in the rest."""
+
+    __slots__ = tuple([x for x in _BOX_FIELDS if x])
+
+    def __init__(self, data=""):
+        """
+        :param data: packed box records, as in a ".bboxes" file
+        :type data: string
+        """
+        count = len(data) // 16
+        values = (count and struct.unpack(">" + (_BOX_RECORD[1:] * count), data[:count * 16])) or ()
+        for i in range(len(_BOX_FIELDS)):
+            if _BOX_FIELDS[i]:
+                setattr(self, _BOX_FIELDS[i], array.array(_BOX_RECORD[i + 1], values[i::len(_BOX_FIELDS)]))
+
+    def __len__(self):
+        return len(self.text_position)
+
+def _column_property (name, doc=None):
+    return property(lambda self: getattr(self.page.columns, name)[self.index], doc=doc)
+
+def _flag_property (mask):
+    return property(lambda self: self.page.columns.flags[self.index] & mask)
+
+def _starts_property (level):
+    return property(lambda self: ((self.page.columns.poscode[self.index] & 0xC0) >> 6) > level)
+
+class PageBBox (object):
+
+    """One box of a PageBBoxes.  This is just a view; the values are kept in the page's columns."""
+
+    __slots__ = ('page', 'index')
 
     FIXED_WIDTH =       0x80
     SERIF_FONT =        0x40
@@ -315,27 +367,31 @@ class PageBBox:
 
     POS_CODES = dict([[v,k] for k,v in POSTag.POS_CODES.items()])
 
-    def __init__(self, page, nchars, nbytes, font_size, flags, ulx, uly, lrx, lry,
-                 pos_tag, begins_para, begins_sentence, begins_phrase, textpos, baseline=0):
+    def __init__(self, page, index):
         self.page = page
-        self.text_len = nbytes
-        self.nchars = nchars
-        self.font_size = font_size
-        self.fixed_width = (flags & PageBBox.FIXED_WIDTH)
-        self.serif_font = (flags & PageBBox.SERIF_FONT)
-        self.symbolic_font = (flags & PageBBox.SYMBOLIC_FONT)
-        self.italic = (flags & PageBBox.ITALIC)
-        self.bold = (flags & PageBBox.BOLD)
-        self.ends_line = (flags & PageBBox.ENDS_LINE)
-        self.ends_word = (flags & PageBBox.ENDS_WORD)
-        self.inserted_hyphen = (flags & PageBBox.INSERTED_HYPHEN)
-        self.begins_paragraph = begins_para
-        self.begins_sentence = begins_sentence
-        self.begins_phrase = begins_phrase
-        self.part_of_speech = pos_tag
-        self.text_position = textpos
-        self.baseline = baseline
-        self.bbox = (ulx, uly, lrx, lry)
+        self.index = index
+
+    text_len = _column_property("text_len", "length of the box's text, in bytes")
+    nchars = _column_property("nchars")
+    text_position = _column_property("text_position", "offset of the box's text in the page text")
+    font_size = property(lambda self: self.page.columns.font_size[self.index] / 2.0)
+    bbox = property(lambda self: (self.page.columns.ulx[self.index], self.page.columns.uly[self.index],
+                                  self.page.columns.lrx[self.index], self.page.columns.lry[self.index]))
+    part_of_speech = property(lambda self: self.page.columns.poscode[self.index] & 0x3F)
+    baseline = 0
+
+    fixed_width = _flag_property(FIXED_WIDTH)
+    serif_font = _flag_property(SERIF_FONT)
+    symbolic_font = _flag_property(SYMBOLIC_FONT)
+    italic = _flag_property(ITALIC)
+    bold = _flag_property(BOLD)
+    ends_line = _flag_property(ENDS_LINE)
+    ends_word = _flag_property(ENDS_WORD)
+    inserted_hyphen = _flag_property(INSERTED_HYPHEN)
+
+    begins_paragraph = _starts_property(2)
+    begins_sentence = _starts_property(1)
+    begins_phrase = _starts_property(0)
 
     def string(self):
         return unicode(self.page.text_bytes[self.text_position:self.text_position+self.text_len], 'utf-8', 'replace')
@@ -354,17 +410,67 @@ class PageBBox:
         if (self.part_of_speech and (self.part_of_speech in self.POS_CODES)):
             return self.POS_CODES[self.part_of_speech]
 
-class PageBBoxes:
+class PageBBoxList (object):
+
+    """The boxes of a PageBBoxes, as a sequence of PageBBox views made as they're asked for."""
+
+    __slots__ = ('page',)
+
+    def __init__(self, page):
+        self.page = page
+
+    def __len__(self):
+        return len(self.page.columns)
 
-    def __init__(self, filepath = None, page_index = None):
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [PageBBox(self.page, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if (index < 0) or (index >= len(self)):
+            raise IndexError("box index %s out of range" % index)
+        return PageBBox(self.page, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield PageBBox(self.page, i)
+
+def _trim_page_text (data, last_record):
+    # text_bytes often has a little extra at the end, since we didn't know how much we'd
+    # need when we created the PageBbox file.  So fix that up.
+    nchars, text_len, text_position = last_record[4], last_record[7], last_record[10]
+    bytes = unicode(data[text_position:], "UTF-8", "replace")[:min(text_len, nchars)].encode("UTF-8", "replace")
+    return data[:text_position] + bytes
+
+class PageBBoxes (object):
+
+    def __init__(self, filepath = None, page_index = None, store = None):
         self.start_pos = 0;
         self.end_pos = 0;
         self.text_bytes = None
-        self.boxes = None
+        self.__columns = None
+        self.__store = store
+        self.__box_count = 0
         self.page_index = page_index
-        if filepath is not None:
+        if store is not None:
+            self.start_pos, text_length, self.text_bytes = store.page(page_index)
+            self.__box_count = store.box_count(page_index)
+            self.end_pos = self.start_pos + text_length
+        elif filepath is not None:
             self.read_page_bboxes_file_internal(filepath, page_index)
 
+    def __get_columns(self):
+        if self.__columns is None:
+            # boxes from a store are only unpacked when they're first needed
+            self.__columns = BoxColumns((self.__store is not None) and self.__store.box_data(self.page_index) or "")
+            # after which we don't need the store any more
+            self.__store = None
+        return self.__columns
+
+    columns = property(__get_columns)
+    boxes = property(lambda self: PageBBoxList(self))
+    starts = property(lambda self: self.columns.text_position)
+
     def read_page_bboxes_file_internal (self, filepath, page_index):
         if not os.path.exists(filepath):
             return None
@@ -375,33 +481,20 @@ class PageBBoxes:
         box_count, text_length, page_start = struct.unpack(">HHI", header[12:20])
         self.page_index = (page_index is not None and page_index) or self.figure_page_index_from_filename(filepath)
         note(4, "page %d, %d boxes, %d text bytes, starting at byte %d in contents.txt", self.page_index, box_count, text_length, page_start)
-        boxes = list()
+        records = ""
         data = ""
         if (box_count > 0) or (text_length > 0):
             data = zlib.decompress(fp.read())
             if len(data) != (box_count * 16) + text_length:
                 note("invalid length for uncompressed box data in %s; expected %s", filepath, (text_length + (box_count * 16)))
-                raise ValueError("invalid length for uncompressed box data in %s; expected %s" % (filename, (text_length + (box_count * 16))))
-            fp = StringIO.StringIO(data)
-            for i in range(box_count):
-                data = fp.read(16)
-                ulx, uly, lrx, lry, char_count, font_size, flags, text_size, unused, poscode, start = struct.unpack(">HHHHBBBBBBH", data)
-                font_size = font_size / 2.0;
-                pos_tag = poscode & 0x3F
-                start_flags = (poscode & 0xC0) >> 6
-                box = PageBBox(self, char_count, text_size, font_size, flags, ulx, uly, lrx, lry, pos_tag,
-                               (start_flags > 2), (start_flags > 1), (start_flags > 0), start)
-                boxes.append(box)
-            data = fp.read(text_length)
+                raise ValueError("invalid length for uncompressed box data in %s; expected %s" % (filepath, (text_length + (box_count * 16))))
+            records, data = data[:box_count * 16], data[box_count * 16:]
+            if records:
+                data = _trim_page_text(data, struct.unpack(_BOX_RECORD, records[-16:]))
         fp.close()
-        # text_bytes often has a little extra at the end, since we didn't know how much we'd
-        # need when we created the PageBbox file.  So fix that up.
-        lastbox = boxes[-1]
-        bytes = unicode(data[lastbox.text_position:], "UTF-8", "replace")[:min(lastbox.text_len, lastbox.nchars)].encode("UTF-8", "replace")
-        self.text_bytes = data[:lastbox.text_position] + bytes
-        # OK, it's fixed
-        self.boxes = boxes
-        self.starts = map(lambda x: x.text_position, boxes)
+        self.text_bytes = data
+        self.__columns = BoxColumns(records)
+        self.__box_count = len(self.__columns)
         self.start_pos = page_start
         self.end_pos = page_start + text_length
         return self
@@ -417,10 +510,11 @@ class PageBBoxes:
             return []
         start_pos = max(start - self.start_pos, 0)
         end_pos = min(max(0, end - self.start_pos), len(self.text_bytes))
+        starts = self.starts
         boxes = []
-        index = bisect (self.starts, start_pos)
-        while (index < len(self.boxes)) and (self.boxes[index].text_position < end_pos):
-            boxes.append(self.boxes[index])
+        index = bisect (starts, start_pos)
+        while (index < len(starts)) and (starts[index] < end_pos):
+            boxes.append(PageBBox(self, index))
             index = index + 1
         return boxes
 
@@ -431,11 +525,232 @@ class PageBBoxes:
     def __str__(self):
         return "<%s %d %d-%d>" % (self.__class__.__name__, self.page_index, self.start_pos, self.end_pos)
 
+    def nbytes(self):
+        """
+        :return: roughly how much memory the page's text and boxes take up, once the boxes are unpacked
+        :rtype: int
+        """
+        # figured from the number of box records, so that the boxes don't have to be unpacked
+        return 200 + len(self.text_bytes or "") + (self.__box_count * _UNPACKED_BOX_SIZE)
+
     def contains_text_pos (self, text_pos):
         return (text_pos >= self.start_pos and text_pos < self.end_pos)
 
+
+# The per-page ".bboxes" files are what ReadUp fetches, but reading them
+# means inflating a file and unpacking every box for each page looked at.
+# So we also keep all the pages of a document in one uncompressed file,
+# "bboxes.pbc" in the thumbnails folder, which is mmapped and read a page
+# (or a span of text) at a time:
+#
+#   header:      "UpLib:pbc:1\0", page count (4 bytes)
+#   page table:  for each page, 6 4-byte values:  offset of the page start in
+#                contents.txt, length of the text range covered by the page,
+#                number of boxes, file offset of the boxes, file offset of the
+#                page text, length of the page text
+#   boxes:       16-byte records, laid out as in the ".bboxes" files
+#   text:        UTF-8 text of each page
+#
+# All numbers are big-endian.
+
+PAGE_BBOXES_STORE_NAME = "bboxes.pbc"
+_STORE_MAGIC = "UpLib:pbc:1\0"
+_STORE_HEADER = struct.Struct(">12sI")
+_STORE_PAGE = struct.Struct(">IIIIII")
+_STORE_BOX = struct.Struct(_BOX_RECORD)
+
+class PageTextIndex (object):
+
+    """Maps positions in a document's contents.txt to page indices."""
+
+    __slots__ = ('starts', 'lengths')
+
+    def __init__(self, ranges):
+        """
+        :param ranges: for each page, the offset of its start in contents.txt and the length of its text
+        :type ranges: sequence of (int, int)
+        """
+        self.starts = array.array('L', [x[0] for x in ranges])
+        self.lengths = array.array('L', [x[1] for x in ranges])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def find(self, text_pos):
+        """
+        :return: the index of the page whose text contains ``text_pos``, or None
+        :rtype: int
+        """
+        index = bisect(self.starts, text_pos) - 1
+        while index >= 0:
+            if text_pos < (self.starts[index] + self.lengths[index]):
+                return index
+            if self.lengths[index] > 0:
+                break
+            # empty pages don't contain anything; look at the page before
+            index -= 1
+        return None
+
+class PageBBoxStore (object):
+
+    """Read-only access to a document's "bboxes.pbc" file."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        fp = open(filepath, 'rb')
+        try:
+            try:
+                self.__data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                self.__data = fp.read()
+        finally:
+            fp.close()
+        magic, count = _STORE_HEADER.unpack_from(self.__data, 0)
+        if magic != _STORE_MAGIC:
+            raise ValueError("%s is not a page bboxes store" % filepath)
+        self.__pages = [_STORE_PAGE.unpack_from(self.__data, _STORE_HEADER.size + (i * _STORE_PAGE.size))
+                        for i in range(count)]
+        self.index = PageTextIndex([x[:2] for x in self.__pages])
+
+    def __len__(self):
+        return len(self.__pages)
+
+    def close(self):
+        if hasattr(self.__data, "close"):
+            self.__data.close()
+
+    def page(self, page_index):
+        """
+        :return: the offset of the start of the page in contents.txt, the length of the \
+                 text range covered by the page, and the (UTF-8) text of the page
+        :rtype: (int, int, string)
+        """
+        start, text_length, count, boxes_offset, text_offset, stored_length = self.__pages[page_index]
+        return start, text_length, self.__data[text_offset:text_offset + stored_length]
+
+    def box_count(self, page_index):
+        return self.__pages[page_index][2]
+
+    def box_data(self, page_index):
+        """
+        :return: the packed box records of a page, laid out as in the ".bboxes" files
+        :rtype: string
+        """
+        count, boxes_offset = self.__pages[page_index][2:4]
+        return self.__data[boxes_offset:boxes_offset + (count * _STORE_BOX.size)]
+
+    def find_page(self, text_pos):
+        """
+        :return: the index of the page whose text contains the specified position in \
+                 contents.txt, or None
+        :rtype: int
+        """
+        return self.index.find(text_pos)
+
+
+def write_page_bboxes_store (dirpath):
+    """Gather the per-page ".bboxes" files in ``dirpath`` into a single "bboxes.pbc" file.
+
+    :param dirpath: the thumbnails folder of a document
+    :type dirpath: string
+    :return: the pathname of the new store, or None if there are no ".bboxes" files
+    :rtype: string
+    """
+    pagenos = [int(os.path.splitext(x)[0]) for x in os.listdir(dirpath) if re.match(r"^[0-9]+\.bboxes$", x)]
+    if not pagenos:
+        return None
+    pages = []
+    last_start = 0
+    for pageno in range(1, max(pagenos) + 1):
+        filepath = os.path.join(dirpath, "%d.bboxes" % pageno)
+        if not os.path.exists(filepath):
+            pages.append((last_start, 0, "", ""))
+            continue
+        fp = open(filepath, 'rb')
+        try:
+            header = fp.read(20)
+            if (len(header) != 20) or (header[:12] != "UpLib:pbb:1\0"):
+                raise ValueError("invalid page bboxes file (bad header) in %s" % filepath)
+            box_count, text_length, page_start = struct.unpack(">HHI", header[12:20])
+            data = ((box_count > 0) or (text_length > 0)) and zlib.decompress(fp.read()) or ""
+        finally:
+            fp.close()
+        if len(data) != (box_count * 16) + text_length:
+            raise ValueError("invalid length for uncompressed box data in %s; expected %s"
+                             % (filepath, (text_length + (box_count * 16))))
+        records, text = data[:box_count * 16], data[box_count * 16:]
+        if records:
+            text = _trim_page_text(text, _STORE_BOX.unpack(records[-16:]))
+        pages.append((page_start, text_length, records, text))
+        last_start = page_start
+
+    fd, tmpname = tempfile.mkstemp(dir=dirpath)
+    try:
+        fp = os.fdopen(fd, 'wb')
+        try:
+            fp.write(_STORE_HEADER.pack(_STORE_MAGIC, len(pages)))
+            offset = _STORE_HEADER.size + (len(pages) * _STORE_PAGE.size)
+            for page_start, text_length, records, text in pages:
+                fp.write(_STORE_PAGE.pack(page_start, text_length, len(records) // 16, offset,
+                                          offset + len(records), len(text)))
+                offset += len(records) + len(text)
+            for page_start, text_length, records, text in pages:
+                fp.write(records)
+                fp.write(text)
+        finally:
+            fp.close()
+    except:
+        os.unlink(tmpname)
+        raise
+    filepath = os.path.join(dirpath, PAGE_BBOXES_STORE_NAME)
+    if os.path.exists(filepath) and sys.platform.lower().startswith("win"):
+        os.unlink(filepath)
+    os.rename(tmpname, filepath)
+    os.chmod(filepath, 0600)
+    note(3, "   wrote %d pages of bboxes to %s", len(pages), filepath)
+    return filepath
+
+def open_page_bboxes_store (dirpath):
+    """Open the "bboxes.pbc" file in ``dirpath``, first creating it from the
+    per-page ".bboxes" files if it's missing or older than they are.
+
+    :param dirpath: the thumbnails folder of a document
+    :type dirpath: string
+    :return: the store, or None if there's no bboxes information
+    :rtype: PageBBoxStore
+    """
+    if not os.path.isdir(dirpath):
+        return None
+    filepath = os.path.join(dirpath, PAGE_BBOXES_STORE_NAME)
+    firstpage = os.path.join(dirpath, "1.bboxes")
+    try:
+        if (not os.path.exists(filepath)) or (os.path.exists(firstpage) and
+                                              (os.path.getmtime(firstpage) > os.path.getmtime(filepath))):
+            if not write_page_bboxes_store(dirpath):
+                return None
+        return PageBBoxStore(filepath)
+    except (EnvironmentError, ValueError, zlib.error), x:
+        note(3, "can't use page bboxes store in %s:  %s", dirpath, x)
+        return None
+
         
 
+def read_page_text_index (dirpath):
+    """
+    :param dirpath: the thumbnails folder of a document
+    :type dirpath: string
+    :return: the index of page text positions from the document's "bboxes.pbc" file, \
+             or None if there's no store
+    :rtype: PageTextIndex
+    """
+    store = open_page_bboxes_store(dirpath)
+    if store is None:
+        return None
+    try:
+        return store.index
+    finally:
+        store.close()
+
 def flush_page (dirpath, page_index, bboxes, pagetext, pagestart):
 
     filepath = os.path.join(dirpath, "thumbnails", "%d.bboxes" % (page_index + 1))
@@ -671,6 +986,8 @@ def do_page_bounding_boxes (dirpath):
     text_file.close()
     wordbox_file.close()
 
+    write_page_bboxes_store(os.path.join(dirpath, "thumbnails"))
+
     dstats = update_stats("", doc_stats)
 
     update_metadata(os.path.join(dirpath, "metadata.txt"), { "wordbbox-stats-pagewise": stats, "wordbbox-stats-docwise": dstats})
@@ -696,8 +1013,23 @@ class BboxesRipper (Ripper):
             note("No page bounding boxes generated.")
             raise
 
+    def requires(self):
+        return ("ThumbnailRipper", "GuessLanguageRipper")
+
+    def declares_dependencies(self):
+        return True
+
 if __name__ == "__main__":
-    # little test
-    from uplib.plibUtil import set_verbosity
-    set_verbosity(4)
-    do_page_bounding_boxes(sys.argv[1])
+    if (len(sys.argv) < 2) or ((sys.argv[1] == "--store") and (len(sys.argv) < 3)):
+        sys.stderr.write("Usage:  python createPageBboxes.py DOCFOLDER\n"
+                         "        python createPageBboxes.py --store DOCFOLDER [DOCFOLDER...]\n")
+        sys.exit(1)
+    if sys.argv[1] == "--store":
+        # gather the existing per-page bboxes files of each document into a single store
+        set_verbosity(3)
+        for path in sys.argv[2:]:
+            write_page_bboxes_store(os.path.join(path, "thumbnails"))
+    else:
+        # little test
+        set_verbosity(4)
+        do_page_bounding_boxes(sys.argv[1])
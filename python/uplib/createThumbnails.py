@@ -20,7 +20,7 @@
 #
 #
 
-import re, os, sys, string, time, shutil, tempfile, stat, traceback, gc, types
+import re, os, sys, string, time, shutil, stat, traceback, gc, types, threading
 import math
 from math import sqrt, log, exp
 
@@ -28,13 +28,11 @@ from PIL import Image, ImageOps, ImageChops, ImageDraw, ImageFont            # p
 
 import roman
 
-from uplib.plibUtil import false, true, Error, note, configurator, set_verbosity, subproc, update_metadata, read_metadata
+from uplib.plibUtil import false, true, Error, note, configurator, set_verbosity, update_metadata, read_metadata, uthread
 from uplib.ripper import Ripper
 from uplib.newFolder import AbortDocumentIncorporation
+from uplib.tiffpages import tiff_pages, tiff_page_count
 
-TIFFSPLIT = None
-TIFFCP = None
-TIFF_SPLIT_CMD = None
 THUMBNAIL_TYPE = None
 NUMBERING_FONT = None
 LEGEND_FONT = None
@@ -63,6 +61,9 @@ MAX_SCALING_FACTOR = 0.33
 # CONSTANT_AREA_FACTOR is used as a divisor to scale down the constant-area size
 CONSTANT_AREA_FACTOR = 4.5
 
+# how many pages of a document to work on at once; set from "thumbnailing-threads"
+THUMBNAILING_THREADS = 1
+
 def load_font (fontname):
     if hasattr(ImageFont, "truetype") and fontname.lower().endswith(".ttf"):
         fnt = ImageFont.truetype(fontname, 14)
@@ -161,16 +162,34 @@ def figure_doc_size (tiff_file):
     im = Image.open(tiff_file)
     return im.size
 
-def figure_bbox (tiff_file, pageno, existing_bbox, skips):
-    if skips and pageno in skips:
-        return existing_bbox or None
-    im = Image.open(tiff_file)
+def page_bbox (tiff_file):
+    """Find the inked area of a page image.
+
+    :param tiff_file: the page image
+    :type tiff_file: filename, or PIL Image
+    :return: the bounding box of the non-white area of the page, or None if the page is blank, \
+             and the size of the page
+    :rtype: ((left, top, right, bottom), (width, height))
+    """
+    if isinstance(tiff_file, Image.Image):
+        im = tiff_file
+    else:
+        im = Image.open(tiff_file)
+    size = im.size
     im = ImageOps.autocontrast(im.convert('L')) # in case the background is not *quite* white
     im = ImageChops.invert(im)  # we need our white background to be 0, not 255
-    bbox = im.getbbox()
+    return im.getbbox(), size
+
+def merge_bbox (existing_bbox, bbox, size):
+    """Combine the bounding box of one page with that of the pages before it.
+
+    :param existing_bbox: the bounding box so far, or None
+    :param bbox: the bounding box of this page, as from ``page_bbox``
+    :param size: the size of this page
+    :return: the combined bounding box
+    """
     if bbox:
         left, top, right, bottom = bbox
-        note(4, "    bbox for page %s is %s", pageno, bbox)
     if existing_bbox and bbox and (left > existing_bbox[0]):
         left = existing_bbox[0]
     if existing_bbox and bbox and (top > existing_bbox[1]):
@@ -179,7 +198,15 @@ def figure_bbox (tiff_file, pageno, existing_bbox, skips):
         right = existing_bbox[2]
     if existing_bbox and bbox and (bottom < existing_bbox[3]):
         bottom = existing_bbox[3]
-    return (bbox and (left, top, right, bottom)) or existing_bbox or (0, 0, im.size[0], im.size[1])
+    return (bbox and (left, top, right, bottom)) or existing_bbox or (0, 0, size[0], size[1])
+
+def figure_bbox (tiff_file, pageno, existing_bbox, skips):
+    if skips and pageno in skips:
+        return existing_bbox or None
+    bbox, size = page_bbox(tiff_file)
+    if bbox:
+        note(4, "    bbox for page %s is %s", pageno, bbox)
+    return merge_bbox(existing_bbox, bbox, size)
         
 
 def add_page_no (im, location, page_no, boxed_width=None):
@@ -357,7 +384,10 @@ def create_thumbnail (tiff_file, tiff_dpi, output_dir, page_no, first_page, page
          str(maxwidth), str(maxheight), maxscaling, thumbnail_strategy)
     status = false
     try:
-        im = Image.open(tiff_file)
+        if isinstance(tiff_file, Image.Image):
+            im = tiff_file
+        else:
+            im = Image.open(tiff_file)
         if im.mode == "1":
             # bilevel
             im = ImageOps.grayscale(im.convert("L"))
@@ -586,155 +616,252 @@ def create_temporary_icons (metadata, dirpath, output_dir, params):
                                                             })
 
 
+def in_parallel (fn, arglists, nthreads):
+    """Call ``fn`` on each of ``arglists``, using up to ``nthreads`` threads,
+    and generate the results in the order of ``arglists``.  ``arglists`` may
+    be a generator; the next argument tuple is only taken from it when a thread
+    is ready to use it, so no more than ``nthreads`` are in hand at once.  If a
+    call (or ``arglists`` itself) raises an exception, it's re-raised here when
+    its result would have been generated.  Once the generator is closed or
+    discarded, no further calls are started, and closing it waits for those
+    already started to finish.
+
+    :param fn: function to call
+    :type fn: function
+    :param arglists: argument tuples for each call to ``fn``
+    :type arglists: iterable of tuples
+    :param nthreads: max number of calls to run at once
+    :type nthreads: int
+    :return: the results of the calls
+    :rtype: generator
+    """
+    if nthreads < 2:
+        for args in arglists:
+            yield fn(*args)
+        return
+
+    arglists = iter(arglists)
+    source_lock = threading.Lock()
+    condition = threading.Condition()
+    results = {}
+    state = { 'next' : 0, 'count' : None, 'running' : nthreads, 'stopped' : False }
+
+    def post(i, result, last=false):
+        condition.acquire()
+        try:
+            if result is not None:
+                results[i] = result
+            if last and (state['count'] is None):
+                state['count'] = i + ((result is not None) and 1 or 0)
+            condition.notifyAll()
+        finally:
+            condition.release()
+
+    def worker():
+        try:
+            while not state['stopped']:
+                source_lock.acquire()
+                try:
+                    if state['count'] is not None:
+                        return
+                    i = state['next']
+                    try:
+                        args = arglists.next()
+                    except StopIteration:
+                        post(i, None, true)
+                        return
+                    except:
+                        post(i, (false, sys.exc_info()), true)
+                        return
+                    state['next'] = i + 1
+                finally:
+                    source_lock.release()
+                try:
+                    result = (true, fn(*args))
+                except:
+                    result = (false, sys.exc_info())
+                del args
+                post(i, result)
+        finally:
+            condition.acquire()
+            try:
+                state['running'] -= 1
+                condition.notifyAll()
+            finally:
+                condition.release()
+
+    for i in range(nthreads):
+        uthread.start_new_thread(worker, (), name="page worker %d" % i)
+    try:
+        i = 0
+        while True:
+            condition.acquire()
+            try:
+                while (i not in results) and ((state['count'] is None) or (i < state['count'])):
+                    condition.wait()
+                if i not in results:
+                    return
+                succeeded, value = results.pop(i)
+            finally:
+                condition.release()
+            if not succeeded:
+                raise value[0], value[1], value[2]
+            yield value
+            i += 1
+    finally:
+        state['stopped'] = True
+        condition.acquire()
+        try:
+            while state['running'] > 0:
+                condition.wait()
+        finally:
+            condition.release()
+
+def thumbnail_page (tiff_file, tiff_dpi, output_dir, page_no, first_page, page_count, bbox, bbox_skips,
+                    maxwidth, maxheight, maxscaling, thumbnail_strategy, legend=None, page_no_string=None):
+    """Create the thumbnails for one page, as with ``create_thumbnail``.
+
+    :return: the big thumbnail size, the small thumbnail size, and (for page 0) the icon size
+    :rtype: ((int, int), (int, int), (int, int) or None)
+    """
+    big_thumbnail_size = []
+    small_thumbnail_size = []
+    icon_size = []
+    if not create_thumbnail(tiff_file, tiff_dpi, output_dir, page_no, first_page, page_count, bbox, bbox_skips,
+                            big_thumbnail_size, small_thumbnail_size, icon_size,
+                            maxwidth, maxheight, maxscaling, thumbnail_strategy, legend, page_no_string):
+        raise Error ("Can't create thumbnail for page %d in %s" % (page_no, tiff_file))
+    return tuple(big_thumbnail_size), tuple(small_thumbnail_size), (icon_size and icon_size[0]) or None
+
 def do_thumbnails (dirpath, output_dir, **params):
     note(2, "  thumbnailing in %s...", dirpath)
-    tmpdir = tempfile.mktemp()
     retval = params.get('returnvalue', false)
     doc_metadata_path = os.path.join(dirpath, "metadata.txt")
     try:
-        os.mkdir(tmpdir)
-        os.chmod(tmpdir, 0700)
-        try:
 
-            md = read_metadata(doc_metadata_path)
-            is_temporary_doc = md.get("temporary-contents")
-            if is_temporary_doc and (is_temporary_doc == "true"):
-                # temporary -- don't spend much time on this
-                create_temporary_icons (md, dirpath, output_dir, params)
-                retval = true
-                return
-
-            if os.path.exists(os.path.join(dirpath, "document.tiff")):
-                # contains one single-page TIFF file
-                tiffmaster = os.path.join(tmpdir, "master.tiff")
-                split_command = (TIFF_SPLIT_CMD
-                                 % (TIFFCP, os.path.join(dirpath, "document.tiff"), tiffmaster,
-                                    TIFFSPLIT, tiffmaster, os.path.join(tmpdir, "x")))
-                status, output, tsignal = subproc(split_command)
-                if status != 0:
-                    raise Error ("'%s' signals non-zero exit status %d in %s => %s"
-                                 % (split_command, status, dirpath, tmpdir))
-                parts_dir = tmpdir
-                filecheck_fn = lambda fn: fn[0] == "x"
-            elif (os.path.exists(os.path.join(dirpath, "page-images")) and
-                  os.path.isdir(os.path.join(dirpath, "page-images"))):
-                # contains directory full of PNG page images
-                parts_dir = os.path.join(dirpath, "page-images")
-                filecheck_fn = lambda fn: (fn.startswith('page') and fn.endswith('.png'))
-            else:
-                raise Error("No page images for document in %s" % dirpath)
-
-            tiff_parts = os.listdir(parts_dir)
-            if len(tiff_parts) < 1:
-                raise Error("No pages in split tiff file directory after split!")
-            # either a PNG-images or a TIFF split will sort properly in lexicographic order
-            tiff_parts.sort()
-
-            # see if there's a document icon legend and info about the DPI of the tiff file
-            legend = md.get('document-icon-legend')
-            tiff_dpi = int(md.get('images-dpi') or md.get('tiff-dpi') or params.get('images-dpi') or 0)
-            page_numbers_v = md.get('page-numbers')
-            page_numbers = (page_numbers_v and figure_page_numbers(page_numbers_v, dirpath))
-            first_page = int(md.get('first-page-number', 1))
-            skips = md.get('document-bbox-pages-to-skip', '')
-            if skips:
-                parts = string.split(skips, ':')
-                bbox_skips = []
-                for part in parts:
-                    bbox_skips = bbox_skips + map(int, string.split(part, ','))
-            else:
-                bbox_skips = None
+        md = read_metadata(doc_metadata_path)
+        is_temporary_doc = md.get("temporary-contents")
+        if is_temporary_doc and (is_temporary_doc == "true"):
+            # temporary -- don't spend much time on this
+            create_temporary_icons (md, dirpath, output_dir, params)
+            retval = true
+            return
+
+        tiff_path = os.path.join(dirpath, "document.tiff")
+        if os.path.exists(tiff_path):
+            # contains one multi-page TIFF file; the pages are decoded as they're needed
+            page_count = tiff_page_count(tiff_path)
+            docwidth, docheight = figure_doc_size(tiff_path)
+            pages = lambda: tiff_pages(tiff_path)
+        elif (os.path.exists(os.path.join(dirpath, "page-images")) and
+              os.path.isdir(os.path.join(dirpath, "page-images"))):
+            # contains directory full of PNG page images, which sort properly in lexicographic order
+            parts_dir = os.path.join(dirpath, "page-images")
+            parts = [os.path.join(parts_dir, fn) for fn in os.listdir(parts_dir)
+                     if (fn.startswith('page') and fn.endswith('.png'))]
+            parts.sort()
+            page_count = len(parts)
+            if page_count > 0:
+                docwidth, docheight = figure_doc_size(parts[0])
+            pages = lambda: iter(parts)
+        else:
+            raise Error("No page images for document in %s" % dirpath)
+        if page_count == 0:
+            raise Error("No pages in page images for document in %s" % dirpath)
+
+        # see if there's a document icon legend and info about the DPI of the tiff file
+        legend = md.get('document-icon-legend')
+        tiff_dpi = int(md.get('images-dpi') or md.get('tiff-dpi') or params.get('images-dpi') or 0)
+        page_numbers_v = md.get('page-numbers')
+        page_numbers = (page_numbers_v and figure_page_numbers(page_numbers_v, dirpath))
+        first_page = int(md.get('first-page-number', 1))
+        skips = md.get('document-bbox-pages-to-skip', '')
+        if skips:
+            parts = string.split(skips, ':')
+            bbox_skips = []
+            for part in parts:
+                bbox_skips = bbox_skips + map(int, string.split(part, ','))
+        else:
+            bbox_skips = None
 
-            # figure bounding box for imaged page
-            page_count = 0
+        # figure bounding box for imaged page
+        note(2, "    calculating bounding box for large pages...")
+        dont_crop = md.get('dont-crop-big-thumbnails', false)
+        if AUTO_CROP_BIG_THUMBNAILS and not dont_crop:
             bbox = None
-            note(2, "    calculating bounding box for large pages...")
-            dont_crop = md.get('dont-crop-big-thumbnails', false)
-            if AUTO_CROP_BIG_THUMBNAILS and not dont_crop:
-                do_bbox = true
-            else:
-                do_bbox = false
-            for tiff_part in tiff_parts:
-                if not filecheck_fn(tiff_part):
-                    continue
-                if page_count == 0:
-                    # find the width and height of the document
-                    docwidth, docheight = figure_doc_size(os.path.join(parts_dir, tiff_part))
-                    if not do_bbox:
-                        bbox = (0, 0, docwidth, docheight)
-                if do_bbox:
-                    bbox = figure_bbox (os.path.join(parts_dir, tiff_part), page_count, bbox, bbox_skips)
-                if (bbox and bbox[0] == 0) and (bbox[1] == 0) and (bbox[2] >= docwidth) and (bbox[3] >= docheight):
-                    # don't bother, there's no area to crop already
-                    do_bbox = false
-                page_count = page_count + 1
-            if page_count == 0:
-                raise Error("No pages in split tiff file directory after split!")
-            note(2, "      final bbox is %s, page_count is %d", bbox, page_count)
-
-            if USE_VIRTUAL_INK:
-                note(2, "      alpha channels will be added to large thumbnails...")
-
-            # now make the thumbnails
-            big_thumbnail_size = []
-            small_thumbnail_size = []
-            icon_size = []
-            page_index = 0
-            for tiff_part in tiff_parts:
-                if not filecheck_fn(tiff_part):
-                    note(3, "    skipping %s", tiff_part)
-                    continue
-                tiff_path = os.path.join(parts_dir, tiff_part)
-                if page_numbers:
-                    page_no_string = page_numbers.get(page_index)
-                else:
-                    page_no_string = None
-                note (2, "    page %d%s", page_index, (page_no_string and "   (%s)" % page_no_string) or "")
-                try:
-                    if not create_thumbnail(tiff_path, tiff_dpi, output_dir,
-                                            page_index, first_page, page_count, bbox, bbox_skips,
-                                            big_thumbnail_size, small_thumbnail_size, icon_size,
-                                            params.get('maxwidth'), params.get('maxheight'), params.get('maxscaling'),
-                                            params.get('thumbnail_strategy'), legend, page_no_string):
-                        raise Error ("Can't create thumbnail for page %d in %s (of %s)" % (page_index, tiff_path, dirpath))
-                except Exception, x:
-                    doc_id = os.path.split(dirpath)[1]
-                    note("exception creating thumbnails for page %d of document %s:\n%s", page_index, doc_id,
-                         string.join(traceback.format_exception(*sys.exc_info()), ""))
-                    raise AbortDocumentIncorporation(doc_id, str(x))
-
-                if page_index == 0:
-                    bt_width = big_thumbnail_size[0]
-                    bt_height = big_thumbnail_size[1]
-                    st_width = small_thumbnail_size[0]
-                    st_height = small_thumbnail_size[1]
-                else:
-                    bt_width = max(bt_width, big_thumbnail_size[0])
-                    bt_height = max(bt_height, big_thumbnail_size[1])
-                    st_width = max(st_width, small_thumbnail_size[0])
-                    st_height = max(st_height, small_thumbnail_size[1])
-                st_scaling = (float(st_width)/float(docwidth) + float(st_height)/float(docheight)) / 2.0
-                page_index = page_index + 1
-
-            d = {"page-count" : str(page_count),
-                 "tiff-width" : str(docwidth),
-                 "images-width" : str(docwidth),
-                 "images-size" : "%d,%d" % (docwidth, docheight),
-                 "cropping-bounding-box" : "%d,%d;%d,%d" % (bbox),
-                 "big-thumbnail-size" : "%s,%s" % (bt_width, bt_height),
-                 "small-thumbnail-size" : "%s,%s" % (st_width, st_height),
-                 "small-thumbnail-scaling" : "%f" % st_scaling,
-                 "icon-size" : "%d,%d" % icon_size[0],
-                 "images-height" : str(docheight),
-                 "tiff-height" : str(docheight) }
-
-            translation, scaling = thumbnail_translation_and_scaling(dirpath, d, false, true)
-            d["big-thumbnail-translation-points"] = "%f,%f" % translation
-            d["big-thumbnail-scaling-factor"] = "%f,%f" % scaling
-            update_metadata(os.path.join(dirpath, "metadata.txt"), d)
+            measure = lambda page_index, page: (page_index, page_bbox(page))
+            bboxes = in_parallel(measure, ((page_index, page) for page_index, page in enumerate(pages())
+                                           if not (bbox_skips and page_index in bbox_skips)),
+                                 THUMBNAILING_THREADS)
+            try:
+                for page_index, (pbbox, psize) in bboxes:
+                    if pbbox:
+                        note(4, "    bbox for page %s is %s", page_index, pbbox)
+                    bbox = merge_bbox(bbox, pbbox, psize)
+                    if (bbox[0] == 0) and (bbox[1] == 0) and (bbox[2] >= docwidth) and (bbox[3] >= docheight):
+                        # don't bother, there's no area to crop already
+                        break
+            finally:
+                bboxes.close()
+        else:
+            bbox = (0, 0, docwidth, docheight)
+        note(2, "      final bbox is %s, page_count is %d", bbox, page_count)
 
-        finally:
-            shutil.rmtree(tmpdir)
+        if USE_VIRTUAL_INK:
+            note(2, "      alpha channels will be added to large thumbnails...")
+
+        # now make the thumbnails, several pages at a time
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+            os.chmod(output_dir, 0700)
+        note(2, "    creating thumbnails for %d pages, %d at a time...", page_count, min(page_count, THUMBNAILING_THREADS))
+        page_no_strings = [(page_numbers and page_numbers.get(page_index)) or None for page_index in range(page_count)]
+        jobs = ((page, tiff_dpi, output_dir, page_index, first_page, page_count, bbox, bbox_skips,
+                 params.get('maxwidth'), params.get('maxheight'), params.get('maxscaling'),
+                 params.get('thumbnail_strategy'), legend, page_no_strings[page_index])
+                for page_index, page in enumerate(pages()))
+        thumbnails = in_parallel(thumbnail_page, jobs, THUMBNAILING_THREADS)
+        page_index = 0
+        try:
+            try:
+                for big_thumbnail_size, small_thumbnail_size, page_icon_size in thumbnails:
+                    note (2, "    page %d%s", page_index,
+                          (page_no_strings[page_index] and "   (%s)" % page_no_strings[page_index]) or "")
+                    if page_index == 0:
+                        bt_width, bt_height = big_thumbnail_size
+                        st_width, st_height = small_thumbnail_size
+                        icon_size = page_icon_size
+                    else:
+                        bt_width = max(bt_width, big_thumbnail_size[0])
+                        bt_height = max(bt_height, big_thumbnail_size[1])
+                        st_width = max(st_width, small_thumbnail_size[0])
+                        st_height = max(st_height, small_thumbnail_size[1])
+                    page_index = page_index + 1
+            finally:
+                thumbnails.close()
+        except Exception, x:
+            doc_id = os.path.split(dirpath)[1]
+            note("exception creating thumbnails for page %d of document %s:\n%s", page_index, doc_id,
+                 string.join(traceback.format_exception(*sys.exc_info()), ""))
+            raise AbortDocumentIncorporation(doc_id, str(x))
+        st_scaling = (float(st_width)/float(docwidth) + float(st_height)/float(docheight)) / 2.0
+
+        d = {"page-count" : str(page_count),
+             "tiff-width" : str(docwidth),
+             "images-width" : str(docwidth),
+             "images-size" : "%d,%d" % (docwidth, docheight),
+             "cropping-bounding-box" : "%d,%d;%d,%d" % (bbox),
+             "big-thumbnail-size" : "%s,%s" % (bt_width, bt_height),
+             "small-thumbnail-size" : "%s,%s" % (st_width, st_height),
+             "small-thumbnail-scaling" : "%f" % st_scaling,
+             "icon-size" : "%d,%d" % icon_size,
+             "images-height" : str(docheight),
+             "tiff-height" : str(docheight) }
+
+        translation, scaling = thumbnail_translation_and_scaling(dirpath, d, false, true)
+        d["big-thumbnail-translation-points"] = "%f,%f" % translation
+        d["big-thumbnail-scaling-factor"] = "%f,%f" % scaling
+        update_metadata(os.path.join(dirpath, "metadata.txt"), d)
 
         # indicate successful completion
         note(2, "  finished.")
@@ -746,17 +873,14 @@ def do_thumbnails (dirpath, output_dir, **params):
 
 def update_configuration():
 
-    global TIFFSPLIT, TIFFCP, THUMBNAIL_TYPE, TIFF_SPLIT_CMD, NUMBERING_FONT, LEGEND_FONT, PREVIOUS_ICON, NEXT_ICON, MAX_SCALING_FACTOR
+    global THUMBNAIL_TYPE, NUMBERING_FONT, LEGEND_FONT, PREVIOUS_ICON, NEXT_ICON, MAX_SCALING_FACTOR
     global PAGEIMAGE_MAXWIDTH, PAGEIMAGE_MAXHEIGHT, TOP_ICON, CONSTANT_AREA_FACTOR, USE_VIRTUAL_INK, UNDER_CONSTRUCTION
-    global AUTO_CROP_BIG_THUMBNAILS, DISTORT_VERY_SMALL_THUMBNAILS
+    global AUTO_CROP_BIG_THUMBNAILS, DISTORT_VERY_SMALL_THUMBNAILS, THUMBNAILING_THREADS
 
     note(3, "in createThumbnails.update_configuration()")
 
     conf = configurator.default_configurator()
 
-    TIFFSPLIT = conf.get("tiffsplit")
-    TIFFCP = conf.get("tiffcp")
-    TIFF_SPLIT_CMD = conf.get("tiff-split-command")
     THUMBNAIL_TYPE = conf.get("thumbnail-strategy", "log-area")
     NUMBERING_FONT = conf.get("numbering-font-file")
     LEGEND_FONT = conf.get("legend-font-file")
@@ -767,6 +891,8 @@ def update_configuration():
       raise IOError("No previous-page-icon-file parameter in site.config nor .uplibrc")
     try:
       PREVIOUS_ICON = Image.open(previous_page_icon_file)
+      # load it now, rather than lazily in whichever page-thumbnailing thread uses it first
+      PREVIOUS_ICON.load()
     except IOError:
       note(0, "Could not load %s as an image." % previous_page_icon_file);
       note(0, "Aborting update_configuration!")
@@ -778,6 +904,7 @@ def update_configuration():
       raise IOError("No next-page-icon-file parameter in config")
     try:
       NEXT_ICON = Image.open(next_page_icon_file)
+      NEXT_ICON.load()
     except IOError:
       note(0, "Could not load %s as an image." % next_page_icon_file);
       note(0, "Aborting update_configuration!")
@@ -792,6 +919,13 @@ def update_configuration():
     USE_VIRTUAL_INK = conf.get_bool("use-alpha-channel-thumbnails", false)
     AUTO_CROP_BIG_THUMBNAILS = conf.get_bool("auto-crop-big-thumbnails", true)
     DISTORT_VERY_SMALL_THUMBNAILS = conf.get_bool("keep-very-small-thumbnails", false)
+    THUMBNAILING_THREADS = conf.get_int("thumbnailing-threads") or 0
+    if THUMBNAILING_THREADS < 1:
+        try:
+            import multiprocessing
+            THUMBNAILING_THREADS = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            THUMBNAILING_THREADS = 1
     images_dir = os.path.join(conf.get("uplib-share"), "images")
     # UNDER_CONSTRUCTION = Image.open(os.path.join(images_dir, "swirl.png"))
                                
@@ -812,6 +946,10 @@ class ThumbnailRipper (Ripper):
 
         thumbnail_folder(self.repository(), location)
 
+    def declares_dependencies(self):
+        # only needs the page images and metadata
+        return True
+
     def rerun_after_metadata_changes (self, changed_fields=None):
         return (changed_fields and ("images-dpi" in changed_fields or
                                     "page-numbers" in changed_fields or
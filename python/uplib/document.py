@@ -23,10 +23,11 @@
 
 import shelve, os, sys, string, time, traceback, re, math, types, unicodedata, struct, weakref
 
-from uplib.plibUtil import true, false, note, lock_folder, unlock_folder, split_categories_string, subproc, Error, set_threaded, id_to_time, read_metadata, get_note_sink, uthread, parse_date
+from uplib.plibUtil import true, false, note, lock_folder, unlock_folder, split_categories_string, subproc, Error, set_threaded, id_to_time, get_note_sink, uthread, parse_date
 from uplib.plibUtil import update_metadata as p_update_metadata
 from uplib.webutils import parse_URL, http_post_multipart
 from uplib.links import read_links_file, Link, write_links_file
+from uplib.changefeed import METADATA
 
 CHARSET_PATTERN = re.compile(r"^Content-Type:\s*text/plain;\s*charset=([^)]*)\n", re.IGNORECASE)
 LANGUAGE_PATTERN = re.compile(r"^Content-Language:\s*(.*)\n", re.IGNORECASE)
@@ -45,8 +46,13 @@ def _reindex_document_folder(repo, folder, doc_id, changed_fields):
                 try:
                     if (ripper.rerun_after_metadata_changes(changed_fields=changed_fields)
                         or any([ripper.rerun_after_other_ripper(x.name()) for x in rerun])):
-                        note(4, "    re-running ripper %s on %s", ripper.name(), doc_id)
-                        ripper.rip(folder, doc_id)
+                        if isinstance(ripper, createIndexEntry.LuceneRipper):
+                            # batched with other pending edits, rather than indexed right now
+                            note(4, "    queueing %s for re-indexing", doc_id)
+                            repo.queue_for_indexing((doc_id,))
+                        else:
+                            note(4, "    re-running ripper %s on %s", ripper.name(), doc_id)
+                            ripper.rip(folder, doc_id)
                         rerun.append(ripper)
                 except:
                     note("Exception running %s on %s:\n%s", ripper, doc_id,
@@ -141,7 +147,7 @@ class Document (object):
         self.__category_strings = None
         self.__citation = None
         self.__date = None
-        self.__bboxes = {}
+        self.__page_text_index = None
         self.__links = {}
         self.__removed_links = {}
         self.__touch_time = None
@@ -464,6 +470,10 @@ class Document (object):
             oldvals = self.get_metadata().copy()
         try:
             self.__metadata = p_update_metadata(self.metadata_path(), newdict)
+            self.repo.metadata_cache().note_written(self.id, self.metadata_path(), self.__metadata)
+            self.repo.repository_index().note_changed(self)
+            self.repo.note_modified()
+            self.repo.changes().record(self.id, METADATA)
             self.__date = None
             self.__category_strings = None
             self.__citation = None
@@ -480,9 +490,7 @@ class Document (object):
 
     def get_metadata(self, tag=None):
         if self.__metadata == None:
-            mpath = self.metadata_path()
-            if os.path.exists(mpath):
-                self.__metadata = read_metadata (self.metadata_path())
+            self.__metadata = self.repo.metadata_cache().get(self.id, self.metadata_path())
         if tag:
             return self.__metadata and self.__metadata.get(tag)
         else:
@@ -522,31 +530,34 @@ class Document (object):
         return self.__category_strings
 
     def get_bboxes_for_page_index (self, index):
-        if not self.__bboxes.has_key(index):
-            import createPageBboxes
-            self.__bboxes[index] = createPageBboxes.get_page_bboxes(os.path.join(self.folder(), "thumbnails"), index)
-        return self.__bboxes[index]
+        # decoded pages are shared, and limited, across the whole repository
+        return self.repo.page_bboxes_cache().get(self, index)
 
     def get_bboxes_for_text_position (self, position):
-        for boxes in self.__bboxes.values():
-            if boxes.contains_text_pos(position):
-                return boxes
-        import createPageBboxes
-        boxes = createPageBboxes.find_page (os.path.join(self.folder(), "thumbnails"), position)
-        if boxes:
-            self.__bboxes[boxes.page_index] = boxes
-        return boxes
+        index = self.get_page_index_for_text_position(position)
+        if index is not None:
+            return self.get_bboxes_for_page_index(index)
+        return None
 
     def get_page_index_for_text_position (self, position):
-        bb = self.get_bboxes_for_text_position(position)
-        if bb:
-            return bb.page_index
-        else:
-            return None
+        import createPageBboxes
+        thumbnails = os.path.join(self.folder(), "thumbnails")
+        if self.__page_text_index is None:
+            # read once from the page table in the folder's bboxes store; False if there isn't one
+            self.__page_text_index = createPageBboxes.read_page_text_index(thumbnails) or False
+        if self.__page_text_index:
+            return self.__page_text_index.find(position)
+        boxes = createPageBboxes.find_page(thumbnails, position)
+        if boxes:
+            self.repo.page_bboxes_cache().add(self.id, boxes)
+            return boxes.page_index
+        return None
 
     def recache(self):
-        self.__bboxes = {}
+        self.__page_text_index = None
+        self.repo.page_bboxes_cache().discard(self.id)
         self.__metadata = None
+        self.repo.metadata_cache().discard(self.id)
         self.__date = None
         self.__category_strings = None
         self.__citation = None
@@ -28,12 +28,14 @@ __docformat__ = "restructuredtext"
 import sys, os, re, string, cgi, time, traceback, urllib, types, zipfile, tempfile, base64
 from xml.dom.minidom import getDOMImplementation
 
-from uplib.plibUtil import subproc, configurator, Error, read_metadata, true, false, note, update_metadata, split_categories_string, id_to_time, read_metadata, zipup, write_metadata, header_value_encode, Job
+from uplib.plibUtil import subproc, configurator, Error, read_metadata, true, false, note, update_metadata, split_categories_string, id_to_time, read_metadata, zipup_stream, write_metadata, header_value_encode, Job
 
 from uplib.webutils import HTTPCodes, parse_URL, http_post_multipart, htmlescape
 
 # for fetch_document_text
-from uplib.createPageBboxes import get_page_bboxes
+from uplib.createPageBboxes import get_page_bboxes, open_page_bboxes_store
+
+from uplib.newFolder import IncorporationBacklogged
 
 INTERACTION_CHARSET = "UTF-8"
 
@@ -71,6 +73,10 @@ def upload_document (repository, response, fields):
           optionally, a citation in some citation format for the document
         comment
           optionally, some text giving a comment on the document
+        priority
+          optionally, "interactive", "normal", or "bulk".  Documents with higher priority are
+          incorporated ahead of those with lower priority.  If the repository already has too
+          many documents waiting, the upload is refused with HTTP 503 (Service Unavailable).
     :return: the document ID for the new document
     :rtype: plain text string, or if XML is specified, an XML ``result`` element containing an ``id`` node with the ID as its text
     """
@@ -120,7 +126,11 @@ def upload_document (repository, response, fields):
         possibly_set(metadata, fields, "name")
 
         note(2, "Adding new document; len(bits) = %d, type='%s'", len(doc_bits), doc_type)
-        id = repository.create_new_document(doc_bits, doc_type, metadata)
+        try:
+            id = repository.create_new_document(doc_bits, doc_type, metadata, fields.get("priority"))
+        except IncorporationBacklogged, x:
+            response.error(HTTPCodes.SERVICE_UNAVAILABLE, "Too many documents waiting to be added; try again later (%s).\n" % x)
+            return
 
         # update the global list of categories
         categories_value = fields.has_key('categories') and fields['categories']
@@ -462,15 +472,14 @@ def fetch_folder (repository, response, params):
         response.error(HTTPCodes.NOT_FOUND, "Invalid doc_id %s specified.\n" % doc_id)
         return
     location = repository.doc_location(doc_id)
-    tfilename = zipup(location)
-    response.return_file("application/x-uplib-folder-zipped", tfilename, true)
+    response.return_stream("application/x-uplib-folder-zipped", zipup_stream(location))
 
 def repo_index (repository, response, params):
     """
     Fetch the repository index of the document.  This may have the usually harmless side-effect
-    of saving the repository, if no index for the repository has been created yet.
+    of writing the index file, if no index for the repository has been created yet.
 
-    :param modtime: Optional.  If supplied, and if the repository has not been modified since this time, this call wil return an HTTP "not modified" code, instead of the repository index.
+    :param modtime: Optional.  If supplied, and if the index has not been modified since this time, this call wil return an HTTP "not modified" code, instead of the repository index.
     :type modtime: a string containing a floating point number giving seconds past the Python (UNIX) epoch.
 
     :return: the repository index
@@ -478,17 +487,22 @@ def repo_index (repository, response, params):
 
     """
 
+    # the index is rewritten in the background a few seconds after the repository changes,
+    # so what matters to the client is whether the file has changed since it last fetched it
+    try:
+        fname = repository.repository_index().current_file()
+    except:
+        note(0, "Can't write repository index:\n%s", ''.join(traceback.format_exception(*sys.exc_info())))
+        fname = repository.repository_index().path
+
     modtime = params.get("modtime")
     if modtime is not None:
         modtime = float(modtime.strip())
         note("modtime is %s, repository.mod_time() is %s", modtime, repository.mod_time())
-        if repository.mod_time() <= modtime:
+        if os.path.exists(fname) and (os.path.getmtime(fname) <= modtime):
             response.error(HTTPCodes.NOT_MODIFIED, "Not modified since %s" % time.ctime(modtime))
             return
 
-    fname = os.path.join(repository.overhead_folder(), "index.upri")
-    if not os.path.exists(fname):
-        repository.save(force = True)
     if os.path.exists(fname):
         response.return_file("application/x-uplib-repository-index", fname, false)
     else:
@@ -548,9 +562,7 @@ def fetch_original (repository, response, params):
             #note("redirecting to /docs/%s/originals/%s" ,doc_id, master)
             response.redirect("/docs/%s/originals/%s" % (doc_id, master))
         else:
-            tfilename = zipup(originals_dir)
-            #note("returning zipfile %s", tfilename)
-            response.return_file("application/x-folder-zipped", tfilename, true)
+            response.return_stream("application/x-folder-zipped", zipup_stream(originals_dir))
     else:
         response.error(HTTPCodes.NOT_FOUND, "No originals for that document %s.\n" % doc_id)
 
@@ -707,12 +719,14 @@ def fetch_job_output (repo, response, params):
 def _accum_generator(doc, pages):
     pagecount = int(doc.get_metadata("page-count") or doc.get_metadata("pagecount"))
     first_page = True
+    thumbnails_dir = os.path.join(doc.folder(), "thumbnails")
+    store = open_page_bboxes_store(thumbnails_dir)
     for page_index in range(pagecount):
         if pages and (page_index not in pages):
             continue
         if (not first_page):
             yield 0          # signal pagebreak
-        pagedata = get_page_bboxes(os.path.join(doc.folder(), "thumbnails"), page_index)
+        pagedata = get_page_bboxes(thumbnails_dir, page_index, store)
         if pagedata:
             first_page = False
             accum = None
@@ -0,0 +1,271 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+An index of document content fingerprints (the ``sha-hash`` metadata value).
+
+Checking whether an uploaded document is already in the repository means
+finding a document with the same fingerprint.  Rather than running a
+``sha-hash:`` search, or re-hashing documents, we keep a map from doc ID to
+fingerprint, and the reverse, in memory, backed by a journal file in the
+``overhead`` folder.  It's updated from the repository's document watchers;
+a document which somehow has no fingerprint is hashed in a background
+thread, reading its files a chunk at a time.
+
+To compare two repositories without exchanging every fingerprint, the
+index can also summarize the fingerprints in buckets, by hex prefix:  each
+bucket's summary is a count and a digest of the fingerprints in it, so two
+repositories with the same summary for a bucket have the same documents
+there, and only the buckets which differ need to be looked into further.
+"""
+
+import os, sys, traceback, bisect, hashlib
+
+from uplib.plibUtil import note, MutexLock, uthread
+
+JOURNAL_FILENAME = "fingerprints.txt"
+
+class FingerprintIndex (object):
+
+    """Maps doc IDs to content fingerprints, and fingerprints to doc IDs."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.__path = os.path.join(repo.overhead_folder(), JOURNAL_FILENAME)
+        self.__by_doc = {}
+        self.__by_hash = {}
+        self.__lock = MutexLock("FingerprintIndex")
+        self.__journal_lines = 0
+        # the distinct fingerprints, sorted; rebuilt after a change, when a summary is asked for
+        self.__sorted = None
+
+    def __len__(self):
+        return len(self.__by_doc)
+
+    def __set(self, doc_id, fingerprint):
+        # called with the lock held
+        old = self.__by_doc.get(doc_id)
+        if old == fingerprint:
+            return False
+        if old is not None:
+            ids = self.__by_hash.get(old)
+            if ids:
+                ids.discard(doc_id)
+                if not ids:
+                    del self.__by_hash[old]
+        if fingerprint is None:
+            self.__by_doc.pop(doc_id, None)
+        else:
+            self.__by_doc[doc_id] = fingerprint
+            self.__by_hash.setdefault(fingerprint, set()).add(doc_id)
+        self.__sorted = None
+        return True
+
+    def __journal(self, line):
+        # called with the lock held
+        fp = open(self.__path, 'a')
+        try:
+            fp.write(line + "\n")
+        finally:
+            fp.close()
+        self.__journal_lines += 1
+
+    def add(self, doc_id, fingerprint):
+        """Record the fingerprint of a document.
+
+        :param doc_id: the document ID
+        :type doc_id: string
+        :param fingerprint: the document's fingerprint, as in its ``sha-hash`` metadata value
+        :type fingerprint: string
+        """
+        self.__lock.acquire()
+        try:
+            if self.__set(doc_id, fingerprint):
+                self.__journal("+ %s %s" % (doc_id, fingerprint))
+        finally:
+            self.__lock.release()
+
+    def remove(self, doc_id):
+        """Forget the fingerprint of a document."""
+        self.__lock.acquire()
+        try:
+            if self.__set(doc_id, None):
+                self.__journal("- %s" % doc_id)
+        finally:
+            self.__lock.release()
+
+    def lookup(self, fingerprint):
+        """
+        :param fingerprint: a content fingerprint, as from ``uplib.addDocument.calculate_originals_fingerprint``
+        :type fingerprint: string
+        :return: the IDs of the documents in the repository with that fingerprint
+        :rtype: list of strings
+        """
+        return [x for x in self.__by_hash.get(fingerprint, ()) if self.repo.valid_doc_id(x)]
+
+    def fingerprint(self, doc_id):
+        """
+        :return: the fingerprint of the document, or None if it's not known
+        :rtype: string
+        """
+        return self.__by_doc.get(doc_id)
+
+    def fingerprints(self):
+        """
+        :return: a copy of the mapping from doc ID to fingerprint
+        :rtype: dict
+        """
+        self.__lock.acquire()
+        try:
+            return self.__by_doc.copy()
+        finally:
+            self.__lock.release()
+
+    def __bucket(self, prefix):
+        # called with the lock held
+        if self.__sorted is None:
+            self.__sorted = sorted(self.__by_hash.keys())
+        # '~' sorts after all the hex digits
+        return self.__sorted[bisect.bisect_left(self.__sorted, prefix):
+                             bisect.bisect_left(self.__sorted, prefix + '~')]
+
+    def summary(self, prefixes):
+        """Summarize the fingerprints in some buckets, for comparison with another repository.
+
+        :param prefixes: the buckets, each one the fingerprints starting with that hex prefix; \
+               the empty prefix is all of them
+        :type prefixes: sequence of strings
+        :return: a mapping of prefix to the number of distinct fingerprints in the bucket, \
+                 and a digest of them
+        :rtype: dict mapping string to (int, string)
+        """
+        results = {}
+        self.__lock.acquire()
+        try:
+            for prefix in prefixes:
+                bucket = self.__bucket(prefix)
+                results[prefix] = (len(bucket), hashlib.sha1('\n'.join(bucket)).hexdigest())
+        finally:
+            self.__lock.release()
+        return results
+
+    def bucket_contents(self, prefixes):
+        """
+        :param prefixes: the buckets, as for ``summary``
+        :type prefixes: sequence of strings
+        :return: a mapping of each fingerprint in the buckets to the IDs of the documents with it
+        :rtype: dict mapping string to list of strings
+        """
+        results = {}
+        self.__lock.acquire()
+        try:
+            for prefix in prefixes:
+                for fingerprint in self.__bucket(prefix):
+                    results[fingerprint] = list(self.__by_hash[fingerprint])
+        finally:
+            self.__lock.release()
+        return results
+
+    # document watcher callbacks
+
+    def on_add(self, doc):
+        h = doc.get_metadata("sha-hash")
+        if h:
+            self.add(doc.id, h)
+        else:
+            # don't hold up whoever's adding the document
+            uthread.start_new_thread(self.__hash_doc, (doc,), name="fingerprint %s" % doc.id)
+
+    def on_delete(self, doc):
+        self.remove(doc.id)
+
+    def __hash_doc(self, doc):
+        try:
+            # sha_hash() also saves it in the document metadata
+            self.add(doc.id, doc.sha_hash())
+        except:
+            note(2, "Can't fingerprint %s:\n%s", doc.id, ''.join(traceback.format_exception(*sys.exc_info())))
+
+    # persistence
+
+    def __load(self):
+        if not os.path.exists(self.__path):
+            return
+        self.__lock.acquire()
+        try:
+            for line in open(self.__path, 'r'):
+                parts = line.split()
+                if len(parts) == 3 and parts[0] == '+':
+                    self.__set(parts[1], parts[2])
+                elif len(parts) == 2 and parts[0] == '-':
+                    self.__set(parts[1], None)
+                self.__journal_lines += 1
+        finally:
+            self.__lock.release()
+
+    def compact(self):
+        """Rewrite the journal to hold just the current fingerprints."""
+        self.__lock.acquire()
+        try:
+            tmpname = self.__path + ".new"
+            fp = open(tmpname, 'w')
+            try:
+                for doc_id, fingerprint in self.__by_doc.iteritems():
+                    fp.write("+ %s %s\n" % (doc_id, fingerprint))
+            finally:
+                fp.close()
+            if os.path.exists(self.__path):
+                os.unlink(self.__path)
+            os.rename(tmpname, self.__path)
+            self.__journal_lines = len(self.__by_doc)
+        finally:
+            self.__lock.release()
+
+    def fill_in(self, hash_missing=True):
+        """Add any documents missing from the index, and drop any which are no longer in the repository.
+
+        :param hash_missing: whether to calculate the fingerprints of documents \
+               which don't have one in their metadata
+        :type hash_missing: boolean
+        """
+        doc_ids = set(self.repo._generate_doc_ids())
+        for doc_id in set(self.__by_doc.keys()) - doc_ids:
+            self.remove(doc_id)
+        missing = [x for x in doc_ids if x not in self.__by_doc]
+        if missing:
+            note(2, "fingerprint index:  adding %d documents", len(missing))
+            for doc_id, h in self.repo.metadata_cache().values("sha-hash", missing).iteritems():
+                if h:
+                    self.add(doc_id, h)
+                elif hash_missing and self.repo.valid_doc_id(doc_id):
+                    self.__hash_doc(self.repo.get_document(doc_id))
+        if self.__journal_lines > (2 * len(self.__by_doc) + 100):
+            self.compact()
+
+    def start(self, background=True):
+        """Load the journal, and bring the index up to date with the repository.
+
+        :param background: if true, do the updating in a new thread; otherwise, do it \
+               now, but don't take the time to hash documents which have no fingerprint
+        :type background: boolean
+        """
+        self.__load()
+        if background:
+            uthread.start_new_thread(self.fill_in, (), name="fingerprint-index")
+        else:
+            self.fill_in(False)
@@ -0,0 +1,178 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Sprite sheets of document icons, for listing pages.
+
+A thumbnail listing shows an icon for every document on the page, and
+fetching each one separately means hundreds of requests for a big listing.
+Instead, the listing can lay the icons out on a single sprite sheet, and
+show each icon as a piece of the sheet's image.  The layout is figured when
+the page is generated, from the icon sizes in the documents' metadata, and
+saved in the ``overhead`` folder; the sheet image itself is built the first
+time it's asked for.  A sheet is named by a hash of its documents and the
+modification times of their icons, so a changed icon gets a new sheet
+rather than a stale one.  Only the most recent sheets are kept.
+"""
+
+import os, sys, hashlib, traceback
+
+from uplib.plibUtil import note, MutexLock
+
+SPRITES_FOLDER = "icon-sprites"
+
+# how many icons to put in each row of a sheet
+_ICONS_PER_ROW = 16
+
+class IconSprites (object):
+
+    """Lays out, builds, and keeps sprite sheets of document icons."""
+
+    def __init__(self, repo, max_sheets=100):
+        """
+        :param repo: the repository
+        :type repo: uplib.repository.Repository
+        :param max_sheets: how many sheets to keep on disk
+        :type max_sheets: int
+        """
+        self.repo = repo
+        self.max_sheets = max_sheets
+        self.__folder = os.path.join(repo.overhead_folder(), SPRITES_FOLDER)
+        self.__lock = MutexLock("IconSprites")
+
+    def __path(self, key, ext):
+        return os.path.join(self.__folder, key + ext)
+
+    def layout(self, docs):
+        """Figure the sprite sheet for the icons of a listing page.
+
+        :param docs: the documents on the page
+        :type docs: sequence of uplib.document.Document
+        :return: the name of the sheet, and a mapping of doc ID to the (x, y, width, height) \
+                 of its icon on the sheet; documents without an icon aren't on the sheet
+        :rtype: (string, dict)
+        """
+        cells = []
+        for doc in docs:
+            try:
+                mtime = os.path.getmtime(doc.icon_path())
+                width, height = doc.icon_size()
+            except (OSError, IOError):
+                continue
+            cells.append((doc.id, mtime, width, height))
+        if not cells:
+            return None, {}
+        key = hashlib.sha1('\n'.join(["%s %r %d %d" % cell for cell in cells])).hexdigest()
+        positions = {}
+        x = y = rowheight = 0
+        for i, (doc_id, mtime, width, height) in enumerate(cells):
+            if i and (i % _ICONS_PER_ROW) == 0:
+                x = 0
+                y += rowheight
+                rowheight = 0
+            positions[doc_id] = (x, y, width, height)
+            x += width
+            rowheight = max(rowheight, height)
+        layoutpath = self.__path(key, ".layout")
+        if not os.path.exists(layoutpath):
+            self.__lock.acquire()
+            try:
+                if not os.path.isdir(self.__folder):
+                    os.makedirs(self.__folder)
+                fp = open(layoutpath + ".new", 'w')
+                try:
+                    for doc_id, mtime, width, height in cells:
+                        fp.write("%s %d %d %d %d\n" % ((doc_id,) + positions[doc_id]))
+                finally:
+                    fp.close()
+                os.rename(layoutpath + ".new", layoutpath)
+                self.__prune()
+            finally:
+                self.__lock.release()
+        else:
+            # keep it from being pruned while it's in use
+            os.utime(layoutpath, None)
+        return key, positions
+
+    def __prune(self):
+        # called with the lock held
+        layouts = [x for x in os.listdir(self.__folder) if x.endswith(".layout")]
+        if len(layouts) <= self.max_sheets:
+            return
+        layouts.sort(key=lambda x: os.path.getmtime(os.path.join(self.__folder, x)))
+        for filename in layouts[:len(layouts) - self.max_sheets]:
+            key = filename[:-len(".layout")]
+            for ext in (".layout", ".png"):
+                if os.path.exists(self.__path(key, ext)):
+                    os.unlink(self.__path(key, ext))
+
+    def sheet(self, key, build=True):
+        """Find the image file for a sheet, building it if necessary.
+
+        :param key: the name of the sheet, as returned by ``layout``
+        :type key: string
+        :param build: whether to build the sheet's image if it hasn't been built yet
+        :type build: boolean
+        :return: the pathname of the sheet's PNG image, or None if there's no such sheet \
+                 (or, if ``build`` is false, if it hasn't been built yet)
+        :rtype: string
+        """
+        if (not key) or (not key.isalnum()):
+            return None
+        imagepath = self.__path(key, ".png")
+        if os.path.exists(imagepath):
+            return imagepath
+        layoutpath = self.__path(key, ".layout")
+        if (not build) or (not os.path.exists(layoutpath)):
+            return None
+        self.__lock.acquire()
+        try:
+            if not os.path.exists(imagepath):
+                self.__build(layoutpath, imagepath)
+        finally:
+            self.__lock.release()
+        return imagepath
+
+    def __build(self, layoutpath, imagepath):
+        from PIL import Image
+
+        cells = []
+        for line in open(layoutpath, 'r'):
+            parts = line.split()
+            if len(parts) == 5:
+                cells.append((parts[0],) + tuple([int(x) for x in parts[1:]]))
+        width = max([x + w for doc_id, x, y, w, h in cells] or [1])
+        height = max([y + h for doc_id, x, y, w, h in cells] or [1])
+        sheet = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        for doc_id, x, y, w, h in cells:
+            if not self.repo.valid_doc_id(doc_id):
+                continue
+            try:
+                icon = Image.open(self.repo.get_document(doc_id).icon_path())
+                icon.load()
+                if icon.mode not in ("RGB", "RGBA"):
+                    icon = icon.convert("RGBA")
+                if icon.size != (w, h):
+                    icon = icon.resize((w, h), Image.ANTIALIAS)
+                sheet.paste(icon, (x, y))
+            except:
+                note(2, "can't add the icon of %s to sprite sheet %s:\n%s", doc_id, imagepath,
+                     ''.join(traceback.format_exception(*sys.exc_info())))
+        sheet.save(imagepath + ".new", "PNG")
+        os.rename(imagepath + ".new", imagepath)
+        note(3, "built icon sprite sheet %s with %d icons", imagepath, len(cells))
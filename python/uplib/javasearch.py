@@ -0,0 +1,195 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+A long-running Java search process, used when PyLucene isn't available.
+
+Rather than starting a new JVM (and re-opening the Lucene index) for every
+query, we start ``LuceneIndexing INDEXDIR serve`` once and talk to it over
+a pipe.  Each request is a single line, ``OPERATION QUERY``; the reply is the
+same set of lines the one-shot search command would print, followed by a line
+containing only a period.  The Java side keeps its IndexSearcher open, and
+re-opens it only when the index has been modified.  If the process dies, it's
+restarted on the next query.
+"""
+
+import os, sys, re, time, subprocess, traceback
+
+from uplib.plibUtil import note, configurator, MutexLock, Error
+
+_END_OF_RESULTS = "."
+
+class SearchServer (object):
+
+    """A persistent ``LuceneIndexing`` search process for a single index."""
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.process = None
+        self.command = None
+        self.started = 0
+        self.restarts = 0
+        self.lock = MutexLock("SearchServer")
+
+    def __str__(self):
+        return "<SearchServer %s %s>" % (self.repository.index_path(),
+                                          (self.process and ("pid %s" % self.process.pid)) or "(not running)")
+
+    def __repr__(self):
+        return self.__str__()
+
+    def enabled(conf=None):
+        """Is the search server configured for use?
+
+        :param conf: configurator to use; defaults to the default configurator
+        :type conf: uplib.plibUtil.configurator
+        :return: whether we should use a persistent search server
+        :rtype: boolean
+        """
+        conf = conf or configurator.default_configurator()
+        return (conf.get_bool("use-java-search-server", True) and
+                bool(conf.get("indexing-search-server-command")))
+    enabled = staticmethod(enabled)
+
+    def running(self):
+        return (self.process is not None) and (self.process.poll() is None)
+
+    def _figure_command(self):
+
+        conf = configurator.default_configurator()
+        INDEXING_SEARCH_SERVER_CMD = conf.get("indexing-search-server-command")
+        JAVA = conf.get("java")
+        LUCENE_JAR = conf.get("lucene-jarfile")
+        INDEXING_JAR = conf.get("uplib-indexing-jarfile")
+        search_terms = conf.get("search-properties")
+        search_operator = conf.get("search-default-operator")
+        search_abbrevs = conf.get("search-abbreviations")
+        quote = (not sys.platform.lower().startswith("win")) and "'" or ""
+        if search_terms:
+            searchterms = "%s-Dcom.parc.uplib.indexing.defaultSearchProperties=%s%s" % (quote, search_terms, quote)
+        else:
+            searchterms = ""
+        if search_abbrevs:
+            searchterms += " %s-Dcom.parc.uplib.indexing.userAbbrevs=%s%s" % (quote, search_abbrevs, quote)
+        if search_operator and (search_operator.lower() in ("or", "and")):
+            searchops = " %s-Dcom.parc.uplib.indexing.defaultSearchOperator=%s%s" % (quote, search_operator, quote)
+            searchops += " %s-Dcom.parc.uplib.indexing.defaultPageSearchOperator=%s%s" % (quote, search_operator, quote)
+        else:
+            searchops = ""
+        try:
+            return INDEXING_SEARCH_SERVER_CMD % (JAVA, searchterms, searchops, INDEXING_JAR, LUCENE_JAR,
+                                                 self.repository.index_path())
+        except TypeError:
+            raise Error("Unable to format the search server command.  "
+                        "INDEXING_SEARCH_SERVER_CMD = " + INDEXING_SEARCH_SERVER_CMD + ".  "
+                        "6 arguments provided.  Perhaps the "
+                        "'indexing-search-server-command' parameter in your configuration file is out of date?")
+
+    def _start(self):
+        self.command = self._figure_command()
+        logfile = open(os.path.join(self.repository.overhead_folder(), "search-server.log"), "a")
+        try:
+            note(3, "Starting search server: %s", self.command)
+            self.process = subprocess.Popen(self.command, shell=True, bufsize=0,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=logfile,
+                                            close_fds=(not sys.platform.lower().startswith("win")))
+        finally:
+            # the child has its own copy now
+            logfile.close()
+        self.started = time.time()
+        note(2, "started search server %s", self)
+
+    def _stop(self):
+        p = self.process
+        self.process = None
+        if p is None:
+            return
+        try:
+            p.stdin.close()
+        except:
+            pass
+        try:
+            if p.poll() is None:
+                # give it a moment to notice EOF, then get rough
+                time.sleep(0.1)
+                if p.poll() is None and hasattr(p, "terminate"):
+                    p.terminate()
+            p.wait()
+        except:
+            note(3, "stopping search server:\n%s", ''.join(traceback.format_exception(*sys.exc_info())))
+        try:
+            p.stdout.close()
+        except:
+            pass
+
+    def _request(self, search_operation, query_string):
+        self.process.stdin.write("%s %s\n" % (search_operation, query_string))
+        self.process.stdin.flush()
+        lines = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise IOError("search server %s exited unexpectedly" % self)
+            line = line.rstrip("\r\n")
+            if line == _END_OF_RESULTS:
+                break
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def search(self, search_operation, query_string):
+        """Run a query, starting (or restarting) the server process if necessary.
+
+        :param search_operation: one of "search", "pagesearch", or "bothsearch"
+        :type search_operation: string
+        :param query_string: an UpLib/Lucene query
+        :type query_string: string
+        :return: the command line of the server, and the output for the query \
+                 in the same format as the one-shot search command
+        :rtype: (string, string)
+        """
+        if isinstance(query_string, unicode):
+            query_string = query_string.encode("UTF-8")
+        # the protocol is line-oriented
+        query_string = re.sub(r'[\r\n]+', ' ', query_string)
+        self.lock.acquire()
+        try:
+            for attempt in (1, 2):
+                if not self.running():
+                    if self.process is not None:
+                        note(0, "search server %s exited with status %s; restarting", self, self.process.returncode)
+                        self.restarts += 1
+                    self._stop()
+                    self._start()
+                try:
+                    return self.command, self._request(search_operation, query_string)
+                except (IOError, OSError), x:
+                    note(0, "search server %s failed on query <%s>: %s", self, query_string, x)
+                    self._stop()
+                    if attempt > 1:
+                        raise Error("search server failed attempting to run query <%s> in %s: %s" %
+                                    (query_string, self.repository.name(), x))
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """Shut down the server process, if it's running."""
+        self.lock.acquire()
+        try:
+            self._stop()
+        finally:
+            self.lock.release()
@@ -52,6 +52,9 @@ if _have_guess_language:
         def provides(self):
             return "GuessLanguage"
 
+        def declares_dependencies(self):
+            return True
+
         def rip (self, location, doc_id):
 
             textbytes, charset, language = self.get_folder_text_bytes(location)
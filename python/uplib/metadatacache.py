@@ -0,0 +1,241 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+A repository-wide cache of document metadata.
+
+Each document's ``metadata.txt`` file is parsed at most once, and the
+result is kept along with the file's modification time and size.  Looking
+up a document's metadata, singly or through the bulk accessors (``values``,
+``page_counts``, ``dates``, ``authors``), costs one ``stat`` call to check
+that the record is still current, so listing or sorting a large repository
+doesn't read one file per document, but still notices metadata written
+behind the cache's back, as by rippers.  Records are replaced when a
+document's metadata is changed through ``Document.update_metadata``, and
+dropped when the document is re-cached or deleted, or when the background
+check finds the file has changed.
+
+The cache is saved to a single snapshot file in the ``overhead`` folder
+whenever the repository is saved, and read back in at startup.
+"""
+
+import os, sys, traceback, cPickle
+
+from uplib.plibUtil import note, read_metadata, parse_date, MutexLock, uthread
+
+SNAPSHOT_FILENAME = "metadata-cache.pickle"
+
+# bump this if the record format changes
+_SNAPSHOT_VERSION = 1
+
+# the same few dozen keys appear in every record, so share them
+_KEYS = {}
+
+def _share_keys(md):
+    return dict([(_KEYS.setdefault(key, key), value) for key, value in md.iteritems()])
+
+class MetadataCache (object):
+
+    """Maps doc ID to (mtime, size, metadata-dict) for the documents of a repository."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.__records = {}
+        self.__dirty = False
+        self.__lock = MutexLock("MetadataCache")
+        self.__snapshot_path = os.path.join(repo.overhead_folder(), SNAPSHOT_FILENAME)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__records)
+
+    def __read(self, doc_id, path, st=None):
+        if st is None:
+            st = os.stat(path)
+        md = _share_keys(read_metadata(path))
+        self.__records[doc_id] = (st.st_mtime, st.st_size, md)
+        self.__dirty = True
+        self.misses += 1
+        return md
+
+    def get(self, doc_id, path=None):
+        """Return the metadata for a document, re-reading ``metadata.txt`` if it has changed.
+
+        :param doc_id: the document ID
+        :type doc_id: string
+        :param path: the location of the document's metadata file; defaults to \
+               ``metadata.txt`` in the document's folder
+        :type path: string
+        :return: the document's metadata, or None if it has no metadata file
+        :rtype: dict
+        """
+        path = path or os.path.join(self.repo.doc_location(doc_id), "metadata.txt")
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.discard(doc_id)
+            return None
+        record = self.__records.get(doc_id)
+        if record and (record[0] == st.st_mtime) and (record[1] == st.st_size):
+            self.hits += 1
+            return record[2]
+        return self.__read(doc_id, path, st)
+
+    def note_written(self, doc_id, path, metadata):
+        """Record metadata which has just been written to ``path``, so that it needn't be re-read.
+
+        :param doc_id: the document ID
+        :type doc_id: string
+        :param path: the metadata file which was written
+        :type path: string
+        :param metadata: the full metadata now in that file
+        :type metadata: dict
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.discard(doc_id)
+        else:
+            self.__records[doc_id] = (st.st_mtime, st.st_size, metadata)
+            self.__dirty = True
+
+    def discard(self, doc_id):
+        """Drop any cached record for the document."""
+        if self.__records.pop(doc_id, None) is not None:
+            self.__dirty = True
+
+    def values(self, key, doc_ids=None):
+        """Return the value of one metadata field for many documents.
+
+        :param key: the metadata field name
+        :type key: string
+        :param doc_ids: the documents to look at; defaults to all the documents in the repository
+        :type doc_ids: sequence of doc ID strings
+        :return: mapping of doc ID to the field value, or None if the document doesn't have that field
+        :rtype: dict
+        """
+        if doc_ids is None:
+            doc_ids = self.repo._generate_doc_ids()
+        result = {}
+        for doc_id in doc_ids:
+            md = self.get(doc_id)
+            result[doc_id] = md and md.get(key)
+        return result
+
+    def page_counts(self, doc_ids=None):
+        """
+        :return: mapping of doc ID to the number of pages in the document
+        :rtype: dict
+        """
+        if doc_ids is None:
+            doc_ids = self.repo._generate_doc_ids()
+        result = {}
+        for doc_id in doc_ids:
+            md = self.get(doc_id) or {}
+            # the same precedence as the stats page has always used
+            count = md.get("pagecount") or md.get("page-count")
+            try:
+                result[doc_id] = int(count or 1)
+            except ValueError:
+                result[doc_id] = 1
+        return result
+
+    def dates(self, doc_ids=None):
+        """
+        :return: mapping of doc ID to the parsed publication date, as from ``uplib.plibUtil.parse_date``
+        :rtype: dict
+        """
+        return dict([(doc_id, (d and parse_date(d)) or None)
+                     for doc_id, d in self.values("date", doc_ids).items()])
+
+    def authors(self, doc_ids=None):
+        """
+        :return: mapping of doc ID to the list of authors of the document
+        :rtype: dict
+        """
+        return dict([(doc_id, (a and [x.strip() for x in a.split(" and ")]) or [])
+                     for doc_id, a in self.values("authors", doc_ids).items()])
+
+    def revalidate(self):
+        """Check every record against its metadata file, dropping those which have changed.
+        Run in the background at startup to catch edits made while the repository was stopped.
+        """
+        stale = 0
+        for doc_id, record in self.__records.items():
+            path = os.path.join(self.repo.doc_location(doc_id), "metadata.txt")
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if (st is None) or (record[0] != st.st_mtime) or (record[1] != st.st_size):
+                self.discard(doc_id)
+                stale += 1
+        note(3, "metadata cache:  %d of %d records were out of date", stale, stale + len(self.__records))
+
+    def load(self):
+        """Read in the snapshot saved by a previous run, if any."""
+        if not os.path.exists(self.__snapshot_path):
+            return
+        try:
+            fp = open(self.__snapshot_path, 'rb')
+            try:
+                version, records = cPickle.load(fp)
+            finally:
+                fp.close()
+            if version != _SNAPSHOT_VERSION:
+                note(2, "ignoring metadata cache snapshot with version %s", version)
+                return
+            for doc_id, (mtime, size, md) in records.iteritems():
+                self.__records[doc_id] = (mtime, size, _share_keys(md))
+            note(3, "loaded %d metadata records from %s", len(records), self.__snapshot_path)
+        except:
+            note(0, "Can't read metadata cache snapshot %s:\n%s", self.__snapshot_path,
+                 ''.join(traceback.format_exception(*sys.exc_info())))
+
+    def save(self):
+        """Write a snapshot of the cache to the overhead folder, if it has changed."""
+        if not self.__dirty:
+            return
+        self.__lock.acquire()
+        try:
+            self.__dirty = False
+            tmpname = self.__snapshot_path + ".new"
+            fp = open(tmpname, 'wb')
+            try:
+                cPickle.dump((_SNAPSHOT_VERSION, self.__records.copy()), fp, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                fp.close()
+            if os.path.exists(self.__snapshot_path):
+                os.unlink(self.__snapshot_path)
+            os.rename(tmpname, self.__snapshot_path)
+        finally:
+            self.__lock.release()
+
+    def start(self, background=True):
+        """Load the snapshot, and check it against the documents.
+
+        :param background: if true, do the checking in a new thread
+        :type background: boolean
+        """
+        self.load()
+        if self.__records:
+            if background:
+                uthread.start_new_thread(self.revalidate, (), name="metadata-cache-check")
+            else:
+                self.revalidate()
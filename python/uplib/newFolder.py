@@ -22,9 +22,9 @@
 # folders.
 #
 
-import re, os, sys, string, time, shutil, tempfile, stat, traceback, StringIO, Queue, threading
+import re, os, sys, string, time, shutil, tempfile, stat, traceback, StringIO, threading, heapq
 
-from uplib.plibUtil import false, true, Error, note, configurator, lock_folder, unlock_folder, subproc, update_metadata, read_metadata, DOC_ID_RE, unzip, uthread
+from uplib.plibUtil import false, true, Error, note, configurator, lock_folder, unlock_folder, subproc, update_metadata, read_metadata, write_metadata, DOC_ID_RE, unzip, uthread
 from uplib.createIndexEntry import remove_from_index
 # import uplib.code_timer as code_timer
 
@@ -55,6 +55,15 @@ class AbortDocumentIncorporation (Error):
         self.id = id
         self.message = msg
 
+############################################################
+###
+###  Exception to raise when too many documents are waiting
+###
+############################################################
+
+class IncorporationBacklogged (Error):
+    pass
+
 ############################################################
 ###
 ###  Functions
@@ -278,29 +287,151 @@ def note_error (folderpath, e):
     fp.close()    
 
 
+############################################################
+###
+###  Per-stage concurrency limits
+###
+############################################################
+
+_STAGE_LIMITS = None
+
+def _stage_limit (stage):
+    """Return a semaphore limiting how many documents may be in the named stage
+    at once, or None if there's no limit.  Stages are "unpack", and the class
+    name of each ripper; limits come from the "incorporation-stage-limits"
+    configuration option, e.g. ``unpack:2, ThumbnailRipper:2, LuceneRipper:1``."""
+    global _STAGE_LIMITS
+    if _STAGE_LIMITS is None:
+        limits = {}
+        v = configurator.default_configurator().get("incorporation-stage-limits")
+        if v:
+            for part in [x.strip() for x in v.split(",") if x.strip()]:
+                try:
+                    name, count = [x.strip() for x in part.split(":")]
+                    limits[name] = threading.BoundedSemaphore(max(1, int(count)))
+                except ValueError:
+                    note("Bad entry '%s' in incorporation-stage-limits", part)
+        _STAGE_LIMITS = limits
+    return _STAGE_LIMITS.get(stage)
+
+def _in_stage (stage, fn, *args):
+    limit = _stage_limit(stage)
+    if limit:
+        limit.acquire()
+    try:
+        return fn(*args)
+    finally:
+        if limit:
+            limit.release()
+
+def _max_simultaneous_rippers (repo):
+    n = repo.get_param("max-simultaneous-rippers") or configurator.default_configurator().get("max-simultaneous-rippers")
+    if n:
+        return max(1, int(n))
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _write_ripper_timings (folderpath, rippers, timings):
+    fp = open(os.path.join(folderpath, "ripper-timings.txt"), 'w')
+    try:
+        for ripper in rippers:
+            if ripper.name() in timings:
+                fp.write("%s: %.3f\n" % (ripper.name(), timings[ripper.name()]))
+    finally:
+        fp.close()
+
 def _run_rippers (folderpath, repo, id):
 
+    # Rippers are run as soon as all the rippers they depend on (see
+    # uplib.ripper.ripper_prerequisites) have finished, up to
+    # "max-simultaneous-rippers" at a time.  RIPPING always names the earliest
+    # ripper (in ripper-list order) which hasn't finished, or, after a failure,
+    # the ripper which failed.
+
+    from uplib.ripper import ripper_prerequisites
+
     rippers = repo.rippers()
-    lock_folder(folderpath)
-    try:
-        which_ripper = os.path.join(folderpath, "RIPPING")
+    prereqs = ripper_prerequisites(rippers)
+    max_running = _max_simultaneous_rippers(repo)
+    condition = threading.Condition()
+    started = set()
+    finished = set()
+    timings = {}
+    failures = []
+
+    def _rip_one (index):
+        ripper = rippers[index]
+        t = time.time()
         try:
-            for ripper in rippers:
+            try:
                 note("%s:  running ripper %s", id, str(ripper))
-                fp = open(which_ripper, 'wb')
-                fp.write(ripper.__class__.__name__)
-                fp.close()
+                _in_stage(ripper.name(), ripper.rip, folderpath, id)
+            except:
+                condition.acquire()
                 try:
-    #                 if CODETIMER_ON:
-    #                     code_timer.StartInt("newFolder$ripping-%s" % ripper.name(), "uplib")
-
-                    ripper.rip(folderpath, id)
-
+                    failures.append((index, sys.exc_info()))
                 finally:
+                    condition.release()
+        finally:
+            condition.acquire()
+            try:
+                timings[ripper.name()] = time.time() - t
+                finished.add(index)
+                condition.notifyAll()
+            finally:
+                condition.release()
+
+    def _note_current_ripper (index):
+        fp = open(which_ripper, 'wb')
+        fp.write(rippers[index].__class__.__name__)
+        fp.close()
 
-                    pass
-    #                 if CODETIMER_ON:
-    #                     code_timer.StopInt("newFolder$ripping-%s" % ripper.name(), "uplib")
+    lock_folder(folderpath)
+    try:
+        which_ripper = os.path.join(folderpath, "RIPPING")
+        try:
+            condition.acquire()
+            try:
+                current = None
+                while len(finished) < len(rippers):
+                    if not failures:
+                        for i in range(len(rippers)):
+                            if failures or ((len(started) - len(finished)) >= max_running):
+                                break
+                            if (i not in started) and prereqs[i].issubset(finished):
+                                started.add(i)
+                                if max_running == 1:
+                                    # no point in another thread
+                                    condition.release()
+                                    try:
+                                        _note_current_ripper(i)
+                                        current = i
+                                        _rip_one(i)
+                                    finally:
+                                        condition.acquire()
+                                else:
+                                    uthread.start_new_thread(_rip_one, (i,), name="ripping-%s-%s" % (id, rippers[i].name()))
+                    earliest = min([i for i in range(len(rippers)) if i not in finished] or [None])
+                    if (earliest is not None) and (earliest != current) and (earliest in started):
+                        _note_current_ripper(earliest)
+                        current = earliest
+                    if failures and (len(started) == len(finished)):
+                        break
+                    if (len(started) - len(finished)) > 0:
+                        condition.wait()
+            finally:
+                condition.release()
+
+            _write_ripper_timings(folderpath, rippers, timings)
+
+            if failures:
+                failures.sort()
+                index, (type, value, tb) = failures[0]
+                _note_current_ripper(index)
+                raise value, None, tb
 
         except AbortDocumentIncorporation:
             type, value, tb = sys.exc_info()
@@ -368,7 +499,8 @@ def _finish_inclusion (repo, folderpath, id):
         os.unlink(os.path.join(folderpath, "ERROR"))
 
 
-def flesh_out_folder(id, tmpfilename, metadata, repo, unpack_fn, counter):
+def flesh_out_folder(id, tmpfilename, metadata, repo, unpack_fn, counter, mdfilename=None):
+    # returns true if the document was incorporated (or deliberately abandoned), false if it failed
     try:
         try:
 #             note(3, "CODETIMER_ON is %s", CODETIMER_ON)
@@ -381,7 +513,12 @@ def flesh_out_folder(id, tmpfilename, metadata, repo, unpack_fn, counter):
 #                 code_timer.CodeTimerOff()
 
             if unpack_fn and tmpfilename and os.path.exists(tmpfilename):
-                unpack_fn(repo, id, tmpfilename, metadata)
+                _in_stage("unpack", unpack_fn, repo, id, tmpfilename, metadata)
+                # the packed bits may live in the pending folder; they're not needed now,
+                # and neither is the metadata sent with them, which is in metadata.txt
+                os.unlink(tmpfilename)
+                if mdfilename and os.path.exists(mdfilename):
+                    os.unlink(mdfilename)
 
 #             if CODETIMER_ON:
 #                 code_timer.StopInt("newFolder$unpack", "uplib")
@@ -426,6 +563,8 @@ def flesh_out_folder(id, tmpfilename, metadata, repo, unpack_fn, counter):
 #                     noteOutString = noteOut.getvalue()
 #                     note(3, noteOutString)
 
+                return true
+
             except:
                 type, value, tb = sys.exc_info()
                 note("%s", ''.join(traceback.format_exception(type, value, tb)))
@@ -438,12 +577,16 @@ def flesh_out_folder(id, tmpfilename, metadata, repo, unpack_fn, counter):
             if (x.id == id):
                 shutil.rmtree(folderpath)
             remove_from_index(repo.index_path(), id)
+            return true
 
         except:
             type, value, tb = sys.exc_info()
             note("Exception processing new folder:\n%s", ''.join(traceback.format_exception(type, value, tb)))
+            return false
     finally:
-        if tmpfilename and os.path.exists(tmpfilename):
+        # packed bits which failed to unpack in the pending folder are left there, to be salvaged
+        if (tmpfilename and os.path.exists(tmpfilename) and
+            (os.path.dirname(tmpfilename) != repo.pending_location(id))):
             os.unlink(tmpfilename)
         if isinstance(counter, threading._BoundedSemaphore):
             try:
@@ -452,36 +595,215 @@ def flesh_out_folder(id, tmpfilename, metadata, repo, unpack_fn, counter):
                 note("Exception releasing incorporation semaphore %s:\n%s", counter,
                      ''.join(traceback.format_exception(*sys.exc_info())))
 
-def _incorporate_document(repo, incoming_queue, counter):
-    # it's a bit tricky to shut this down cleanly, so we do
-    # some extra checking
-    import sys, Queue, traceback, threading
-    while True:
+############################################################
+###
+###  IncorporationScheduler
+###
+############################################################
+
+# lower numbers are incorporated first
+PRIORITIES = { "interactive" : 0,
+               "normal" : 1,
+               "bulk" : 2,
+               }
+
+_UNPACK_FUNCTIONS = { "tarred-folder" : process_tarred_folder,
+                      "zipped-folder" : process_zipped_folder,
+                      }
+
+# name of the packed document in a pending folder, before it's unpacked
+INCOMING_FILENAME = "INCOMING"
+INCOMING_METADATA_FILENAME = "INCOMING-metadata.txt"
+
+class IncorporationScheduler (object):
+    """
+    A fixed pool of worker threads which incorporate new documents.  All the
+    workers take jobs from one shared priority queue, so an idle worker always
+    picks up the most urgent waiting document; interactive uploads go ahead of
+    bulk loads, and documents of the same priority are handled in the order they
+    arrived.  Every job is recorded in a journal in the ``overhead`` folder, so
+    that documents which were waiting when the repository stopped are resumed,
+    in their original order, when it restarts.
+    """
+
+    def __init__(self, repo, n_workers, max_queued=0):
+        self.repo = repo
+        self.n_workers = n_workers
+        self.max_queued = max_queued
+        self.__heap = []
+        self.__counter = 0
+        self.__running = {}
+        self.__condition = threading.Condition(threading.RLock())
+        self.__journal_path = os.path.join(repo.overhead_folder(), "incorporation-journal.txt")
+        self.__workers = [uthread.start_new_thread(self.__work, (), name="incorporation-worker-%d" % i)
+                          for i in range(n_workers)]
+
+    def __journal(self, line):
+        # called with the condition held
+        fp = open(self.__journal_path, 'a')
         try:
-            value = incoming_queue.get(True, 60)
-            # value contains:  (id, tmpfilename, metadata, unpack_fn)
-            id, tmpfilename, metadata, unpack_fn = value
-            if isinstance(counter, threading._BoundedSemaphore):
-                # blocks until below max number of threads
-                counter.acquire()
-            uthread.start_new_thread(flesh_out_folder,
-                                     (id, tmpfilename, metadata, repo, unpack_fn, counter),
-                                     name="incorporating-%s" % id)
-        except Queue.Empty:
-            pass
-        except:
-            if sys and traceback and note:
-                note("%s", ''.join(traceback.format_exception(*sys.exc_info())))
+            fp.write(line + "\n")
+            fp.flush()
+        finally:
+            fp.close()
+
+    def qsize(self):
+        """Number of documents waiting to be incorporated (not counting those in progress)."""
+        return len(self.__heap)
+
+    def queued(self, id):
+        """
+        :return: whether the document is waiting to be incorporated, or being incorporated now
+        :rtype: boolean
+        """
+        self.__condition.acquire()
+        try:
+            return (id in self.__running) or (id in [job[0] for priority, counter, job in self.__heap])
+        finally:
+            self.__condition.release()
+
+    def stats(self):
+        """
+        :return: number of waiting documents by priority name, and the IDs of documents now being incorporated
+        :rtype: dict
+        """
+        self.__condition.acquire()
+        try:
+            names = dict([(v, k) for k, v in PRIORITIES.items()])
+            waiting = {}
+            for priority, counter, job in self.__heap:
+                name = names.get(priority, str(priority))
+                waiting[name] = waiting.get(name, 0) + 1
+            return { 'waiting' : waiting,
+                     'running' : self.__running.keys(),
+                     'workers' : self.n_workers,
+                     }
+        finally:
+            self.__condition.release()
+
+    def wait_for_room (self, timeout=None):
+        """Block until there's room for another document in the queue.
+
+        :param timeout: max number of seconds to wait; None means wait indefinitely
+        :type timeout: float
+        :raises IncorporationBacklogged: if there's still no room after ``timeout`` seconds
+        """
+        if self.max_queued <= 0:
+            return
+        deadline = (timeout is not None) and (time.time() + timeout)
+        self.__condition.acquire()
+        try:
+            while len(self.__heap) >= self.max_queued:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise IncorporationBacklogged("%d documents already waiting to be incorporated" % len(self.__heap))
+                    self.__condition.wait(remaining)
+                else:
+                    self.__condition.wait()
+        finally:
+            self.__condition.release()
+
+    def put (self, id, doc_type, priority=None, journal=True):
+        """Queue the document in pending folder ``id`` for incorporation.
+        The packed document, and its metadata, if any, must already be in
+        the pending folder.
+
+        :param id: the document ID
+        :type id: string
+        :param doc_type: "tarred-folder" or "zipped-folder"
+        :type doc_type: string
+        :param priority: one of the names in PRIORITIES; defaults to "normal"
+        :type priority: string
+        """
+        if doc_type not in _UNPACK_FUNCTIONS:
+            raise Error("Can only add documents of type 'tarred-folder' or 'zipped-folder'")
+        if priority not in PRIORITIES:
+            priority = "normal"
+        self.__condition.acquire()
+        try:
+            if journal:
+                self.__journal("queued %s %s %s" % (id, priority, doc_type))
+            self.__counter += 1
+            heapq.heappush(self.__heap, (PRIORITIES[priority], self.__counter, (id, doc_type)))
+            self.__condition.notifyAll()
+        finally:
+            self.__condition.release()
+
+    def resume (self):
+        """Re-queue, in their original order, any documents in the journal which
+        were never incorporated, then rewrite the journal to hold just those."""
+        if not os.path.exists(self.__journal_path):
+            return
+        self.__condition.acquire()
+        try:
+            outstanding = []
+            for line in open(self.__journal_path, 'r'):
+                parts = line.split()
+                if len(parts) == 4 and parts[0] == "queued":
+                    outstanding.append(parts[1:])
+                elif len(parts) == 2 and parts[0] in ("done", "failed"):
+                    outstanding = [x for x in outstanding if x[0] != parts[1]]
+            waiting = [job[0] for priority, counter, job in self.__heap]
+            fp = open(self.__journal_path + ".new", 'w')
+            for id, priority, doc_type in outstanding:
+                if os.path.exists(os.path.join(self.repo.pending_location(id), INCOMING_FILENAME)):
+                    fp.write("queued %s %s %s\n" % (id, priority, doc_type))
+                    if id not in waiting:
+                        note(2, "resuming incorporation of %s (%s)", id, priority)
+                        self.put(id, doc_type, priority, journal=False)
+            fp.close()
+            if os.path.exists(self.__journal_path):
+                os.unlink(self.__journal_path)
+            os.rename(self.__journal_path + ".new", self.__journal_path)
+        finally:
+            self.__condition.release()
+
+    def __work (self):
+        while True:
+            self.__condition.acquire()
+            try:
+                while not self.__heap:
+                    self.__condition.wait()
+                priority, counter, (id, doc_type) = heapq.heappop(self.__heap)
+                self.__running[id] = time.time()
+                self.__condition.notifyAll()
+            finally:
+                self.__condition.release()
+            succeeded = false
+            try:
+                try:
+                    folder = self.repo.pending_location(id)
+                    tmpfilename = os.path.join(folder, INCOMING_FILENAME)
+                    mdpath = os.path.join(folder, INCOMING_METADATA_FILENAME)
+                    metadata = None
+                    if os.path.exists(mdpath):
+                        metadata = read_metadata(mdpath)
+                    # the metadata file is removed once the document has been unpacked, so
+                    # that if unpacking fails it's still there for whoever salvages the folder
+                    succeeded = flesh_out_folder(id, tmpfilename, metadata, self.repo, _UNPACK_FUNCTIONS[doc_type], None,
+                                                 mdpath)
+                except:
+                    note("Exception incorporating %s:\n%s", id, ''.join(traceback.format_exception(*sys.exc_info())))
+            finally:
+                self.__condition.acquire()
+                try:
+                    del self.__running[id]
+                    self.__journal("%s %s" % ((succeeded and "done") or "failed", id))
+                finally:
+                    self.__condition.release()
 
 def start_incorporation_thread(repo, n_simultaneous_threads):
-    incoming_queue = Queue.Queue()
-    name = "process_incoming_documents"
-    counter = None
-    if (n_simultaneous_threads > 0):
-        name += "_in_at_most_%d_threads" % n_simultaneous_threads
-        counter = threading.BoundedSemaphore(n_simultaneous_threads)
-    uthread.start_new_thread(_incorporate_document, (repo, incoming_queue, counter), name=name)
-    return incoming_queue
+    if n_simultaneous_threads <= 0:
+        # no specified limit, so use one worker per CPU
+        try:
+            import multiprocessing
+            n_simultaneous_threads = multiprocessing.cpu_count()
+        except (ImportError, NotImplementedError):
+            n_simultaneous_threads = 4
+    conf = configurator.default_configurator()
+    max_queued = int(repo.get_param("max-waiting-incorporations") or conf.get_int("max-waiting-incorporations", 0))
+    return IncorporationScheduler(repo, n_simultaneous_threads, max_queued)
 
 def retry_folder (repo, folderpath, id):
     try:
@@ -519,6 +841,10 @@ def retry_folder (repo, folderpath, id):
 
 def retry_folders (repo):
     def _retry_folders_thread_fn (repo):
+        scheduler = repo.incorporation_scheduler()
+        if scheduler:
+            # documents which hadn't been unpacked yet
+            scheduler.resume()
         directory = repo.pending_folder()
         pending_docs = [x for x in os.listdir(directory) if DOC_ID_RE.match(x)]
         note(3, "%d docs in 'pending' folder", len(pending_docs))
@@ -529,13 +855,16 @@ def retry_folders (repo):
                 if (os.path.exists(os.path.join(folderpath, "UNPACKED")) or os.path.exists(os.path.join(folderpath, "RIPPED"))):
                     note(2, "Attempting to salvage pending folder %s", filename)
                     retry_folder (repo, folderpath, filename)
+                elif scheduler and scheduler.queued(filename):
+                    # still to be unpacked; resumed from the scheduler's journal
+                    pass
                 else:
                     note("Files in %s may be salvageable, but not automatically.  Please check.", folderpath)
             except:
                 note("retry_folders:  %s", ''.join(traceback.format_exception(*sys.exc_info())))
     uthread.start_new_thread(_retry_folders_thread_fn, (repo,), name="retry_pending_folders")
 
-def create (repo, queue, doc_bits, doc_type, metadata):
+def create (repo, scheduler, doc_bits, doc_type, metadata, priority=None):
 
     note(4, "in newFolder.create")
 
@@ -544,12 +873,11 @@ def create (repo, queue, doc_bits, doc_type, metadata):
 
     note(4, "updated configuration data")
 
-    tmpfilename = tempfile.mktemp()
-    f = open(tmpfilename, 'wb')
-    f.write(doc_bits)
-    f.close()
+    if doc_type not in _UNPACK_FUNCTIONS:
+        raise Error("Can only add documents of type 'tarred-folder' or 'zipped-folder'")
 
-    note(3, "wrote packed file to temporary file %s", tmpfilename)
+    # push back on the caller if we're already swamped
+    scheduler.wait_for_room(configurator.default_configurator().get_int("incorporation-queue-timeout", 60))
 
     if metadata and metadata.has_key("id"):
         id = metadata['id']
@@ -564,12 +892,23 @@ def create (repo, queue, doc_bits, doc_type, metadata):
         folder = repo.create_document_folder(repo.pending_folder())
     id = os.path.basename(folder)
 
-    if doc_type == 'tarred-folder':
-        queue.put((id, tmpfilename, metadata, process_tarred_folder))
-    elif doc_type == 'zipped-folder':
-        queue.put((id, tmpfilename, metadata, process_zipped_folder))
+    # keep the packed bits in the pending folder, so that they survive a restart
+    tmpfilename = os.path.join(folder, INCOMING_FILENAME)
+    f = open(tmpfilename, 'wb')
+    if hasattr(doc_bits, "read"):
+        # copy it a chunk at a time
+        shutil.copyfileobj(doc_bits, f)
     else:
-        raise Error("Can only add documents of type 'tarred-folder' or 'zipped-folder'")
+        f.write(doc_bits)
+    f.close()
+    os.chmod(tmpfilename, 0600)
+    if metadata:
+        fp = open(os.path.join(folder, INCOMING_METADATA_FILENAME), 'w')
+        write_metadata(fp, metadata)
+        fp.close()
 
-    return id
+    note(3, "wrote packed file to %s", tmpfilename)
 
+    scheduler.put(id, doc_type, priority)
+
+    return id
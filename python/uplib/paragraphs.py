@@ -68,6 +68,11 @@ def transform_point (x, y, translation, scaling):
             trunc((y + translation[1]) * scaling[1] + 0.5))
 
 class Box (object):
+
+    # there are many thousands of these on a long document; subclasses which
+    # need more attributes than their base declares get a __dict__ as usual
+    __slots__ = ('x0', 'y0', 'x1', 'y1')
+
     def __init__(self, x1, y1, x2, y2):
         self.x0 = x1
         self.y0 = y1
@@ -132,6 +137,7 @@ class Box (object):
         return u'<%s (%.1f,%.1f),(%.1f,%.1f)>' % (self.__class__.__name__, self.x0, self.y0, self.x1, self.y1)
 
 class WordBox (Box):
+    __slots__ = ('base',)
     def __init__(self, x1, y1, x2, y2, baseline):
         Box.__init__(self, x1, y1, x2, y2)
         self.base = baseline
@@ -157,18 +163,11 @@ class Space (Box):
     pass
 
 class PartBox (WordBox):
+    __slots__ = ('box', 'textstr', 'fontsize', 'offset')
     def __init__(self, box):
         WordBox.__init__(self, box.left(), box.top(), box.right(), box.bottom(), box.baseline())
         self.box = box
         self.textstr = box.text()
-        self.ENDS_WORD = box.ends_word()
-        self.ENDS_LINE = box.ends_line()
-        self.HAS_HYPHEN = box.has_hyphen()
-        self.FIXED_WIDTH = box.is_fixedwidth()
-        self.ITALIC = box.is_italic()
-        self.BOLD = box.is_bold()
-        self.SERIF = box.is_serif()
-        self.SYMBOL = box.is_symbol()
         self.fontsize = box.font_size()
         self.offset = box.contents_offset()
 
@@ -214,9 +213,6 @@ class PartBox (WordBox):
     def append(self, box):
         self.expand(box)
         self.textstr = self.textstr + box.text()
-        self.ENDS_LINE = box.ends_line()
-        self.ENDS_WORD = box.ends_word()
-        self.HAS_HYPHEN = box.has_hyphen()
         self.box = box
 
     def text(self):
@@ -1097,6 +1093,12 @@ class ParagraphRipper (Ripper):
 
         process_document(folder)
 
+    def requires(self):
+        return ("GuessLanguageRipper",)
+
+    def declares_dependencies(self):
+        return True
+
 
 def _by_repo_add_date(h1, h2):
     return cmp(h1[0].add_time(), h2[0].add_time())
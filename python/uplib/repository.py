@@ -24,14 +24,22 @@ import os, sys, string, time, hashlib, thread, traceback, re, types, warnings, l
 import uplib.plibUtil as plibUtil
 from uplib.newFolder import create as newFolder_create
 from uplib.newFolder import start_incorporation_thread, retry_folders
-from uplib.createIndexEntry import index_folder, remove_from_index
+from uplib.createIndexEntry import index_folder, remove_from_index, IndexingQueue, index_generation
 from uplib.ripper import get_default_rippers
 from uplib.plibUtil import note, lock_folder, unlock_folder, split_categories_string, subproc, Error, configurator, set_threaded, find_class, read_metadata, update_metadata, MutexLock, create_new_id, DOC_ID_RE, COLL_ID_RE, uthread, utf_8_encode, utf_8_decode, write_metadata, LimitedOrderedDict, HIER_DOC_ID_RE, set_verbosity, ensure_file, check_repository_in_list, set_note_sink, set_default_configuration_sections, get_fqdn, set_configuration_port
-from uplib.repindex import build_index_1_0
+from uplib.repindex import RepositoryIndex
 from uplib.collection import Collection, PrestoCollection, QueryCollection, CollectionPointer, Pointer
 from uplib.document import Document
 from uplib.extensions import find_and_load_extension
 from uplib.addDocument import MissingResource
+from uplib.javasearch import SearchServer
+from uplib.metadatacache import MetadataCache
+from uplib.bboxcache import PageBBoxesCache
+from uplib.iconsprites import IconSprites
+from uplib.catalog import open_catalog
+from uplib.repostats import RepositoryStats
+from uplib.fingerprints import FingerprintIndex
+from uplib.changefeed import ChangeFeed
 
 
 TheRepository = None
@@ -56,6 +64,77 @@ def _compare_docs_by_usage_time(repo, doc1, doc2):
     if (t2 > t1): return 1
     return 0
 
+class TagIndex (dict):
+
+    """
+    An inverted index mapping each tag (a category or author name) to the
+    set of IDs of the documents which have it, along with the reverse
+    mapping, ``by_doc``, from doc ID to the set of its tags.  Changing one
+    document's tags costs time proportional to the number of tags that
+    document has, not the number of tags in the repository.  Tags stay in
+    the index even when no document has them any more.
+    """
+
+    def __init__(self, mapping=None):
+        """
+        :param mapping: initial contents, mapping tag to a sequence of doc IDs
+        :type mapping: dict
+        """
+        dict.__init__(self)
+        self.by_doc = {}
+        if mapping:
+            for tag, doc_ids in mapping.iteritems():
+                ids = self.setdefault(tag, set())
+                for doc_id in doc_ids:
+                    ids.add(doc_id)
+                    self.by_doc.setdefault(doc_id, set()).add(tag)
+
+    def clear(self):
+        dict.clear(self)
+        self.by_doc.clear()
+
+    def add_tag(self, tag):
+        """Add a tag with no documents, if it's not already there.
+
+        :return: whether the tag was added
+        :rtype: boolean
+        """
+        if tag in self:
+            return False
+        self[tag] = set()
+        return True
+
+    def set_doc_tags(self, doc_id, tags):
+        """Make ``tags`` the complete set of tags for the document.
+
+        :return: whether anything changed
+        :rtype: boolean
+        """
+        new = set(tags)
+        old = self.by_doc.get(doc_id, set())
+        if new == old:
+            return False
+        for tag in old - new:
+            self[tag].discard(doc_id)
+        for tag in new - old:
+            self.setdefault(tag, set()).add(doc_id)
+        if new:
+            self.by_doc[doc_id] = new
+        else:
+            self.by_doc.pop(doc_id, None)
+        return True
+
+    def remove_doc(self, doc_id):
+        return self.set_doc_tags(doc_id, ())
+
+    def as_lists(self):
+        """
+        :return: a copy of the index, mapping each tag to a list of doc IDs
+        :rtype: dict
+        """
+        return dict([(tag, list(ids)) for tag, ids in self.iteritems()])
+
+
 class cookie (object):
     def __init__ (self, name, value, timeout):
         self.__name = name
@@ -122,41 +201,51 @@ class Repository (object):
         else:
             self.__metadata = {}
 
-        try:
-            self.__categories = (os.path.exists(os.path.join(root, "overhead", "categories.txt")) and
-                                 read_metadata(os.path.join(root, "overhead", "categories.txt"))) or {}
-        except:
-            note(0, "%s\n*** Removing bad categories.txt file",
-                 "".join(traceback.format_exception(*sys.exc_info())))
-            os.unlink(os.path.join(root, "overhead", "categories.txt"))
-            self.__categories = {}
-
-        for key, value in self.__categories.items():
+        # categories, authors, and usage records, if SQLite is available
+        self.__catalog = open_catalog(self)
+        if self.__catalog and self.__catalog.is_populated():
+            self.__categories = TagIndex(self.__catalog.category_map())
+            self.__authors = TagIndex(self.__catalog.author_map())
+            migrate = False
+        else:
             try:
-                if type(value) in types.StringTypes:
-                    value = eval(value)
+                self.__categories = (os.path.exists(os.path.join(root, "overhead", "categories.txt")) and
+                                     read_metadata(os.path.join(root, "overhead", "categories.txt"))) or {}
             except:
-                note("for value %s %s:\n%s", key, repr(value), ''.join(traceback.format_exception(*sys.exc_info())))
-                raise
-            self.__categories[key] = value
+                note(0, "%s\n*** Removing bad categories.txt file",
+                     "".join(traceback.format_exception(*sys.exc_info())))
+                os.unlink(os.path.join(root, "overhead", "categories.txt"))
+                self.__categories = {}
 
-        try:
-            self.__authors = (os.path.exists(os.path.join(root, "overhead", "authors.txt")) and
-                              read_metadata(os.path.join(root, "overhead", "authors.txt"))) or {}
-        except:
-            note(0, "%s\n*** Removing bad authors.txt file",
-                 "".join(traceback.format_exception(*sys.exc_info())))
-            os.unlink(os.path.join(root, "overhead", "authors.txt"))
-            self.__authors = {}
+            for key, value in self.__categories.items():
+                try:
+                    if type(value) in types.StringTypes:
+                        value = eval(value)
+                except:
+                    note("for value %s %s:\n%s", key, repr(value), ''.join(traceback.format_exception(*sys.exc_info())))
+                    raise
+                self.__categories[key] = value
 
-        for key, value in self.__authors.items():
             try:
-                if type(value) in types.StringTypes:
-                    value = eval(value)
+                self.__authors = (os.path.exists(os.path.join(root, "overhead", "authors.txt")) and
+                                  read_metadata(os.path.join(root, "overhead", "authors.txt"))) or {}
             except:
-                note("for value <<%s: %s>>:\n%s", repr(key), repr(value), ''.join(traceback.format_exception(*sys.exc_info())))
-                raise
-            self.__authors[key] = value
+                note(0, "%s\n*** Removing bad authors.txt file",
+                     "".join(traceback.format_exception(*sys.exc_info())))
+                os.unlink(os.path.join(root, "overhead", "authors.txt"))
+                self.__authors = {}
+
+            for key, value in self.__authors.items():
+                try:
+                    if type(value) in types.StringTypes:
+                        value = eval(value)
+                except:
+                    note("for value <<%s: %s>>:\n%s", repr(key), repr(value), ''.join(traceback.format_exception(*sys.exc_info())))
+                    raise
+                self.__authors[key] = value
+            self.__categories = TagIndex(self.__categories)
+            self.__authors = TagIndex(self.__authors)
+            migrate = (self.__catalog is not None)
         self.__certfilename = os.path.join(root, "overhead", "stunnel.pem")
 
         for key in db.keys():
@@ -170,6 +259,10 @@ class Repository (object):
 
         self.__uses_hierarchical_directories = self.__metadata.get("use-hierarchical-directories", "false").lower() == "true"
 
+        # parsed metadata.txt files of the documents, warmed from the last snapshot
+        self.__metadata_cache = MetadataCache(self)
+        self.__metadata_cache.start(inc_threads)
+
         # list of (on_addition, on_deletion) function pairs to call when a document is added or deleted
         # each function takes one parameter, the document object
         self.__doc_watchers = []
@@ -204,6 +297,38 @@ class Repository (object):
             # could be OK, but rescan anyway just in case
             note(3, "rescanning categories and authors...")
             self.rescan_indices()
+        elif migrate:
+            note(2, "moving categories and authors into the catalog...")
+            self.__sync_catalog()
+
+        # running counts of documents, pages, and disk usage
+        self.__stats = RepositoryStats(self)
+        self.register_document_watcher(self.__stats.on_add, self.__stats.on_delete, self.__stats.on_touch)
+        self.add_shutdown_hook(self.__stats.save)
+        self.__stats.start(inc_threads)
+
+        # content fingerprints, for finding duplicates
+        self.__fingerprints = FingerprintIndex(self)
+        self.register_document_watcher(self.__fingerprints.on_add, self.__fingerprints.on_delete, None)
+        self.__fingerprints.start(inc_threads)
+
+        # the records of the index.upri file, which is rewritten when they change
+        self.__repo_index = RepositoryIndex(self)
+        self.register_document_watcher(self.__repo_index.on_add, self.__repo_index.on_delete, None)
+        self.__repo_index.start(inc_threads)
+
+        # decoded page bounding boxes, shared by all the documents
+        self.__page_bboxes_cache = PageBBoxesCache(__conf.get_int("page-bboxes-cache-size", 16 * 1024) * 1024)
+        self.register_document_watcher(self.__page_bboxes_cache.on_change, self.__page_bboxes_cache.on_change, None)
+
+        # sprite sheets of document icons, for listing pages
+        max_sheets = __conf.get_int("icon-sprite-sheets", 100)
+        self.__icon_sprites = (max_sheets > 0) and IconSprites(self, max_sheets) or None
+
+        # numbered changes to documents, for clients which keep copies of the repository's state
+        self.__changes = ChangeFeed(__conf.get_int("change-feed-length", 10000))
+        self.register_document_watcher(self.__changes.on_add, self.__changes.on_delete, self.__changes.on_touch)
+        self.add_shutdown_hook(self.__changes.close)
 
         # finally, restore the collections
 
@@ -211,9 +336,19 @@ class Repository (object):
         self.__collections = {}
         self.__read_collections()
         self.__search_context = None
+        self.__search_server = None
+
+        # recent search results, good until the index changes
+        self.__query_cache = LimitedOrderedDict(max(1, __conf.get_int("query-cache-size", 100)))
+        self.__query_cache_enabled = (__conf.get_int("query-cache-size", 100) > 0)
+        self.__query_cache_generation = None
+        self.__query_cache_lock = MutexLock("QueryCache")
+        self.__query_cache_hits = 0
+        self.__query_cache_misses = 0
         self.__save_time = 0
 
         # create a thread to deal with new documents
+        self.__incorporation_queue = None
         if inc_threads:
             n_incorporation_threads = self.__metadata.get("max-simultaneous-incorporation-threads")
             if not n_incorporation_threads:
@@ -224,6 +359,12 @@ class Repository (object):
                 n_incorporation_threads = -1        # no limit
             self.__incorporation_queue = start_incorporation_thread(self, n_incorporation_threads)
 
+        # batch up re-indexing requests from metadata edits
+        self.__indexing_queue = None
+        if inc_threads:
+            self.__indexing_queue = IndexingQueue(self)
+            self.add_shutdown_hook(self.__indexing_queue.shutdown)
+
         self.start_time = time.time()
 
 
@@ -237,6 +378,8 @@ class Repository (object):
         self.__shutdown_hooks.append(hook)
 
     def run_shutdown_hooks(self):
+        if self.__catalog is not None:
+            self.__catalog.flush()
         if self.__database is not None:
             self.__database.close()
             self.__database = None
@@ -258,7 +401,17 @@ class Repository (object):
         self.__save_collections()
         self.__save_history()
         try:
-            if force: build_index_1_0(self)
+            self.__metadata_cache.save()
+        except:
+            note(0, string.join(traceback.format_exception(*sys.exc_info())))
+        try:
+            if self.__catalog is not None:
+                self.__catalog.flush()
+        except:
+            note(0, string.join(traceback.format_exception(*sys.exc_info())))
+        try:
+            if force and self.__repo_index.is_stale():
+                self.__repo_index.write()
         except:
             note(0, string.join(traceback.format_exception(*sys.exc_info())))
         self.__save_time = time.time()
@@ -328,6 +481,8 @@ class Repository (object):
             try:
                 c.store(self.collections_folder())
                 coll_list_file.write("%s.%s %s %s\n" % (c.__class__.__module__, c.__class__.__name__, c.id, key))
+                if (self.__catalog is not None) and not isinstance(c, QueryCollection):
+                    self.__catalog.set_collection(key, [x for x in c.iterkeys() if DOC_ID_RE.match(x)])
             except:
                 note("while saving collection %s:\n%s", key, string.join(traceback.format_exception(*sys.exc_info())))
         coll_list_file.close()        
@@ -337,40 +492,39 @@ class Repository (object):
             self.__rippers = get_default_rippers(self)
         return self.__rippers
 
+    def __doc_categories(self, doc):
+        # the lower-cased categories of the doc, plus the parents of hierarchical categories
+        cats = []
+        for cat in doc.get_category_strings():
+            c = [x.strip().lower() for x in cat.split('/')]
+            for i in range(len(c)):
+                cname = '/'.join(c[:i+1])
+                if cname not in cats:
+                    cats.append(cname)
+        return cats
+
+    def __doc_authors(self, doc):
+        auts = doc.get_metadata("authors")
+        return (auts and [x.strip() for x in auts.split(' and ')]) or []
+
     def update_indices(self, doc, authors=None, categories=None):
+        """Bring the category and author indices up to date for ``doc``.
+
+        :param doc: the document
+        :type doc: uplib.document.Document
+        :param authors: the author index to update, if any
+        :type authors: TagIndex
+        :param categories: the category index to update, if any
+        :type categories: TagIndex
+        :return: whether the author index, and whether the category index, changed
+        :rtype: (boolean, boolean)
+        """
+        authors_changed = categories_changed = False
         if categories is not None:
-            cs = doc.get_category_strings()
-            cats = []
-            for cat in cs:
-                c = [x.strip().lower() for x in cat.split('/')]
-                for i in range(len(c)):
-                    cname = '/'.join(c[:i+1])
-                    if cname not in cats:
-                        cats.append(cname)
-            for cat in cats:
-                if cat in categories:
-                    if doc.id not in categories[cat]:
-                        categories[cat].append(doc.id)
-                else:
-                    categories[cat] = [doc.id,]
-            for cat in categories:
-                if (doc.id in categories[cat]) and (cat not in cats):
-                    categories[cat].remove(doc.id)
+            categories_changed = categories.set_doc_tags(doc.id, self.__doc_categories(doc))
         if authors is not None:
-            auts = doc.get_metadata("authors")
-            if auts:
-                auts = [x.strip() for x in auts.split(' and ')]
-                for aut in auts:
-                    if aut in authors:
-                        if doc.id not in authors[aut]:
-                            authors[aut].append(doc.id)
-                    else:
-                        authors[aut] = [doc.id,]
-            else:
-                auts = []
-            for aut in authors:
-                if (doc.id in authors[aut]) and (aut not in auts):
-                    authors[aut].remove(doc.id)
+            authors_changed = authors.set_doc_tags(doc.id, self.__doc_authors(doc))
+        return authors_changed, categories_changed
 
     def reindex(self, docs=None, categories=None, authors=None):
         if docs is None:
@@ -388,9 +542,64 @@ class Repository (object):
             try:
                 for doc in docs:
                     self.update_indices(doc, authors, categories)
+                    if (categories is self.__categories) or (authors is self.__authors):
+                        self.__catalog_document(doc)
             finally:
                 self.categories_lock.release()
 
+    def __catalog_document(self, doc):
+        if self.__catalog is not None:
+            try:
+                self.__catalog.update_document(doc.id, self.__doc_categories(doc), self.__doc_authors(doc),
+                                               doc.touch_time())
+            except:
+                note(0, "while cataloging %s:\n%s", doc.id, ''.join(traceback.format_exception(*sys.exc_info())))
+
+    def __sync_catalog(self):
+        # replace the catalog's contents with what we've got in memory
+        if self.__catalog is None:
+            return
+        touched = dict([(doc_id, doc.touch_time()) for doc_id, doc in self.__history.items()])
+        self.__catalog.rebuild(self._generate_doc_ids(), self.__categories, self.__authors, touched)
+        # the catalog supersedes the old flat files; move them aside so they can't go stale
+        for filename in ("categories.txt", "authors.txt"):
+            path = os.path.join(self.overhead_folder(), filename)
+            if os.path.exists(path):
+                if os.path.exists(path + ".bak"):
+                    os.unlink(path + ".bak")
+                os.rename(path, path + ".bak")
+
+    def catalog(self):
+        """
+        :return: the catalog of documents, categories, authors and collections, \
+                 or None if SQLite isn't available
+        :rtype: uplib.catalog.Catalog
+        """
+        return self.__catalog
+
+    def queue_for_indexing(self, doc_ids):
+        """
+        Arrange for the specified documents to be re-indexed soon.  If the repository
+        is running its background threads, the documents are added to the indexing
+        queue and indexed in a batch; otherwise they're indexed immediately.
+
+        :param doc_ids: the documents to re-index
+        :type doc_ids: sequence of doc ID strings
+        """
+        if self.__indexing_queue is not None:
+            self.__indexing_queue.add(doc_ids)
+        else:
+            for doc_id in doc_ids:
+                if self.valid_doc_id(doc_id):
+                    index_folder(self.doc_location(doc_id), self.index_path())
+
+    def indexing_queue(self):
+        """
+        :return: the queue of documents waiting to be re-indexed, if any
+        :rtype: uplib.createIndexEntry.IndexingQueue
+        """
+        return self.__indexing_queue
+
     def get_param (self, param_name, default_value=None):
         return self.__metadata.get(param_name, default_value)
 
@@ -409,6 +618,13 @@ class Repository (object):
         """
         return self.__modtime
 
+    def note_modified(self):
+        """
+        Record that something the repository shows about its documents, such as
+        their metadata, has changed, without the documents themselves being touched.
+        """
+        self.__modtime = time.time()
+
     def up_time(self):
         return time.time() - self.start_time
 
@@ -455,9 +671,91 @@ class Repository (object):
             self.document_lock.release()
         return newdir
 
-    def create_new_document (self, doc_bits, doc_type, metadata=None):
+    def create_new_document (self, doc_bits, doc_type, metadata=None, priority=None):
+        """
+        Queue a packed document folder for incorporation into the repository.
+
+        :param doc_bits: the packed folder, or a file-like object to read it from
+        :type doc_bits: string or file
+        :param doc_type: "tarred-folder" or "zipped-folder"
+        :type doc_type: string
+        :param metadata: additional metadata for the document
+        :type metadata: dict
+        :param priority: "interactive", "normal" (the default), or "bulk"
+        :type priority: string
+        :return: the ID of the new document
+        :rtype: string
+        :raises uplib.newFolder.IncorporationBacklogged: if too many documents are already waiting
+        """
         return newFolder_create(self, self.__incorporation_queue,
-                                doc_bits, doc_type, metadata)
+                                doc_bits, doc_type, metadata, priority)
+
+    def incorporation_scheduler (self):
+        """
+        :return: the scheduler which incorporates new documents, if the repository is running its threads
+        :rtype: uplib.newFolder.IncorporationScheduler
+        """
+        return self.__incorporation_queue
+
+    def metadata_cache (self):
+        """
+        :return: the cache of document metadata for this repository
+        :rtype: uplib.metadatacache.MetadataCache
+        """
+        return self.__metadata_cache
+
+    def statistics (self):
+        """
+        :return: the running document, page, and disk-usage counts for this repository
+        :rtype: uplib.repostats.RepositoryStats
+        """
+        return self.__stats
+
+    def fingerprints (self):
+        """
+        :return: the index of document content fingerprints
+        :rtype: uplib.fingerprints.FingerprintIndex
+        """
+        return self.__fingerprints
+
+    def repository_index (self):
+        """
+        :return: the keeper of the repository's ``index.upri`` file
+        :rtype: uplib.repindex.RepositoryIndex
+        """
+        return self.__repo_index
+
+    def page_bboxes_cache (self):
+        """
+        :return: the cache of decoded page bounding boxes for this repository's documents
+        :rtype: uplib.bboxcache.PageBBoxesCache
+        """
+        return self.__page_bboxes_cache
+
+    def icon_sprites (self):
+        """
+        :return: the keeper of sprite sheets of document icons, or None if listings \
+                 should fetch each icon separately
+        :rtype: uplib.iconsprites.IconSprites
+        """
+        return self.__icon_sprites
+
+    def changes (self):
+        """
+        :return: the feed of changes to the repository's documents
+        :rtype: uplib.changefeed.ChangeFeed
+        """
+        return self.__changes
+
+    def find_duplicates (self, fingerprint):
+        """Find the documents whose content has the given fingerprint.
+
+        :param fingerprint: as calculated by ``uplib.addDocument.calculate_originals_fingerprint``
+        :type fingerprint: string
+        :return: the documents with that fingerprint
+        :rtype: list of uplib.document.Document
+        """
+        return [self.get_document(x) for x in self.__fingerprints.lookup(fingerprint)]
 
     def register_document_watcher(self, on_add, on_delete, on_touch):
         self.__doc_watchers.append((on_add, on_delete, on_touch))
@@ -505,6 +803,15 @@ class Repository (object):
                 if did in self.__history:
                     self.__history.pop(did)
                 remove_from_index(self.index_path(), did)
+                self.__metadata_cache.discard(did)
+                if self.__catalog is not None:
+                    self.__catalog.remove_document(did)
+                self.categories_lock.acquire()
+                try:
+                    self.__categories.remove_doc(did)
+                    self.__authors.remove_doc(did)
+                finally:
+                    self.categories_lock.release()
                 os.rename(location, os.path.join(deleted_folder, did))
                 doc.setfolder(os.path.join(deleted_folder, did))
                 self.__modtime = time.time()
@@ -570,11 +877,11 @@ class Repository (object):
                     return None
             path = os.path.join(self.overhead_folder(), "sqlitedb")
             if os.path.exists(path):
-                # just open it
-                self.__database = sqlite.connect(path)
+                # just open it; callers must serialize their use of it across threads
+                self.__database = sqlite.connect(path, check_same_thread=False)
             else:
                 # need to create any initial tables
-                self.__database = sqlite.connect(path)
+                self.__database = sqlite.connect(path, check_same_thread=False)
                 self.initialize_database()
         return self.__database
 
@@ -643,7 +950,9 @@ class Repository (object):
 
 
     def sort_doclist_by_pubdate(self, doclist):
-        doclist.sort(_compare_docs_by_pubdate)
+        # newest-first, using the cached dates rather than reading each metadata file
+        dates = self.__metadata_cache.dates([doc.id for doc in doclist])
+        doclist.sort(key=lambda doc: dates.get(doc.id), reverse=True)
         return doclist
 
     def sort_doclist_by_mru (self, doclist):
@@ -785,12 +1094,22 @@ class Repository (object):
         else:
             raise ValueError("Parameter 'doc_or_id', %s, must be a document ID string or a Document instance" % repr(doc_or_id))
         d.touch()
-        oldcathash = hash(unicode(self.__categories))
-        oldauthash = hash(unicode(self.__authors))
-	self.update_indices(d, self.__authors, self.__categories)
-	if (oldcathash != hash(unicode(self.__categories))):
+        self.categories_lock.acquire()
+        try:
+            authors_changed, categories_changed = self.update_indices(d, self.__authors, self.__categories)
+        finally:
+            self.categories_lock.release()
+        if authors_changed or categories_changed:
+            self.__catalog_document(d)
+        elif self.__catalog is not None:
+            # only the touch time has changed
+            try:
+                self.__catalog.note_touched(d.id, d.touch_time())
+            except:
+                note(0, "while cataloging %s:\n%s", d.id, ''.join(traceback.format_exception(*sys.exc_info())))
+        if categories_changed:
             self._update_categories_file()
-        if (oldauthash != hash(unicode(self.__authors))):
+        if authors_changed:
             self._update_authors_file()
         found = None
         if d.id in self.__history:
@@ -830,36 +1149,37 @@ class Repository (object):
         return l
 
     def get_docs_by_category(self, cat):
-        x = self.__categories.get(cat.strip().lower())
+        if self.__catalog is not None:
+            x = self.__catalog.docs_in_category(cat)
+        else:
+            x = self.__categories.get(cat.strip().lower())
         if x:
             return tuple([self.get_document(id) for id in x if self.valid_doc_id(id)])
 
     def get_docids_with_categories(self):
-        ids_to_categories_mapping = {}
-        for cat, ids in self.__categories.iteritems():
-            for id in ids:
-                if id not in ids_to_categories_mapping:
-                    ids_to_categories_mapping.setdefault(id, [])
-                ids_to_categories_mapping[id].append(cat)
-        return ids_to_categories_mapping
+        return dict([(id, list(cats)) for id, cats in self.__categories.by_doc.iteritems()])
 
     def get_categories_with_docs(self):
-        return self.__categories.copy()
+        return self.__categories.as_lists()
 
     def get_docs_by_author(self, author):
-        x = self.__authors.get(author.strip().lower())
+        if self.__catalog is not None:
+            x = self.__catalog.docs_by_author(author)
+        else:
+            x = self.__authors.get(author.strip().lower())
         if x:
-            return tuple([get_document(id) for id in x])
+            return tuple([self.get_document(id) for id in x if self.valid_doc_id(id)])
 
     def get_authors_with_docs(self):
-        return self.__authors.copy()
+        return self.__authors.as_lists()
 
     def add_category(self, new_category, holds_lock=False):
         if not holds_lock:
             self.categories_lock.acquire()
         try:
-            if new_category.strip().lower() not in self.__categories:
-                self.__categories[new_category.strip().lower()] = []
+            if self.__categories.add_tag(new_category.strip().lower()):
+                if self.__catalog is not None:
+                    self.__catalog.add_category(new_category.strip().lower())
                 self._update_categories_file()
                 self.__modtime = time.time()
         finally:
@@ -867,8 +1187,11 @@ class Repository (object):
                 self.categories_lock.release()
 
     def _update_authors_file(self, d=None):
+        if self.__catalog is not None:
+            # kept up to date a document at a time
+            return
         if d is None:
-            d = self.__authors.copy()
+            d = self.__authors.as_lists()
             #note("self.__authors yields %d (%d) values", len(self.__authors), len(d))
         for key, value in d.items():
             value = str(value)
@@ -890,8 +1213,11 @@ class Repository (object):
         write_metadata(open(os.path.join(self.__root, "overhead", "authors.txt"), 'w'), d)
 
     def _update_categories_file(self, d=None):
+        if self.__catalog is not None:
+            # kept up to date a document at a time
+            return
         if d is None:
-            d = self.__categories.copy()
+            d = self.__categories.as_lists()
             # note("self.__categories yields %d (%d) values", len(self.__categories), len(d))
         for key, value in d.items():
             value = str(value)
@@ -914,25 +1240,27 @@ class Repository (object):
 
     def rescan_categories(self):
         self.categories_lock.acquire()
-        categories = {}
+        categories = TagIndex()
         for doc in self.generate_docs():
             self.update_indices(doc, None, categories)
         self.__categories = categories
         self._update_categories_file()
+        self.__sync_catalog()
         self.__modtime = time.time()
         self.categories_lock.release()
 
     def rescan_indices(self):
         self.categories_lock.acquire()
         try:
-            newcats = {}
-            newauts = {}
+            newcats = TagIndex()
+            newauts = TagIndex()
             for doc in self.generate_docs():
                 self.update_indices(doc, newauts, newcats)
             self.__categories = newcats
             self.__authors = newauts
             self._update_categories_file()
             self._update_authors_file()
+            self.__sync_catalog()
         finally:
             self.categories_lock.release()
 
@@ -1016,6 +1344,9 @@ class Repository (object):
         for name, coll in self.__collections.items():
             if (coll.name() == id):
                 del self.__collections[name]
+                if self.__catalog is not None:
+                    self.__catalog.remove_collection(name)
+                self.__repo_index.note_modified()
                 self.__save_collections()
                 return True
         return False
@@ -1025,6 +1356,9 @@ class Repository (object):
         if c:
             del self.__collections[oldname]
             self.__collections[newname] = c
+            if self.__catalog is not None:
+                self.__catalog.remove_collection(oldname)
+            self.__repo_index.note_modified()
             self.__save_collections()
             return True
         else:
@@ -1039,6 +1373,7 @@ class Repository (object):
             c = Collection(self, create_new_id(), objects)
         self.__collections[name or c.name()] = c
         self.__modtime = time.time()
+        self.__repo_index.note_modified()
         if checkpoint: self.save()
         return c
 
@@ -1048,6 +1383,7 @@ class Repository (object):
         else:
             c = PrestoCollection(self, None, query)
         self.__collections[name or c.name()] = c
+        self.__repo_index.note_modified()
         self.__save_collections()
         return c
 
@@ -1109,10 +1445,36 @@ class Repository (object):
         else:
             return None
 
+    def search_server (self):
+        """
+        Get the persistent Java search process for this repository, starting it if necessary.
+
+        :return: the search server, or None if it's not configured
+        :rtype: uplib.javasearch.SearchServer
+        """
+        if self.__search_server is None and SearchServer.enabled():
+            # two first searches at once shouldn't each start a server
+            self.document_lock.acquire()
+            try:
+                if self.__search_server is None:
+                    self.__search_server = SearchServer(self)
+                    self.add_shutdown_hook(self.__search_server.close)
+            finally:
+                self.document_lock.release()
+        return self.__search_server
+
     def javalucene_search (self, search_operation, query_string):
 
         # self.save()           # don't think we need this, and it speeds things up
         conf = configurator.default_configurator()
+
+        server = self.search_server()
+        if server:
+            command, output = server.search(search_operation, query_string)
+            if output and output[0] == '*':
+                raise Error ("%s signals error attempting to run query <%s> in %s:\n%s\ncommand is <%s>" % (server, query_string, self.name(), output, command))
+            return command, output
+
         INDEXING_SEARCH_CMD = conf.get("indexing-search-command")
         JAVA = conf.get("java")
         LUCENE_JAR = conf.get("lucene-jarfile")
@@ -1208,6 +1570,56 @@ class Repository (object):
         if searchtype is None:
             searchtype = "bothsearch"
 
+        if not self.__query_cache_enabled:
+            return self.__run_full_query(query_string, searchtype)
+
+        generation = index_generation(self.index_path())
+        key = (query_string, searchtype)
+        self.__query_cache_lock.acquire()
+        try:
+            if generation != self.__query_cache_generation:
+                # the index has changed, so none of the cached results can be trusted
+                self.__query_cache.clear()
+                self.__query_cache_generation = generation
+            results = self.__query_cache.get(key)
+            if results is not None:
+                self.__query_cache_hits += 1
+                # move it to the most-recently-used end
+                self.__query_cache[key] = results
+        finally:
+            self.__query_cache_lock.release()
+
+        if results is None:
+            results = self.__run_full_query(query_string, searchtype)
+            self.__query_cache_lock.acquire()
+            try:
+                self.__query_cache_misses += 1
+                if generation == self.__query_cache_generation:
+                    self.__query_cache[key] = results
+            finally:
+                self.__query_cache_lock.release()
+
+        # callers may modify what they get back, so give them their own copy
+        copy = {}
+        for doc_id, record in results.iteritems():
+            record = record.copy()
+            if 'pages' in record:
+                record['pages'] = record['pages'].copy()
+            copy[doc_id] = record
+        return copy
+
+    def query_cache_stats (self):
+        """
+        :return: "hits", "misses", and "size" (number of cached queries) of the search results cache
+        :rtype: dict
+        """
+        return { 'hits' : self.__query_cache_hits,
+                 'misses' : self.__query_cache_misses,
+                 'size' : len(self.__query_cache),
+                 }
+
+    def __run_full_query (self, query_string, searchtype):
+
         results = self.pylucene_search(searchtype, query_string)
 
         # note(4, "results of pylucene_search are %s", results)
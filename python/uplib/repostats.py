@@ -0,0 +1,246 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Running counts of documents, pages, and disk usage for a repository.
+
+Rather than walking every document whenever someone asks how big the
+repository is, we keep a small record for each document (page count,
+content type, bytes on disk) and running totals, and update them from the
+repository's document watchers as documents are added, deleted, or touched.
+The records are saved in the ``overhead`` folder; if they're missing, or
+don't match the number of documents in the repository, they're rebuilt
+once by walking the documents.
+"""
+
+import os, sys, time, traceback, cPickle
+
+from uplib.plibUtil import note, MutexLock, uthread
+
+STATS_FILENAME = "repository-stats.pickle"
+
+# don't rewrite the stats file more often than this, in seconds; it's always saved at shutdown
+_SAVE_INTERVAL = 30
+
+def _folder_bytes(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+def _doc_pages(doc):
+    try:
+        return int(doc.get_metadata("pagecount") or doc.get_metadata("page-count") or 1)
+    except ValueError:
+        return 1
+
+
+class RepositoryStats (object):
+
+    """Document, page, and disk-usage counts for a repository, kept up to date incrementally."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.__path = os.path.join(repo.overhead_folder(), STATS_FILENAME)
+        # maps doc ID to (pages, content-type, bytes)
+        self.__records = {}
+        self.__lock = MutexLock("RepositoryStats")
+        self.__saved = 0
+        self.__dirty = False
+        self.docs = 0
+        self.pages = 0
+        # maps page count to number of docs with that many pages
+        self.page_histogram = {}
+        # maps content type to bytes on disk
+        self.bytes_by_type = {}
+        self.ready = False
+
+    def __add(self, doc_id, record):
+        # called with the lock held
+        old = self.__records.get(doc_id)
+        if old:
+            self.__remove(doc_id)
+        pages, ctype, nbytes = record
+        self.__records[doc_id] = record
+        self.docs += 1
+        self.pages += pages
+        self.page_histogram[pages] = self.page_histogram.get(pages, 0) + 1
+        self.bytes_by_type[ctype] = self.bytes_by_type.get(ctype, 0) + nbytes
+        self.__dirty = True
+
+    def __remove(self, doc_id):
+        # called with the lock held
+        record = self.__records.pop(doc_id, None)
+        if record is None:
+            return
+        pages, ctype, nbytes = record
+        self.docs -= 1
+        self.pages -= pages
+        self.page_histogram[pages] -= 1
+        if self.page_histogram[pages] <= 0:
+            del self.page_histogram[pages]
+        self.bytes_by_type[ctype] -= nbytes
+        if self.bytes_by_type[ctype] <= 0:
+            del self.bytes_by_type[ctype]
+        self.__dirty = True
+
+    def __record(self, doc):
+        return (_doc_pages(doc), doc.get_metadata("apparent-mime-type") or "unknown", _folder_bytes(doc.folder()))
+
+    # document watcher callbacks
+
+    def on_add(self, doc):
+        record = self.__record(doc)
+        self.__lock.acquire()
+        try:
+            self.__add(doc.id, record)
+        finally:
+            self.__lock.release()
+        self.save(False)
+
+    def on_delete(self, doc):
+        self.__lock.acquire()
+        try:
+            self.__remove(doc.id)
+        finally:
+            self.__lock.release()
+        self.save(False)
+
+    def on_touch(self, doc):
+        # a re-rip can change the page count; the disk usage is re-figured only on addition
+        record = self.__records.get(doc.id)
+        if record and (record[0] != _doc_pages(doc)):
+            self.__lock.acquire()
+            try:
+                self.__add(doc.id, (_doc_pages(doc), record[1], record[2]))
+            finally:
+                self.__lock.release()
+
+    # persistence
+
+    def save(self, force=True):
+        """Write the per-document records to the overhead folder, if they've changed.
+
+        :param force: if false, skip the write if we've saved recently
+        :type force: boolean
+        """
+        if (not self.__dirty) or (not self.ready):
+            return
+        if (not force) and ((time.time() - self.__saved) < _SAVE_INTERVAL):
+            return
+        self.__lock.acquire()
+        try:
+            records = self.__records.copy()
+            self.__dirty = False
+            self.__saved = time.time()
+        finally:
+            self.__lock.release()
+        tmpname = self.__path + ".new"
+        fp = open(tmpname, 'wb')
+        try:
+            cPickle.dump(records, fp, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+        if os.path.exists(self.__path):
+            os.unlink(self.__path)
+        os.rename(tmpname, self.__path)
+
+    def __load(self):
+        if not os.path.exists(self.__path):
+            return False
+        try:
+            fp = open(self.__path, 'rb')
+            try:
+                records = cPickle.load(fp)
+            finally:
+                fp.close()
+        except:
+            note(0, "Can't read repository stats %s:\n%s", self.__path,
+                 ''.join(traceback.format_exception(*sys.exc_info())))
+            return False
+        self.__lock.acquire()
+        try:
+            for doc_id, record in records.iteritems():
+                self.__add(doc_id, record)
+            self.__dirty = False
+        finally:
+            self.__lock.release()
+        return True
+
+    def rebuild(self):
+        """Recalculate all the records by walking the documents of the repository."""
+        note(2, "recalculating repository statistics...")
+        records = {}
+        for doc in self.repo.generate_docs():
+            try:
+                records[doc.id] = self.__record(doc)
+            except:
+                note(0, "while figuring stats for %s:\n%s", doc.id,
+                     ''.join(traceback.format_exception(*sys.exc_info())))
+        self.__lock.acquire()
+        try:
+            # keep anything added by the watchers while we were walking
+            for doc_id, record in self.__records.items():
+                if (doc_id not in records) and self.repo.valid_doc_id(doc_id):
+                    records[doc_id] = record
+            self.__records = {}
+            self.docs = self.pages = 0
+            self.page_histogram = {}
+            self.bytes_by_type = {}
+            for doc_id, record in records.iteritems():
+                self.__add(doc_id, record)
+            self.ready = True
+        finally:
+            self.__lock.release()
+        self.save()
+        note(2, "repository has %d documents, %d pages", self.docs, self.pages)
+
+    def start(self, background=True):
+        """Load the saved records; if they're missing or out of date, rebuild them.
+
+        :param background: if true, do any rebuilding in a new thread
+        :type background: boolean
+        """
+        if self.__load() and (self.docs == self.repo.docs_count()):
+            self.ready = True
+        elif background:
+            uthread.start_new_thread(self.rebuild, (), name="repository-stats")
+        else:
+            self.rebuild()
+
+    # reporting
+
+    def summary(self):
+        """
+        :return: docs, pages, page_histogram, bytes_by_type, and whether the numbers are complete yet
+        :rtype: dict
+        """
+        self.__lock.acquire()
+        try:
+            return { 'docs' : self.docs,
+                     'pages' : self.pages,
+                     'page_histogram' : self.page_histogram.copy(),
+                     'bytes_by_type' : self.bytes_by_type.copy(),
+                     'ready' : self.ready,
+                     }
+        finally:
+            self.__lock.release()
@@ -58,6 +58,15 @@ class Ripper (object):
         #returns the class names of rippers which must be run before this ripper
         return ()
 
+    def declares_dependencies(self):
+        """Whether ``requires()`` names every ripper this ripper depends on.
+        Defaults to ``False``, in which case the ripper is assumed to depend on
+        every ripper which precedes it in the ripper list, and won't be run
+        concurrently with any of them.  Override and return True if ``requires()``
+        is complete, so that the ripper can run alongside unrelated rippers.
+        """
+        return False
+
     def repository (self):
         return self.__repo
 
@@ -128,6 +137,13 @@ class SimpleSummaryRipper (Ripper):
     def provides(self):
         return "SimpleSummary"
 
+    def requires(self):
+        # GuessLanguageRipper may re-write contents.txt
+        return ("GuessLanguageRipper",)
+
+    def declares_dependencies(self):
+        return True
+
     def rip (self, location, doc_id):
 
         text, language = self.get_folder_text(location)
@@ -159,6 +175,54 @@ class SimpleSummaryRipper (Ripper):
         self.update_folder_metadata(location, { "summary" : txt })
 
 
+############################################################
+###
+###  ripper_prerequisites
+###
+############################################################
+
+def ripper_prerequisites(rippers):
+    """Figure out which rippers must finish before each ripper in ``rippers`` can start.
+
+    Rippers which don't declare their dependencies depend on every ripper
+    before them in the list.  Those which do depend on the earlier rippers
+    whose class name, or ``provides()`` value, appears in their ``requires()``.
+    Only earlier rippers are considered, so the list order is always a valid
+    order in which to run them.
+
+    :param rippers: the rippers, in order
+    :type rippers: list(uplib.ripper.Ripper)
+    :return: for each ripper, the set of indices of rippers which must be run before it
+    :rtype: list(set(int))
+    """
+    def _names(v):
+        if not v:
+            return ()
+        elif type(v) in types.StringTypes:
+            return (v,)
+        else:
+            return tuple(v)
+
+    indices = {}
+    for i in range(len(rippers)):
+        ripper = rippers[i]
+        names = (ripper.name(),)
+        if hasattr(ripper, "provides"):
+            names = names + _names(ripper.provides())
+        for name in names:
+            indices.setdefault(name, set()).add(i)
+    prereqs = []
+    for i in range(len(rippers)):
+        ripper = rippers[i]
+        if ripper.declares_dependencies():
+            deps = set()
+            for name in _names(ripper.requires()):
+                deps.update([x for x in indices.get(name, ()) if x < i])
+        else:
+            deps = set(range(i))
+        prereqs.append(deps)
+    return prereqs
+
 ############################################################
 ###
 ###  rerip_generic
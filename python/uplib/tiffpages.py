@@ -0,0 +1,125 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+"""
+Reading the pages of a multi-page TIFF file, one at a time.
+
+Page images are kept in a single multi-page ``document.tiff``.  Rather than
+copying that to a temporary file and splitting the copy into one file per
+page with ``tiffcp`` and ``tiffsplit``, ``tiff_pages`` has PIL step from
+each page's IFD to the next, decoding a page only when it's asked for.  If
+PIL can't decode a page (some builds can't read every TIFF compression),
+the rest of the pages are split out with the ``tiff-split-command``, as
+before.
+"""
+
+import os, shutil, tempfile
+
+from PIL import Image
+
+from uplib.plibUtil import Error, note, configurator, subproc
+
+# the page info which PIL reads from a TIFF file, and will write back if asked to
+_SAVED_INFO = ("dpi", "resolution", "resolution_unit", "description", "software", "date_time", "artist", "copyright")
+
+def tiff_save_options (im):
+    """Figure the options which will keep a page's resolution and other tags
+    when it's saved as a TIFF file again.  PIL only writes what it's told to,
+    not what it read, and tiffsplit used to keep all of these.
+
+    :param im: a page, as from ``tiff_pages``
+    :type im: PIL Image
+    :return: keyword arguments for ``im.save(path, 'TIFF', ...)``
+    :rtype: dict
+    """
+    return dict([(key, im.info[key]) for key in _SAVED_INFO if im.info.get(key) is not None])
+
+def tiff_page_count (path):
+    """
+    :param path: a TIFF file
+    :type path: string
+    :return: the number of pages in the file
+    :rtype: int
+    """
+    fp = open(path, 'rb')
+    try:
+        im = Image.open(fp)
+        if hasattr(im, "n_frames"):
+            return im.n_frames
+        count = 1
+        try:
+            while True:
+                # seeking reads only the IFD, not the image data
+                im.seek(count)
+                count += 1
+        except EOFError:
+            pass
+        return count
+    finally:
+        fp.close()
+
+def _split_pages (path, first):
+    conf = configurator.default_configurator()
+    split_command = conf.get("tiff-split-command")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tiffmaster = os.path.join(tmpdir, "master.tiff")
+        split_command = split_command % (conf.get("tiffcp"), path, tiffmaster,
+                                         conf.get("tiffsplit"), tiffmaster, os.path.join(tmpdir, "x"))
+        status, output, tsignal = subproc(split_command)
+        if status != 0:
+            raise Error("'%s' signals non-zero exit status %d => %s" % (split_command, status, output))
+        parts = [x for x in os.listdir(tmpdir) if x[0] == 'x']
+        parts.sort()
+        for part in parts[first:]:
+            im = Image.open(os.path.join(tmpdir, part))
+            im.load()
+            yield im
+    finally:
+        shutil.rmtree(tmpdir)
+
+def tiff_pages (path):
+    """Generate the pages of a TIFF file, in order.
+
+    :param path: a TIFF file
+    :type path: string
+    :return: the pages, each one already decoded, and independent of the others
+    :rtype: generator of PIL Images
+    """
+    fp = open(path, 'rb')
+    try:
+        im = Image.open(fp)
+        index = 0
+        while True:
+            if index > 0:
+                try:
+                    im.seek(index)
+                except EOFError:
+                    return
+            try:
+                im.load()
+            except IOError, x:
+                note(3, "can't decode page %d of %s (%s); splitting it with tiff-split-command", index, path, x)
+                for page in _split_pages(path, index):
+                    yield page
+                return
+            # the next seek replaces the image data, so hand out a copy
+            yield im.copy()
+            index += 1
+    finally:
+        fp.close()
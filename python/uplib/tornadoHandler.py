@@ -30,15 +30,16 @@ import tempfile
 import types
 import datetime
 import urlparse
+import email.utils
 
-from tornado.web import RequestHandler, HTTPError
+from tornado.web import RequestHandler, HTTPError, ChunkedTransferEncoding
 from tornado import version as TornadoVersion
 
 assert(tuple([int(x) for x in TornadoVersion.split('.')]) >= (1, 2))
 
 from uplib.plibUtil import note, configurator, PATH_SEPARATOR, uthread, get_note_sink
 from uplib.extensions import find_and_load_extension, is_hierarchical_extension
-from uplib.webutils import htmlescape, HTTPCodes, get_content_type
+from uplib.webutils import htmlescape, HTTPCodes, get_content_type, make_etag, etag_matches
 
 TOUCHPATH = re.compile('/docs/(?P<docid>[^/]+)/(.*\.(html|pdf|tiff)|contents.txt)')
 DOCPATH = re.compile('/docs/(?P<docid>[^/]+)/.*\.(html|pdf|tiff|txt|png|bboxes)')
@@ -50,6 +51,8 @@ ALLOW_OLD_EXTENSIONS = False
 
 ONE_YEAR = 365 * 24 * 60 * 60   # seconds in one standard year
 
+STREAM_CHUNK_SIZE = 1 << 16     # bytes of a streamed response to hand to the socket at a time
+
 TOP_LEVEL_ACTION = ("basic", "repo_show")
 """What to revert to if asked for '/', a (MODULE-NAME, MODULE-FUNCTION) pair.
 Could be overridden by an extension."""
@@ -367,6 +370,145 @@ def _python_exception_html(excn, extra = None):
     s2 = s2 + '<br>\n<p><pre>' + htmlescape(s) + '</pre></body></html>'
     return s2
 
+_RANGE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$')
+
+def _parse_range (header, size):
+    # returns (first, last) byte positions of a single byte range, or None to send
+    # the whole thing; an unsatisfiable range has first >= size
+    m = header and _RANGE.match(header)
+    if (not m) or not (m.group(1) or m.group(2)):
+        return None
+    if m.group(1):
+        first = int(m.group(1))
+        if not m.group(2):
+            return first, size - 1
+        last = int(m.group(2))
+        if last < first:
+            return None
+        return first, min(last, size - 1)
+    else:
+        # suffix range:  the last N bytes
+        return max(size - int(m.group(2)), 0), size - 1
+
+def _matches_validators (header, etag, mtime):
+    # whether an If-None-Match or If-Range header value matches the ETag, or,
+    # if it's a date, whether the file hasn't been modified since then
+    if etag_matches(header, etag):
+        return True
+    t = email.utils.parsedate_tz(header.strip())
+    return bool(t) and (email.utils.mktime_tz(t) >= int(mtime))
+
+def _file_chunks (fp, first, count):
+    try:
+        fp.seek(first)
+        while count > 0:
+            data = fp.read(min(count, STREAM_CHUNK_SIZE))
+            if not data:
+                break
+            count -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+def _send_chunks (handler, chunks, compressible=True):
+    """Write the strings generated by `chunks` as the body of the response, and finish it.
+
+    The next chunk is generated only when the last one has been written to the socket,
+    so neither a big body nor a slow client holds up the IOLoop.  Must be called in the
+    IOLoop thread, after the headers have been set.
+
+    :param handler: the handler for the request
+    :type handler: tornado.web.RequestHandler
+    :param chunks: the body data
+    :type chunks: iterable of strings
+    :param compressible: if false, the headers are sent before any data, so \
+           that the GZip transform leaves the body alone (as for a byte range)
+    :type compressible: boolean
+    """
+    stream = handler.request.connection.stream
+    iterator = iter(chunks)
+
+    def _pump():
+        if stream.closed():
+            # client went away
+            return
+        data = []
+        size = 0
+        try:
+            while size < STREAM_CHUNK_SIZE:
+                chunk = iterator.next()
+                data.append(chunk)
+                size += len(chunk)
+        except StopIteration:
+            handler.write(''.join(data))
+            if not compressible:
+                handler.flush()
+            handler.finish()
+            return
+        except:
+            note(0, "Exception producing response data for %s:\n%s", handler.request.uri,
+                 ''.join(traceback.format_exception(*sys.exc_info())))
+            # the response is incomplete, so don't let it look finished
+            stream.close()
+            return
+        handler.write(''.join(data))
+        handler.flush()
+        # flush() takes no callback, so ask the stream to call us back once it's written
+        stream.write("", _pump)
+
+    _pump()
+
+def _send_file (handler, fp, content_type):
+    """Send an open file as the response, and finish the request.
+
+    The ETag and Last-Modified headers come from the file's modification time
+    (and size), and If-None-Match, If-Modified-Since, Range and If-Range
+    request headers are honored.  The file is read and sent a chunk at a time
+    with `_send_chunks`, and closed at the end.  Must be called in the IOLoop
+    thread.
+
+    :param handler: the handler for the request
+    :type handler: tornado.web.RequestHandler
+    :param fp: the file to send, open for reading
+    :type fp: file
+    :param content_type: the MIME type of the file
+    :type content_type: string
+    """
+    stats = os.fstat(fp.fileno())
+    size = stats.st_size
+    etag = '"%x-%x"' % (int(stats.st_mtime), size)
+    handler.set_header('Content-Type', content_type)
+    handler.set_header('Last-Modified', datetime.datetime.utcfromtimestamp(stats.st_mtime))
+    handler.set_header('Etag', etag)
+    handler.set_header('Accept-Ranges', 'bytes')
+    headers = handler.request.headers
+    validator = headers.get("If-None-Match") or headers.get("If-Modified-Since")
+    if validator and _matches_validators(validator, etag, stats.st_mtime):
+        fp.close()
+        handler.set_status(HTTPCodes.NOT_MODIFIED)
+        handler.finish()
+        return
+    first, last = 0, size - 1
+    byte_range = _parse_range(headers.get("Range"), size)
+    if byte_range and ((not headers.get("If-Range")) or
+                       _matches_validators(headers.get("If-Range"), etag, stats.st_mtime)):
+        first, last = byte_range
+        if first >= size:
+            fp.close()
+            handler.set_status(HTTPCodes.REQUESTED_RANGE_NOT_SATISFIABLE)
+            handler.set_header('Content-Range', 'bytes */%d' % size)
+            handler.finish()
+            return
+        handler.set_status(HTTPCodes.PARTIAL_CONTENT)
+        handler.set_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+    handler.set_header('Content-Length', str(last - first + 1))
+    if handler.request.method == "HEAD":
+        fp.close()
+        handler.flush()
+        handler.finish()
+    else:
+        _send_chunks(handler, _file_chunks(fp, first, last - first + 1), not byte_range)
+
 def run_fn_in_new_thread(resp, fn, args):
     resp._in_new_thread = True
     try:
@@ -398,6 +540,7 @@ class response (object):
         self.request.set_header('Cache-Control', 'no-store')
         self.request.uri = self.request.request.uri
         self._in_new_thread = False
+        self._streaming = False
 
     def open (self, content_type = "text/html"):
         self.fp = _request_file_buffer(self.request, content_type)
@@ -433,23 +576,70 @@ class response (object):
             self.request.write(message)
 
     def return_file (self, typ, path, delete_on_close=False, filename=None):
-        stats = os.stat(path)
+        # sent a chunk at a time by _send_file, which also handles conditional and range requests
         if delete_on_close:
             fp = self_deleting_file(path, 'rb')
         else:
             fp = open(path, 'rb')
-        self.request.set_header('Content-Type', (isinstance(typ, unicode) and typ.encode("ASCII", "replace")) or typ)
-        self.request.set_header('Content-Length', str(stats.st_size))
-        self.request.set_header('Last-Modified', datetime.datetime.fromtimestamp(stats.st_mtime))
+        handler = self.request
+        self._streaming = True
         if filename:
             filename = (isinstance(filename, unicode) and filename.encode("ASCII", "replace")) or filename
-            self.request.set_header("Content-Disposition", "inline; filename=%s" % filename)
+            handler.set_header("Content-Disposition", "inline; filename=%s" % filename)
         elif not delete_on_close:
             filename = os.path.split(path)[1]
             filename = (isinstance(filename, unicode) and filename.encode("ASCII", "replace")) or filename
-            self.request.set_header("Content-Disposition", "inline; filename=%s" % filename)
-        if (self.request.request.method != "HEAD"):
-            self.request.write(fp.read())
+            handler.set_header("Content-Disposition", "inline; filename=%s" % filename)
+        typ = (isinstance(typ, unicode) and typ.encode("ASCII", "replace")) or typ
+        if self._in_new_thread:
+            handler.request.connection.stream.io_loop.add_callback(lambda: _send_file(handler, fp, typ))
+        else:
+            _send_file(handler, fp, typ)
+
+    def return_stream (self, typ, chunks, filename=None):
+        # The length isn't known ahead of time, so the data is sent as it's
+        # generated, with chunked encoding for HTTP/1.1 clients, or by closing
+        # the connection at the end for older ones, or when the server has
+        # been configured not to use chunking.
+        handler = self.request
+        connection = handler.request.connection
+        self._streaming = True
+
+        def _start():
+            handler.set_header('Content-Type', (isinstance(typ, unicode) and typ.encode("ASCII", "replace")) or typ)
+            if filename:
+                fname = (isinstance(filename, unicode) and filename.encode("ASCII", "replace")) or filename
+                handler.set_header("Content-Disposition", "inline; filename=%s" % fname)
+            chunked = [x for x in handler._transforms if isinstance(x, ChunkedTransferEncoding)]
+            if not (chunked and handler.request.supports_http_1_1()):
+                # without chunked encoding, only closing the connection marks the end of the data
+                connection.no_keep_alive = True
+                handler.set_header("Connection", "close")
+            if handler.request.method == "HEAD":
+                handler.flush()
+                handler.finish()
+            else:
+                _send_chunks(handler, chunks)
+
+        if self._in_new_thread:
+            connection.stream.io_loop.add_callback(_start)
+        else:
+            _start()
+
+    def not_modified (self, etag):
+        # Give the response the entity tag ETAG.  If the client's copy has that tag,
+        # reply "not modified" and return True, in which case the caller is done.
+        matches = etag_matches(self.request.request.headers.get("If-None-Match"), etag)
+        def _set_headers():
+            self.request.set_header('Etag', etag)
+            self.request.set_header('Cache-Control', 'no-cache')
+            if matches:
+                self.request.set_status(HTTPCodes.NOT_MODIFIED)
+        if self._in_new_thread:
+            self.request.request.connection.stream.io_loop.add_callback(_set_headers)
+        else:
+            _set_headers()
+        return matches
 
     def fork_request(self, fn, *args):
         note(3, "forking %s in new thread...", fn)
@@ -463,7 +653,9 @@ class response (object):
         if isinstance(self.fp, _request_file_buffer):
             self.request.request.connection.stream.io_loop.add_callback(self.fp.finish)
         self.fp = None
-        self.request.request.connection.stream.io_loop.add_callback(self.request.finish)
+        if not self._streaming:
+            # otherwise return_file() or return_stream() finishes the request when it's sent everything
+            self.request.request.connection.stream.io_loop.add_callback(self.request.finish)
 
     def __del__(self):
         if isinstance(self.fp, _request_file_buffer):
@@ -590,7 +782,7 @@ class DocsHandler(UpLibHandler):
 
         if self.allow_cache:
             # no need to re-fetch doc images or HTML
-            self.set_header('Expires', datetime.datetime.utcnow() + datetime.timedelta(days=EXPIRES_DAYS))
+            self.set_header('Expires', datetime.datetime.utcnow() + datetime.timedelta(seconds=ONE_YEAR))
         else:
             # dynamic content
             self.set_header('Cache-Control', 'no-store')
@@ -613,18 +805,24 @@ class DocsHandler(UpLibHandler):
                     path[5:].endswith("/metadata.txt")):
                     doc = self.repo.get_document(docid)
                     bits, mime_type = doc.get_requested_part(path, params, query, fragment)
+                    if bits and mime_type:
+                        # generated each time, but often the same, so let the client check
+                        etag = make_etag(bits)
+                        self.set_header('Etag', etag)
+                        self.set_header('Cache-Control', 'no-cache')
+                        if etag_matches(self.request.headers.get("If-None-Match"), etag):
+                            self.set_status(HTTPCodes.NOT_MODIFIED)
+                        else:
+                            self.set_header('Content-Type', mime_type)
+                            self.set_status(200)
+                            self.write(bits)
                 else:
-                    try:
-                        bits = open(filepath, 'rb').read()
-                        mime_type = get_content_type(filepath)
-                    except:
-                        bits = None
-                        mime_type = None
-                        raise
-                if bits and mime_type:
-                    self.set_header('Content-Type', mime_type)
-                    self.set_status(200)
-                    self.write(bits)
+                    # a file of the document, like a page image or thumbnail; it has an ETag
+                    # and Last-Modified, so the client can check whether it's changed
+                    if not self.allow_cache:
+                        self.set_header('Cache-Control', 'no-cache')
+                    self._auto_finish = False
+                    _send_file(self, open(filepath, 'rb'), get_content_type(filepath) or "application/octet-stream")
         return None
 
     def get(self, *args, **kwargs):
@@ -687,7 +885,8 @@ class ActionHandler (UpLibHandler):
             try:
                 resp = response(self, self.current_user is not None)
                 callable(self.repo, resp, field_values)
-                return True
+                # a streamed response finishes itself when it's all been sent
+                return not resp._streaming
             except ForkRequestInNewThread, x:
                 note(4, "forked off request")
                 self._auto_finish = False
@@ -577,6 +577,7 @@ class _http_codes:
     REQUEST_TOO_LARGE = 413
     URI_TOO_LARGE = 414
     UNSUPPORTED_MEDIA_TYPE = 415
+    REQUESTED_RANGE_NOT_SATISFIABLE = 416
     INTERNAL_SERVER_ERROR = 500
     NOT_IMPLEMENTED = 501
     BAD_GATEWAY = 502
@@ -592,6 +593,35 @@ def HTTP_error_message(code):
         if code == value:
             return key
 
+def make_etag (data):
+    """
+    :param data: the response body, or a string which changes whenever the response body would
+    :type data: string
+    :return: a strong HTTP entity tag derived from a hash of the data
+    :rtype: string
+    """
+    return '"%s"' % hashlib.sha1(data).hexdigest()
+
+def etag_matches (header, etag):
+    """
+    :param header: the value of an If-None-Match request header, or None
+    :type header: string
+    :param etag: the entity tag of the current version of the resource
+    :type etag: string
+    :return: whether the header names the entity tag (or is "*")
+    :rtype: boolean
+    """
+    if not header:
+        return False
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            # weak comparison is fine for GET
+            tag = tag[2:]
+        if tag == etag or tag == '*':
+            return True
+    return False
+
 ############################################################
 ###
 ###  class TitleFinder
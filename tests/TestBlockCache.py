@@ -0,0 +1,168 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+import sys, os, re, tempfile, shutil, threading, BaseHTTPServer, unittest
+import TestSupport
+
+# the file RangeHandler serves
+FILE_DATA = ''.join([chr(i % 253) for i in range(10500)])
+BLOCKSIZE = 1000
+
+class RangeHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # serves FILE_DATA, with byte ranges if the server's honor_ranges is set,
+    # and keeps track of the ranges asked for
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.getheader("range"))
+        m = re.match(r"bytes=(\d+)-(\d+)$", self.headers.getheader("range") or "")
+        if m and self.server.honor_ranges:
+            start, end = int(m.group(1)), min(int(m.group(2)), len(FILE_DATA) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, len(FILE_DATA)))
+        else:
+            start, end = 0, len(FILE_DATA) - 1
+            self.send_response(200)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+        self.wfile.write(FILE_DATA[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+class BlockCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_and_put(self):
+        cache = BlockCache(self.directory, 10000, BLOCKSIZE)
+        self.failUnlessEqual(cache.get("abc", 0), None)
+        cache.put("abc", 0, "x" * BLOCKSIZE)
+        cache.put("abc", 1, "y" * 10)
+        self.failUnlessEqual(cache.get("abc", 0), "x" * BLOCKSIZE)
+        self.failUnlessEqual(cache.get("abc", 1), "y" * 10)
+        self.failUnlessEqual(cache.get("def", 0), None)
+        self.failUnlessEqual(cache.nbytes, BLOCKSIZE + 10)
+
+    def test_eviction(self):
+        cache = BlockCache(self.directory, 2 * BLOCKSIZE, BLOCKSIZE)
+        cache.put("abc", 0, "0" * BLOCKSIZE)
+        cache.put("abc", 1, "1" * BLOCKSIZE)
+        # use the first block again, so that the second is the least recently used
+        cache.get("abc", 0)
+        cache.put("abc", 2, "2" * BLOCKSIZE)
+        self.failUnlessEqual(cache.nbytes, 2 * BLOCKSIZE)
+        self.failUnlessEqual(cache.get("abc", 1), None)
+        self.failUnlessEqual(cache.get("abc", 0), "0" * BLOCKSIZE)
+        self.failUnlessEqual(cache.get("abc", 2), "2" * BLOCKSIZE)
+        self.failUnlessEqual(len(os.listdir(self.directory)), 2)
+
+    def test_reopen(self):
+        cache = BlockCache(self.directory, 10000, BLOCKSIZE)
+        for i in range(3):
+            cache.put("abc", i, str(i) * BLOCKSIZE)
+        cache = BlockCache(self.directory, 10000, BLOCKSIZE)
+        self.failUnlessEqual(cache.nbytes, 3 * BLOCKSIZE)
+        self.failUnlessEqual(cache.get("abc", 1), "1" * BLOCKSIZE)
+        # a smaller cache drops blocks as it starts up
+        cache = BlockCache(self.directory, BLOCKSIZE, BLOCKSIZE)
+        self.failUnlessEqual(cache.nbytes, BLOCKSIZE)
+        self.failUnlessEqual(len(os.listdir(self.directory)), 1)
+
+    def test_disabled(self):
+        cache = BlockCache(self.directory, 0, BLOCKSIZE)
+        cache.put("abc", 0, "x" * BLOCKSIZE)
+        self.failUnlessEqual(cache.get("abc", 0), None)
+        self.failUnlessEqual(os.listdir(self.directory), [])
+
+class RemoteContentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = BlockCache(self.directory, 100000, BLOCKSIZE)
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), RangeHandler)
+        self.server.requests = []
+        self.server.honor_ranges = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.content = RemoteContent("http://127.0.0.1:%d/original" % self.server.server_address[1],
+                                     len(FILE_DATA), "abc", self.cache)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_read_through(self):
+        self.content.seek(1500)
+        self.failUnlessEqual(self.content.read(1000), FILE_DATA[1500:2500])
+        self.failUnlessEqual(self.content.tell(), 2500)
+        # one request, for the two blocks the read touched
+        self.failUnlessEqual(self.server.requests, ["bytes=1000-2999"])
+        self.failUnlessEqual(self.cache.get("abc", 2), FILE_DATA[2000:3000])
+        # read again, from the cache
+        self.content.seek(1000)
+        self.failUnlessEqual(self.content.read(2000), FILE_DATA[1000:3000])
+        self.failUnlessEqual(len(self.server.requests), 1)
+        # only the blocks which aren't cached are fetched
+        self.content.seek(0)
+        self.failUnlessEqual(self.content.read(4000), FILE_DATA[:4000])
+        self.failUnlessEqual(self.server.requests[1:], ["bytes=0-999", "bytes=3000-3999"])
+
+    def test_end_of_file(self):
+        self.content.seek(-100, 2)
+        self.failUnlessEqual(self.content.read(), FILE_DATA[-100:])
+        self.failUnlessEqual(self.server.requests, ["bytes=10000-10499"])
+        self.failUnlessEqual(self.content.read(10), "")
+        self.failUnlessEqual(self.content.getvalue(), FILE_DATA)
+
+    def test_ranges_ignored(self):
+        # the whole file comes back, and all of it is cached
+        self.server.honor_ranges = False
+        self.content.seek(5000)
+        self.failUnlessEqual(self.content.read(10), FILE_DATA[5000:5010])
+        self.content.seek(0)
+        self.failUnlessEqual(self.content.read(), FILE_DATA)
+        self.failUnlessEqual(len(self.server.requests), 1)
+        self.failUnlessEqual(self.cache.nbytes, len(FILE_DATA))
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    try:
+        from uplib.fuse.uplibfuse import BlockCache, RemoteContent
+    except ImportError, x:
+        # UVFS runs only where FUSE and its other requirements are installed
+        sys.stderr.write("Skipping %s:  can't import uplib.fuse.uplibfuse (%s).\n" % (sys.argv[0], x))
+        sys.exit(0)
+
+    unittest.main(argv=sys.argv[:1])
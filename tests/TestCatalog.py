@@ -0,0 +1,132 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, tempfile, shutil, unittest
+import TestSupport
+
+try:
+    import sqlite3 as sqlite
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = Catalog(sqlite.connect(":memory:"))
+        self.doc1 = create_new_id(1100000000.0)
+        self.doc2 = create_new_id(1200000000.0)
+        self.doc3 = create_new_id(1300000000.0)
+
+    def test_update_document(self):
+        self.catalog.update_document(self.doc1, ["work", "work/papers"], ["A. Smith"])
+        self.catalog.update_document(self.doc2, ["work"], ["a. smith", "B. Jones"])
+        self.failUnlessEqual(self.catalog.categories(), ["work", "work/papers"])
+        self.failUnlessEqual(self.catalog.docs_in_category(" Work "), [self.doc2, self.doc1])
+        self.failUnlessEqual(self.catalog.docs_by_author("A. SMITH"), [self.doc2, self.doc1])
+        self.failUnlessEqual(self.catalog.docs_count(), 2)
+
+    def test_replace_categories(self):
+        self.catalog.update_document(self.doc1, ["work"], ["A. Smith"])
+        self.catalog.update_document(self.doc1, ["home"])
+        self.failUnlessEqual(self.catalog.document_categories(self.doc1), ["home"])
+        # the old category is still known, and the authors were left alone
+        self.failUnlessEqual(self.catalog.category_map(), {"home" : [self.doc1], "work" : []})
+        self.failUnlessEqual(self.catalog.author_map(), {"A. Smith" : [self.doc1]})
+
+    def test_remove_document(self):
+        self.catalog.update_document(self.doc1, ["work"], ["A. Smith"])
+        self.catalog.set_collection("mine", [self.doc1])
+        self.catalog.remove_document(self.doc1)
+        self.failUnlessEqual(self.catalog.docs_in_category("work"), [])
+        self.failUnlessEqual(self.catalog.author_map(), {})
+        self.failUnlessEqual(self.catalog.document_collections(self.doc1), [])
+        self.failUnlessEqual(self.catalog.docs_count(), 0)
+
+    def test_collections(self):
+        self.catalog.set_collection("mine", [self.doc1, self.doc2])
+        self.catalog.set_collection("mine", [self.doc2])
+        self.catalog.set_collection("yours", [self.doc2])
+        self.failUnlessEqual(self.catalog.document_collections(self.doc1), [])
+        self.failUnlessEqual(sorted(self.catalog.document_collections(self.doc2)), ["mine", "yours"])
+        self.catalog.remove_collection("yours")
+        self.failUnlessEqual(self.catalog.document_collections(self.doc2), ["mine"])
+
+    def test_recent(self):
+        self.catalog.update_document(self.doc2, touched=50)
+        self.catalog.update_document(self.doc1, touched=100)
+        self.catalog.update_document(self.doc3)
+        self.failUnlessEqual(self.catalog.recently_added(), [self.doc3, self.doc2, self.doc1])
+        self.failUnlessEqual(self.catalog.recently_added(1), [self.doc3])
+        self.failUnlessEqual(self.catalog.recently_touched(), [self.doc1, self.doc2])
+
+    def test_note_touched(self):
+        self.catalog.update_document(self.doc1, ["work"], ["A. Smith"], touched=50)
+        self.catalog.update_document(self.doc2, ["work"], touched=100)
+        self.catalog.note_touched(self.doc1, 150)
+        # a document the catalog hasn't seen yet is added
+        self.catalog.note_touched(self.doc3, 125)
+        self.failUnlessEqual(self.catalog.recently_touched(), [self.doc1, self.doc3, self.doc2])
+        # nothing else about the document changed
+        self.failUnlessEqual(self.catalog.document_categories(self.doc1), ["work"])
+        self.failUnlessEqual(self.catalog.docs_by_author("a. smith"), [self.doc1])
+
+    def test_touches_are_committed(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "catalog.db")
+            catalog = Catalog(sqlite.connect(path))
+            catalog.update_document(self.doc1, ["work"])
+            catalog.note_touched(self.doc1, 150)
+            catalog.flush()
+            self.failUnlessEqual(Catalog(sqlite.connect(path)).recently_touched(), [self.doc1])
+            # enough touches are committed without a flush
+            for i in range(_TOUCH_BATCH):
+                catalog.note_touched(self.doc2, 200 + i)
+            self.failUnlessEqual(Catalog(sqlite.connect(path)).recently_touched(), [self.doc2, self.doc1])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_rebuild(self):
+        self.failIf(self.catalog.is_populated())
+        self.catalog.update_document(self.doc3, ["old"])
+        self.catalog.rebuild([self.doc1, self.doc2],
+                             { "work" : [self.doc1, self.doc2], "empty" : [] },
+                             { "A. Smith" : [self.doc2] },
+                             { self.doc1 : 10 })
+        self.failUnless(self.catalog.is_populated())
+        self.failUnlessEqual(self.catalog.categories(), ["empty", "work"])
+        self.failUnlessEqual(self.catalog.docs_in_category("work"), [self.doc2, self.doc1])
+        self.failUnlessEqual(self.catalog.docs_by_author("a. smith"), [self.doc2])
+        self.failUnlessEqual(self.catalog.recently_touched(), [self.doc1])
+        self.failUnlessEqual(self.catalog.docs_count(), 2)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.plibUtil import create_new_id
+    from uplib.catalog import Catalog, _TOUCH_BATCH
+
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,100 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+import sys, os, time, threading, unittest
+import TestSupport
+
+class FakeDocument:
+
+    def __init__(self, doc_id):
+        self.id = doc_id
+
+class ChangeFeedTest(unittest.TestCase):
+
+    def test_ordering(self):
+        feed = ChangeFeed()
+        feed.on_add(FakeDocument("d1"))
+        feed.record("d2", METADATA)
+        feed.on_touch(FakeDocument("d1"))
+        feed.on_delete(FakeDocument("d2"))
+        seq, changes = feed.changes(0)
+        self.failUnlessEqual(seq, 4)
+        self.failUnlessEqual(changes, [(1, ADDED, "d1"), (2, METADATA, "d2"), (3, TOUCHED, "d1"), (4, DELETED, "d2")])
+        self.failUnlessEqual(feed.changes(2), (4, [(3, TOUCHED, "d1"), (4, DELETED, "d2")]))
+        self.failUnlessEqual(feed.changes(4), (4, []))
+
+    def test_wait(self):
+        feed = ChangeFeed()
+        def later():
+            time.sleep(0.2)
+            feed.record("d1", ADDED)
+        t = threading.Thread(target=later)
+        t.start()
+        start = time.time()
+        seq, changes = feed.changes(0, timeout=10)
+        t.join()
+        self.failUnless(time.time() - start < 5)
+        self.failUnlessEqual(changes, [(1, ADDED, "d1")])
+
+    def test_timeout(self):
+        feed = ChangeFeed()
+        start = time.time()
+        self.failUnlessEqual(feed.changes(0, timeout=0.2), (0, []))
+        self.failUnless(time.time() - start >= 0.15)
+
+    def test_close(self):
+        feed = ChangeFeed()
+        t = threading.Timer(0.2, feed.close)
+        t.start()
+        start = time.time()
+        self.failUnlessEqual(feed.changes(0, timeout=10), (0, []))
+        self.failUnless(time.time() - start < 5)
+        t.join()
+
+    def test_fallen_behind(self):
+        feed = ChangeFeed(maxlen=4)
+        for i in range(20):
+            feed.record("d%d" % i, TOUCHED)
+        seq, changes = feed.changes(0)
+        self.failUnlessEqual((seq, changes), (20, None))
+        # the most recent changes are still there
+        seq, changes = feed.changes(16)
+        self.failUnlessEqual([change[0] for change in changes], [17, 18, 19, 20])
+
+    def test_other_epoch(self):
+        # a client of an earlier run of the repository may be ahead of this one
+        feed = ChangeFeed()
+        feed.record("d1", ADDED)
+        self.failUnlessEqual(feed.changes(5), (1, None))
+        self.failIfEqual(feed.epoch, None)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.changefeed import ChangeFeed, ADDED, DELETED, TOUCHED, METADATA
+
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,144 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, tempfile, shutil, unittest
+import TestSupport
+
+class FakeDocument:
+
+    def __init__(self, doc_id, fingerprint):
+        self.id = doc_id
+        self.fingerprint = fingerprint
+
+    def get_metadata(self, name):
+        return None
+
+    def sha_hash(self):
+        return self.fingerprint
+
+class FakeMetadataCache:
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def values(self, key, doc_ids):
+        return dict([(doc_id, self.repo.hashes.get(doc_id)) for doc_id in doc_ids])
+
+class FakeRepository:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.docs = {}
+        # doc ID => sha-hash metadata value
+        self.hashes = {}
+        # doc ID => fingerprint calculated from the document's files
+        self.computed = {}
+
+    def overhead_folder(self):
+        return self.directory
+
+    def valid_doc_id(self, doc_id):
+        return doc_id in self.docs
+
+    def _generate_doc_ids(self):
+        return self.docs.keys()
+
+    def metadata_cache(self):
+        return FakeMetadataCache(self)
+
+    def get_document(self, doc_id):
+        return FakeDocument(doc_id, self.computed.get(doc_id))
+
+class FingerprintIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.repo = FakeRepository(self.directory)
+        self.index = FingerprintIndex(self.repo)
+        for doc_id in ("d1", "d2", "d3"):
+            self.repo.docs[doc_id] = True
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lookup(self):
+        self.index.add("d1", "aaaa")
+        self.index.add("d2", "aaaa")
+        self.index.add("d3", "bbbb")
+        self.failUnlessEqual(sorted(self.index.lookup("aaaa")), ["d1", "d2"])
+        self.failUnlessEqual(self.index.lookup("cccc"), [])
+        self.failUnlessEqual(self.index.fingerprint("d3"), "bbbb")
+        # documents no longer in the repository aren't matched
+        del self.repo.docs["d1"]
+        self.failUnlessEqual(self.index.lookup("aaaa"), ["d2"])
+
+    def test_change_and_remove(self):
+        self.index.add("d1", "aaaa")
+        self.index.add("d1", "bbbb")
+        self.failUnlessEqual(self.index.lookup("aaaa"), [])
+        self.failUnlessEqual(self.index.lookup("bbbb"), ["d1"])
+        self.index.remove("d1")
+        self.failUnlessEqual(self.index.lookup("bbbb"), [])
+        self.failUnlessEqual(len(self.index), 0)
+
+    def test_journal(self):
+        self.index.add("d1", "aaaa")
+        self.index.add("d2", "bbbb")
+        self.index.remove("d1")
+        self.index.add("d2", "cccc")
+        index = FingerprintIndex(self.repo)
+        index.start(background=False)
+        self.failUnlessEqual(index.fingerprints(), { "d2" : "cccc" })
+
+    def test_compact(self):
+        for i in range(10):
+            self.index.add("d1", "hash%d" % i)
+        self.index.compact()
+        lines = open(os.path.join(self.directory, JOURNAL_FILENAME)).readlines()
+        self.failUnlessEqual(lines, ["+ d1 hash9\n"])
+        index = FingerprintIndex(self.repo)
+        index.start(background=False)
+        self.failUnlessEqual(index.lookup("hash9"), ["d1"])
+
+    def test_fill_in(self):
+        self.index.add("gone", "aaaa")
+        self.repo.hashes["d1"] = "1111"
+        self.repo.computed["d2"] = "2222"
+        self.index.fill_in()
+        self.failUnlessEqual(self.index.fingerprints(), { "d1" : "1111", "d2" : "2222" })
+
+    def test_fill_in_without_hashing(self):
+        self.repo.hashes["d1"] = "1111"
+        self.repo.computed["d2"] = "2222"
+        self.index.start(background=False)
+        self.failUnlessEqual(self.index.fingerprints(), { "d1" : "1111" })
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.fingerprints import FingerprintIndex, JOURNAL_FILENAME
+
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,109 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, time, threading, unittest
+import TestSupport
+
+class FakeRepository:
+
+    def valid_doc_id(self, doc_id):
+        return not doc_id.startswith("gone")
+
+    def doc_location(self, doc_id):
+        return os.path.join("/docs", doc_id)
+
+    def index_path(self):
+        return "/index"
+
+class IndexingQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.saved_index_folders = createIndexEntry.index_folders
+        createIndexEntry.index_folders = self.index_folders
+
+    def tearDown(self):
+        self.gate.set()
+        createIndexEntry.index_folders = self.saved_index_folders
+
+    def index_folders(self, docs_dir, names, index_path):
+        self.gate.wait()
+        self.batches.append((docs_dir, list(names), index_path))
+
+    def test_repeats_are_coalesced(self):
+        queue = IndexingQueue(FakeRepository(), max_staleness=0.2, batch_size=100)
+        queue.add(["a", "b"])
+        queue.add(["b", "a", "c"])
+        self.failUnless(queue.flush(5))
+        self.failUnlessEqual(self.batches, [("/docs", ["a", "b", "c"], "/index")])
+        stats = queue.stats()
+        self.failUnlessEqual(stats['commits'], 1)
+        self.failUnlessEqual(stats['docs-indexed'], 3)
+        self.failUnlessEqual(stats['depth'], 0)
+
+    def test_waits_for_staleness(self):
+        queue = IndexingQueue(FakeRepository(), max_staleness=0.5, batch_size=100)
+        queue.add(["a"])
+        time.sleep(0.1)
+        self.failUnlessEqual(self.batches, [])
+        self.failUnlessEqual(queue.depth(), 1)
+        self.failUnless(queue.flush(5))
+        self.failUnlessEqual(len(self.batches), 1)
+        self.failUnless(queue.stats()['max-wait'] >= 0.5)
+
+    def test_full_batch_goes_early(self):
+        queue = IndexingQueue(FakeRepository(), max_staleness=60, batch_size=3)
+        queue.add(["a", "b", "c", "d"])
+        time.sleep(0.5)
+        self.failUnlessEqual(self.batches, [("/docs", ["a", "b", "c"], "/index")])
+        self.failUnlessEqual(queue.depth(), 1)
+
+    def test_invalid_documents_are_skipped(self):
+        queue = IndexingQueue(FakeRepository(), max_staleness=0, batch_size=100)
+        queue.add(["gone1", "a"])
+        self.failUnless(queue.flush(5))
+        self.failUnlessEqual(self.batches, [("/docs", ["a"], "/index")])
+
+    def test_shutdown_times_out(self):
+        self.gate.clear()
+        queue = IndexingQueue(FakeRepository(), max_staleness=0, batch_size=100)
+        queue.add(["a"])
+        start = time.time()
+        self.failIf(queue.shutdown(0.3))
+        self.failUnless(time.time() - start < 5)
+        self.gate.set()
+        self.failUnless(queue.shutdown(5))
+        self.failUnlessEqual(len(self.batches), 1)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    import uplib.createIndexEntry as createIndexEntry
+    from uplib.createIndexEntry import IndexingQueue
+
+    unittest.main(argv=sys.argv[:1])
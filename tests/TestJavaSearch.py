@@ -0,0 +1,126 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, tempfile, shutil, unittest
+import TestSupport
+
+# Stands in for "LuceneIndexing INDEXDIR serve":  answers each
+# "OPERATION QUERY" line with a few result lines and a "." line,
+# and exits when asked to search for "die".
+
+FAKE_SERVER = r'''
+import sys, os
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    operation, query = line.rstrip("\n").split(" ", 1)
+    if query == "die":
+        sys.exit(1)
+    sys.stdout.write("operation %s\nquery %s\npid %s\n.\n" % (operation, query, os.getpid()))
+    sys.stdout.flush()
+'''
+
+class FakeRepository:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def index_path(self):
+        return os.path.join(self.directory, "index")
+
+    def overhead_folder(self):
+        return self.directory
+
+    def name(self):
+        return "test repository"
+
+class SearchServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        script = os.path.join(self.directory, "fakeserver.py")
+        fp = open(script, "w")
+        fp.write(FAKE_SERVER)
+        fp.close()
+        self.server = SearchServer(FakeRepository(self.directory))
+        # run the fake server instead of the configured Java command
+        command = '"%s" "%s"' % (sys.executable, script)
+        self.server._figure_command = lambda: command
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def results(self, operation, query):
+        command, output = self.server.search(operation, query)
+        return dict([line.split(" ", 1) for line in output.split("\n")])
+
+    def test_search(self):
+        results = self.results("search", "title:cats")
+        self.failUnlessEqual(results["operation"], "search")
+        self.failUnlessEqual(results["query"], "title:cats")
+
+    def test_process_is_reused(self):
+        first = self.results("search", "cats")
+        second = self.results("pagesearch", "dogs")
+        self.failUnlessEqual(second["operation"], "pagesearch")
+        self.failUnlessEqual(first["pid"], second["pid"])
+        self.failUnlessEqual(self.server.restarts, 0)
+
+    def test_query_is_one_line(self):
+        results = self.results("search", u"cats\r\nand dogs")
+        self.failUnlessEqual(results["query"], "cats and dogs")
+
+    def test_restart_after_exit(self):
+        first = self.results("search", "cats")
+        self.server.process.stdin.close()
+        self.server.process.wait()
+        second = self.results("search", "dogs")
+        self.failIfEqual(first["pid"], second["pid"])
+        self.failUnlessEqual(self.server.restarts, 1)
+
+    def test_failure_during_query(self):
+        # the query is tried once more against a new process, which also dies
+        self.failUnlessRaises(Error, self.server.search, "search", "die")
+        self.failIf(self.server.running())
+        # but the next query starts things up again
+        self.failUnlessEqual(self.results("search", "cats")["query"], "cats")
+
+    def test_close(self):
+        self.results("search", "cats")
+        process = self.server.process
+        self.server.close()
+        self.failIf(self.server.running())
+        self.failIfEqual(process.poll(), None)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.plibUtil import Error
+    from uplib.javasearch import SearchServer
+
+    unittest.main(argv=sys.argv[:1])
@@ -0,0 +1,142 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, time, tempfile, shutil, unittest
+import TestSupport
+
+class FakeRepository:
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.mkdir(os.path.join(directory, "overhead"))
+        os.mkdir(os.path.join(directory, "docs"))
+
+    def overhead_folder(self):
+        return os.path.join(self.directory, "overhead")
+
+    def doc_location(self, doc_id):
+        return os.path.join(self.directory, "docs", doc_id)
+
+    def _generate_doc_ids(self):
+        return sorted(os.listdir(os.path.join(self.directory, "docs")))
+
+class MetadataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.repo = FakeRepository(self.directory)
+        self.cache = MetadataCache(self.repo)
+        self.mtime = time.time() - 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, doc_id, md):
+        folder = self.repo.doc_location(doc_id)
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        path = os.path.join(folder, "metadata.txt")
+        fp = open(path, "w")
+        write_metadata(fp, md)
+        fp.close()
+        # make sure every rewrite shows up as a change, whatever the file system's mtime resolution
+        self.mtime += 10
+        os.utime(path, (self.mtime, self.mtime))
+        return path
+
+    def test_get_reads_once(self):
+        self.write("doc1", {"title" : "First"})
+        self.failUnlessEqual(self.cache.get("doc1")["title"], "First")
+        self.failUnlessEqual(self.cache.get("doc1")["title"], "First")
+        self.failUnlessEqual((self.cache.misses, self.cache.hits), (1, 1))
+
+    def test_get_notices_changes(self):
+        self.write("doc1", {"title" : "First"})
+        self.cache.get("doc1")
+        self.write("doc1", {"title" : "Second"})
+        self.failUnlessEqual(self.cache.get("doc1")["title"], "Second")
+        self.failUnlessEqual(self.cache.misses, 2)
+
+    def test_missing_document(self):
+        self.write("doc1", {"title" : "First"})
+        self.cache.get("doc1")
+        os.unlink(os.path.join(self.repo.doc_location("doc1"), "metadata.txt"))
+        self.failUnlessEqual(self.cache.get("doc1"), None)
+        self.failUnlessEqual(len(self.cache), 0)
+        self.failUnlessEqual(self.cache.values("title", ["doc2"]), {"doc2" : None})
+
+    def test_note_written(self):
+        path = self.write("doc1", {"title" : "First"})
+        self.cache.note_written("doc1", path, {"title" : "First"})
+        self.failUnlessEqual(self.cache.get("doc1")["title"], "First")
+        self.failUnlessEqual((self.cache.misses, self.cache.hits), (0, 1))
+
+    def test_bulk_accessors(self):
+        self.write("doc1", {"page-count" : "3", "authors" : "A. Smith and B. Jones", "date" : "3/4/2005"})
+        self.write("doc2", {"pagecount" : "7"})
+        self.write("doc3", {"title" : "no pages"})
+        self.failUnlessEqual(self.cache.page_counts(), {"doc1" : 3, "doc2" : 7, "doc3" : 1})
+        self.failUnlessEqual(self.cache.authors(["doc1", "doc3"]),
+                             {"doc1" : ["A. Smith", "B. Jones"], "doc3" : []})
+        dates = self.cache.dates(["doc1", "doc2"])
+        self.failUnlessEqual(dates["doc1"], parse_date("3/4/2005"))
+        self.failUnlessEqual(dates["doc2"], None)
+        # the records were each read once
+        self.failUnlessEqual(self.cache.misses, 3)
+
+    def test_bulk_accessors_notice_changes(self):
+        # as when a ripper updates metadata.txt directly
+        self.write("doc1", {"title" : "First", "page-count" : "3"})
+        self.failUnlessEqual(self.cache.values("title"), {"doc1" : "First"})
+        self.write("doc1", {"title" : "Second", "page-count" : "4"})
+        self.failUnlessEqual(self.cache.values("title"), {"doc1" : "Second"})
+        self.failUnlessEqual(self.cache.page_counts(), {"doc1" : 4})
+        self.failUnlessEqual(self.cache.misses, 2)
+
+    def test_page_count_precedence(self):
+        self.write("doc1", {"pagecount" : "5", "page-count" : "3"})
+        self.failUnlessEqual(self.cache.page_counts(), {"doc1" : 5})
+
+    def test_snapshot(self):
+        self.write("doc1", {"title" : "First"})
+        self.write("doc2", {"title" : "Second"})
+        self.cache.values("title")
+        self.cache.save()
+        self.write("doc2", {"title" : "Changed"})
+        cache = MetadataCache(self.repo)
+        cache.start(background=False)
+        # doc2 changed while we weren't looking, so it was dropped
+        self.failUnlessEqual(len(cache), 1)
+        self.failUnlessEqual(cache.values("title"), {"doc1" : "First", "doc2" : "Changed"})
+        self.failUnlessEqual(cache.misses, 1)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.plibUtil import write_metadata, parse_date
+    from uplib.metadatacache import MetadataCache
+
+    unittest.main(argv=sys.argv[:1])
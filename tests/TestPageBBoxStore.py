@@ -0,0 +1,286 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, struct, zlib, time, tempfile, shutil, unittest
+import TestSupport
+
+def write_bboxes_file (path, words, page_start):
+    # a ".bboxes" file with one box per word, in a row across the page
+    records = []
+    text = ""
+    for i, word in enumerate(words):
+        records.append(struct.pack(">HHHHBBBBBBH", i * 100, 10, i * 100 + 90, 30,
+                                   len(word), 20, 0, len(word), 0, 0, len(text)))
+        text += word + " "
+    fp = open(path, "wb")
+    fp.write("UpLib:pbb:1\0" + struct.pack(">HHI", len(words), len(text), page_start))
+    fp.write(zlib.compress("".join(records) + text))
+    fp.close()
+    return "".join(records)
+
+# the words of a two-page document:  (text, font size in half-points, flags, (left, top, right, bottom)),
+# with None between the pages.  "wor" and "ld" are two fragments of one word.
+WORDS = [("Hello", 20, 0x40 | 0x08 | 0x02, (10.2, 20.0, 60.7, 32.4)),
+         ("wor", 24, 0x10, (65.0, 20.0, 90.0, 34.0)),
+         ("ld", 24, 0x10 | 0x04, (90.0, 19.5, 105.5, 34.0)),
+         None,
+         ("fixed", 19, 0x80 | 0x02, (10.0, 40.0, 50.0, 50.0)),
+         ("sym", 22, 0x20 | 0x04, (12.0, 60.0, 30.0, 71.0)),
+         ("hy", 21, 0x01 | 0x02, (10.0, 80.0, 25.0, 90.0))]
+
+def write_wordbboxes (folder):
+    # a version 2 "wordbboxes" file and the contents.txt it refers to
+    text = ""
+    fp = open(os.path.join(folder, "wordbboxes"), "wb")
+    fp.write("UpLib:wbb:2\0")
+    for word in WORDS:
+        if word is None:
+            fp.write("\0" * 28)
+            continue
+        chars, font_size, flags, (left, top, right, bottom) = word
+        fp.write(struct.pack(">BBBBfffffI", len(chars), 0, font_size, flags,
+                             left, top, right, bottom, bottom - 2, len(text)))
+        text += chars
+        if flags & 0x06:
+            text += " "
+    fp.close()
+    fp = open(os.path.join(folder, "contents.txt"), "wb")
+    fp.write("Content-Type: text/plain;charset=UTF-8\nContent-Language: en\n" + text)
+    fp.close()
+
+PAGES = [["one", "two"], ["three"], None, ["four", "five", "six"]]
+
+class PageBBoxStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.records = []
+        self.starts = []
+        start = 0
+        for i, words in enumerate(PAGES):
+            if words is None:
+                # no ".bboxes" file for this page
+                self.records.append("")
+                self.starts.append(None)
+                continue
+            self.records.append(write_bboxes_file(self.bboxes_path(i), words, start))
+            self.starts.append(start)
+            start += len(" ".join(words)) + 1
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def bboxes_path(self, page_index):
+        return os.path.join(self.directory, "%d.bboxes" % (page_index + 1))
+
+    def store_path(self):
+        return os.path.join(self.directory, createPageBboxes.PAGE_BBOXES_STORE_NAME)
+
+    def test_round_trip(self):
+        filepath = createPageBboxes.write_page_bboxes_store(self.directory)
+        self.failUnlessEqual(filepath, self.store_path())
+        store = createPageBboxes.PageBBoxStore(filepath)
+        try:
+            self.failUnlessEqual(len(store), len(PAGES))
+            for i, words in enumerate(PAGES):
+                self.failUnlessEqual(store.box_data(i), self.records[i])
+                self.failUnlessEqual(store.box_count(i), len(words or []))
+                if words is None:
+                    continue
+                start, text_length, text = store.page(i)
+                self.failUnlessEqual(start, self.starts[i])
+                self.failUnlessEqual(text_length, len(" ".join(words)) + 1)
+                # the boxes read through the store are the same as those in the page's file
+                stored = createPageBboxes.get_page_bboxes(self.directory, i, store)
+                legacy = createPageBboxes.PageBBoxes(self.bboxes_path(i), i)
+                self.failUnlessEqual((stored.start_pos, stored.end_pos), (legacy.start_pos, legacy.end_pos))
+                self.failUnlessEqual([(x.string(), x.bbox, x.text_position) for x in stored.boxes],
+                                     [(x.string(), x.bbox, x.text_position) for x in legacy.boxes])
+                self.failUnlessEqual([x.string() for x in stored.boxes], [unicode(x) for x in words])
+            self.failUnlessEqual(createPageBboxes.get_page_bboxes(self.directory, len(PAGES), store), None)
+        finally:
+            store.close()
+
+    def test_find_page(self):
+        for i, words in enumerate(PAGES):
+            if words is None:
+                continue
+            for pos in (self.starts[i], self.starts[i] + len(" ".join(words))):
+                boxes = createPageBboxes.find_page(self.directory, pos)
+                self.failUnlessEqual(boxes.page_index, i)
+                self.failUnless(boxes.contains_text_pos(pos))
+        end = self.starts[-1] + len(" ".join(PAGES[-1])) + 1
+        self.failUnlessEqual(createPageBboxes.find_page(self.directory, end), None)
+        index = createPageBboxes.read_page_text_index(self.directory)
+        self.failUnlessEqual([index.find(x) for x in self.starts if x is not None], [0, 1, 3])
+
+    def test_open_rewrites_stale_store(self):
+        self.failIf(os.path.exists(self.store_path()))
+        store = createPageBboxes.open_page_bboxes_store(self.directory)
+        store.close()
+        self.failUnless(os.path.exists(self.store_path()))
+        # a newer first page means the store has to be made again
+        records = write_bboxes_file(self.bboxes_path(0), ["uno", "dos"], 0)
+        then = time.time() - 60
+        os.utime(self.store_path(), (then, then))
+        store = createPageBboxes.open_page_bboxes_store(self.directory)
+        try:
+            self.failUnlessEqual(store.box_data(0), records)
+        finally:
+            store.close()
+
+    def test_empty_store_is_used(self):
+        # a store with no pages is still a store, and shouldn't be reopened
+        fp = open(self.store_path(), "wb")
+        fp.write("UpLib:pbc:1\0" + struct.pack(">I", 0))
+        fp.close()
+        store = createPageBboxes.PageBBoxStore(self.store_path())
+        try:
+            self.failUnlessEqual(len(store), 0)
+            self.failUnlessEqual(createPageBboxes.get_page_bboxes(self.directory, 0, store), None)
+        finally:
+            store.close()
+
+    def test_fallback_to_page_files(self):
+        # an unusable store, newer than the page files, isn't rewritten, so
+        # the per-page ".bboxes" files are read instead
+        fp = open(self.store_path(), "wb")
+        fp.write("not a store, but long enough")
+        fp.close()
+        self.failUnlessEqual(createPageBboxes.open_page_bboxes_store(self.directory), None)
+        boxes = createPageBboxes.get_page_bboxes(self.directory, 3)
+        self.failUnlessEqual([x.string() for x in boxes.boxes], [u"four", u"five", u"six"])
+        self.failUnlessEqual(boxes.boxes[2].bbox, (200, 10, 290, 30))
+        self.failUnlessEqual(createPageBboxes.get_page_bboxes(self.directory, 2), None)
+        boxes = createPageBboxes.find_page(self.directory, self.starts[1])
+        self.failUnlessEqual(boxes.page_index, 1)
+        self.failUnlessEqual([x.string() for x in boxes.boxes], [u"three"])
+
+class WordBBoxesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.thumbnails = os.path.join(self.directory, "thumbnails")
+        os.mkdir(self.thumbnails)
+        write_wordbboxes(self.directory)
+        # make the page files as do_page_bounding_boxes would, with no scaling
+        fp = open(os.path.join(self.directory, "contents.txt"), "rb")
+        fp.readline()
+        fp.readline()
+        text = fp.read()
+        fp.close()
+        for page_index, boxes in wordboxes_page_iterator(self.directory):
+            adjusted = [(box, None, int(box.left() + 0.5), int(box.top() + 0.5),
+                         int(box.right() + 0.5), int(box.bottom() + 0.5)) for box in boxes]
+            start = boxes[0].contents_offset()
+            end = boxes[-1].contents_offset() + (boxes[-1].nchars() * 4)
+            createPageBboxes.flush_page(self.directory, page_index, adjusted, text[start:end], start)
+        createPageBboxes.write_page_bboxes_store(self.thumbnails)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def expected(self):
+        # for each page, the boxes as (text, bbox, nchars, font size, flags, position in contents.txt)
+        pages = [[]]
+        text = ""
+        continued = False
+        for word in WORDS:
+            if word is None:
+                pages.append([])
+                continued = False
+                continue
+            chars, font_size, flags, (left, top, right, bottom) = word
+            bbox = (int(left + 0.5), int(top + 0.5), int(right + 0.5), int(bottom + 0.5))
+            if continued:
+                # merged into the box of the word's first fragment, which keeps its font and flags
+                last = pages[-1].pop()
+                bbox = (min(last[1][0], bbox[0]), min(last[1][1], bbox[1]),
+                        max(last[1][2], bbox[2]), max(last[1][3], bbox[3]))
+                pages[-1].append((last[0] + chars, bbox, last[2] + len(chars)) + last[3:])
+            else:
+                pages[-1].append((chars, bbox, len(chars), font_size, flags, len(text)))
+            text += chars
+            continued = not (flags & 0x06)
+            if not continued:
+                text += " "
+        return pages
+
+    def check_page(self, page_index, page, expected):
+        columns = page.columns
+        self.failUnless(isinstance(columns, createPageBboxes.BoxColumns))
+        self.failUnlessEqual(len(columns), len(expected))
+        self.failUnlessEqual(len(page.boxes), len(expected))
+        page_start = expected[0][5]
+        for i, (chars, bbox, nchars, font_size, flags, position) in enumerate(expected):
+            self.failUnlessEqual((columns.ulx[i], columns.uly[i], columns.lrx[i], columns.lry[i]), bbox)
+            self.failUnlessEqual(columns.nchars[i], nchars)
+            self.failUnlessEqual(columns.font_size[i], font_size)
+            self.failUnlessEqual(columns.flags[i], flags)
+            self.failUnlessEqual(columns.poscode[i], 0)
+            box = page.boxes[i]
+            self.failUnlessEqual(box.page_index(), page_index)
+            # a box's text runs on to the start of the next box
+            self.failUnlessEqual(box.string().rstrip(), unicode(chars))
+            self.failUnlessEqual(box.bbox, bbox)
+            self.failUnlessEqual(box.nchars, nchars)
+            self.failUnlessEqual(box.text_position, position - page_start)
+            if i < (len(expected) - 1):
+                self.failUnlessEqual(box.text_len, expected[i + 1][5] - position)
+            self.failUnlessEqual(box.font_size, font_size / 2.0)
+            self.failUnlessEqual(bool(box.fixed_width), bool(flags & 0x80))
+            self.failUnlessEqual(bool(box.serif_font), bool(flags & 0x40))
+            self.failUnlessEqual(bool(box.symbolic_font), bool(flags & 0x20))
+            self.failUnlessEqual(bool(box.italic), bool(flags & 0x10))
+            self.failUnlessEqual(bool(box.bold), bool(flags & 0x08))
+            self.failUnlessEqual(bool(box.ends_line), bool(flags & 0x04))
+            self.failUnlessEqual(bool(box.ends_word), bool(flags & 0x02))
+            self.failUnlessEqual(bool(box.inserted_hyphen), bool(flags & 0x01))
+            self.failIf(box.begins_paragraph or box.begins_sentence or box.begins_phrase)
+            self.failUnlessEqual(box.part_of_speech_tag(), None)
+
+    def test_page_files(self):
+        for page_index, expected in enumerate(self.expected()):
+            filepath = os.path.join(self.thumbnails, "%d.bboxes" % (page_index + 1))
+            self.check_page(page_index, createPageBboxes.PageBBoxes(filepath, page_index), expected)
+
+    def test_store(self):
+        store = createPageBboxes.open_page_bboxes_store(self.thumbnails)
+        try:
+            pages = self.expected()
+            self.failUnlessEqual(len(store), len(pages))
+            for page_index, expected in enumerate(pages):
+                self.check_page(page_index, createPageBboxes.get_page_bboxes(self.thumbnails, page_index, store), expected)
+        finally:
+            store.close()
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib import createPageBboxes
+    from uplib.plibUtil import wordboxes_page_iterator
+
+    unittest.main(argv=sys.argv[:1])
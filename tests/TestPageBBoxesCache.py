@@ -0,0 +1,133 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, struct, zlib, tempfile, shutil, unittest
+import TestSupport
+
+def write_bboxes_file (path, words, page_start):
+    # a ".bboxes" file with one box per word, in a row across the page
+    records = []
+    text = ""
+    for i, word in enumerate(words):
+        records.append(struct.pack(">HHHHBBBBBBH", i * 100, 10, i * 100 + 90, 30,
+                                   len(word), 20, 0, len(word), 0, 0, len(text)))
+        text += word + " "
+    fp = open(path, "wb")
+    fp.write("UpLib:pbb:1\0" + struct.pack(">HHI", len(words), len(text), page_start))
+    fp.write(zlib.compress("".join(records) + text))
+    fp.close()
+
+class FakeDocument:
+
+    def __init__(self, directory, doc_id, pages):
+        self.id = doc_id
+        self.directory = os.path.join(directory, doc_id)
+        thumbnails = os.path.join(self.directory, "thumbnails")
+        os.makedirs(thumbnails)
+        start = 0
+        for i, words in enumerate(pages):
+            write_bboxes_file(os.path.join(thumbnails, "%d.bboxes" % (i + 1)), words, start)
+            start += len(" ".join(words)) + 1
+
+    def folder(self):
+        return self.directory
+
+class PageBBoxesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.doc1 = FakeDocument(self.directory, "doc1", [["one", "two"], ["three"], ["four", "five", "six"]])
+        self.doc2 = FakeDocument(self.directory, "doc2", [["seven"]])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get(self):
+        cache = PageBBoxesCache(1000000)
+        boxes = cache.get(self.doc1, 2)
+        self.failUnlessEqual([box.string() for box in boxes.boxes], [u"four", u"five", u"six"])
+        self.failUnlessEqual(boxes.boxes[1].bbox, (100, 10, 190, 30))
+        self.failUnless(cache.get(self.doc1, 2) is boxes)
+        self.failUnlessEqual((cache.hits, cache.misses), (1, 1))
+        self.failUnlessEqual(cache.nbytes, boxes.nbytes())
+        # the pages were read through the document's bboxes store
+        self.failUnless(os.path.exists(os.path.join(self.doc1.folder(), "thumbnails", "bboxes.pbc")))
+
+    def test_boxes_unpacked_when_used(self):
+        cache = PageBBoxesCache(1000000)
+        boxes = cache.get(self.doc1, 2)
+        # caching the page doesn't unpack its boxes
+        self.failUnless(boxes._PageBBoxes__columns is None)
+        size = cache.nbytes
+        self.failUnlessEqual(len(boxes.boxes), 3)
+        self.failIf(boxes._PageBBoxes__columns is None)
+        self.failUnlessEqual(boxes.nbytes(), size)
+
+    def test_missing_page(self):
+        cache = PageBBoxesCache(1000000)
+        self.failUnlessEqual(cache.get(self.doc1, 3), None)
+        self.failUnlessEqual(len(cache), 0)
+
+    def test_eviction(self):
+        size = PageBBoxesCache(1000000).get(self.doc1, 0).nbytes()
+        # room for two pages of about the same size
+        cache = PageBBoxesCache(size * 2 + size // 2)
+        first = cache.get(self.doc1, 0)
+        cache.get(self.doc1, 1)
+        # use the first page again, so that the second is the least recently used
+        cache.get(self.doc1, 0)
+        cache.get(self.doc2, 0)
+        self.failUnlessEqual(len(cache), 2)
+        self.failUnless(cache.nbytes <= cache.maxbytes)
+        self.failUnless(cache.get(self.doc1, 0) is first)
+        misses = cache.misses
+        cache.get(self.doc1, 1)
+        self.failUnlessEqual(cache.misses, misses + 1)
+
+    def test_discard(self):
+        cache = PageBBoxesCache(1000000)
+        cache.get(self.doc1, 0)
+        cache.get(self.doc1, 1)
+        cache.get(self.doc2, 0)
+        cache.on_change(self.doc1)
+        self.failUnlessEqual(len(cache), 1)
+        self.failUnlessEqual(cache.nbytes, cache.get(self.doc2, 0).nbytes())
+        cache.clear()
+        self.failUnlessEqual(cache.stats()['pages'], 0)
+        self.failUnlessEqual(cache.stats()['bytes'], 0)
+
+    def test_disabled(self):
+        cache = PageBBoxesCache(0)
+        self.failIfEqual(cache.get(self.doc1, 0), None)
+        self.failUnlessEqual(len(cache), 0)
+        self.failUnlessEqual(cache.nbytes, 0)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.bboxcache import PageBBoxesCache
+
+    unittest.main(argv=sys.argv[:1])
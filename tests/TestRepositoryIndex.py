@@ -0,0 +1,154 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, time, hashlib, tempfile, shutil, unittest
+import TestSupport
+
+class FakeMetadataCache:
+
+    def __init__(self, repo):
+        self.repo = repo
+
+    def get(self, doc_id):
+        md = self.repo.metadata.get(doc_id)
+        return (md is not None) and md.copy() or None
+
+class FakeDocument:
+
+    def __init__(self, repo, doc_id):
+        self.repo = repo
+        self.id = doc_id
+
+    def get_metadata(self):
+        return self.repo.metadata[self.id].copy()
+
+class FakeRepository:
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.mkdir(os.path.join(directory, "overhead"))
+        fp = open(os.path.join(directory, "overhead", "metadata.txt"), "w")
+        fp.write("name: test\npassword: %s\n" % hashlib.sha1("secret").hexdigest())
+        fp.close()
+        self.metadata = {}
+        self.modtime = 1300000000
+
+    def overhead_folder(self):
+        return os.path.join(self.directory, "overhead")
+
+    def mod_time(self):
+        return self.modtime
+
+    def list_collections(self):
+        return []
+
+    def metadata_cache(self):
+        return FakeMetadataCache(self)
+
+    def valid_doc_id(self, doc_id):
+        return doc_id in self.metadata
+
+    def _generate_doc_ids(self):
+        return sorted(self.metadata)
+
+    def generate_docs(self):
+        return [FakeDocument(self, doc_id) for doc_id in sorted(self.metadata)]
+
+class RepositoryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.repo = FakeRepository(self.directory)
+        self.repo.metadata = {
+            "01234-56-7890-123" : { "title" : "The First", "authors" : "Jane Smith and John Q. Public",
+                                    "categories" : "papers, papers/drafts", "date" : "3/14/2009",
+                                    "page-count" : "12" },
+            "01234-56-7891-456" : { "title" : "The Second", "authors" : "Jane Smith",
+                                    "categories" : "papers", "page-count" : "3" },
+            "01234-56-7892-789" : { "title" : "Untitled" },
+            }
+        self.index = RepositoryIndex(self.repo)
+        self.index.start(False)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def built(self):
+        # what the index file would be if it were built from scratch
+        path = os.path.join(self.repo.overhead_folder(), repindex.INDEX_FILENAME)
+        saved = path + ".saved"
+        os.rename(path, saved)
+        try:
+            repindex.build_index_1_0(self.repo)
+            return open(path, "rb").read()
+        finally:
+            os.rename(saved, path)
+
+    def test_same_as_built(self):
+        self.index.write()
+        self.failUnlessEqual(open(self.index.current_file(), "rb").read(), self.built())
+
+    def test_same_after_changes(self):
+        self.index.write()
+        doc_id = "01234-56-7893-012"
+        self.repo.metadata[doc_id] = { "title" : "Added", "authors" : "Kim Lee", "categories" : "books" }
+        self.index.on_add(FakeDocument(self.repo, doc_id))
+        self.repo.metadata["01234-56-7891-456"]["categories"] = "papers, books"
+        self.index.note_changed(FakeDocument(self.repo, "01234-56-7891-456"))
+        doc = FakeDocument(self.repo, "01234-56-7892-789")
+        del self.repo.metadata[doc.id]
+        self.index.on_delete(doc)
+        self.failUnless(self.index.is_stale())
+        self.index.write()
+        self.failUnlessEqual(len(self.index), 3)
+        self.failUnlessEqual(open(self.index.current_file(), "rb").read(), self.built())
+
+    def test_stale(self):
+        self.failUnless(self.index.is_stale())
+        self.index.write()
+        self.failIf(self.index.is_stale())
+        # touching documents changes the repository, but not the index
+        self.repo.modtime = time.time() + 1
+        self.failIf(self.index.is_stale())
+        self.index.note_changed(FakeDocument(self.repo, "01234-56-7890-123"))
+        self.failUnless(self.index.is_stale())
+        self.index.write()
+        self.index.on_delete(FakeDocument(self.repo, "01234-56-7890-123"))
+        self.failUnless(self.index.is_stale())
+        self.index.write()
+        self.index.note_modified()
+        self.failUnless(self.index.is_stale())
+        self.index.write()
+        os.unlink(self.index.path)
+        self.failUnless(self.index.is_stale())
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib import repindex
+    from uplib.repindex import RepositoryIndex
+
+    unittest.main(argv=sys.argv[:1])
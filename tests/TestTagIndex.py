@@ -0,0 +1,80 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, unittest
+import TestSupport
+
+class TagIndexTest(unittest.TestCase):
+
+    def test_initial_mapping(self):
+        index = TagIndex({ "work" : ["d1", "d2"], "home" : ["d2"], "empty" : [] })
+        self.failUnlessEqual(index["work"], set(["d1", "d2"]))
+        self.failUnlessEqual(index["empty"], set())
+        self.failUnlessEqual(index.by_doc, { "d1" : set(["work"]), "d2" : set(["work", "home"]) })
+
+    def test_set_doc_tags(self):
+        index = TagIndex({ "work" : ["d1"] })
+        self.failUnless(index.set_doc_tags("d1", ["home", "play"]))
+        self.failUnlessEqual(index["work"], set())
+        self.failUnlessEqual(index["home"], set(["d1"]))
+        self.failUnlessEqual(index.by_doc["d1"], set(["home", "play"]))
+        # nothing changes the second time
+        self.failIf(index.set_doc_tags("d1", ["play", "home", "home"]))
+
+    def test_remove_doc(self):
+        index = TagIndex({ "work" : ["d1", "d2"] })
+        self.failUnless(index.remove_doc("d1"))
+        self.failIf(index.remove_doc("d1"))
+        self.failIf("d1" in index.by_doc)
+        # the tag stays, even when it has no documents left
+        index.remove_doc("d2")
+        self.failUnlessEqual(index.as_lists(), { "work" : [] })
+
+    def test_add_tag(self):
+        index = TagIndex({ "work" : ["d1"] })
+        self.failIf(index.add_tag("work"))
+        self.failUnless(index.add_tag("home"))
+        self.failUnlessEqual(index["home"], set())
+        self.failUnlessEqual(index["work"], set(["d1"]))
+
+    def test_as_lists_is_a_copy(self):
+        index = TagIndex({ "work" : ["d1"] })
+        lists = index.as_lists()
+        lists["work"].append("d2")
+        self.failUnlessEqual(index["work"], set(["d1"]))
+
+    def test_clear(self):
+        index = TagIndex({ "work" : ["d1"] })
+        index.clear()
+        self.failUnlessEqual(len(index), 0)
+        self.failUnlessEqual(index.by_doc, {})
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.repository import TagIndex
+
+    unittest.main(argv=sys.argv[:1])
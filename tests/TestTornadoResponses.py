@@ -0,0 +1,226 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, time, httplib, threading, tempfile, logging, email.utils, unittest
+import TestSupport
+
+# enough data for several trips through the stream pump
+STREAM_DATA = [("%06d" % i) * 1000 for i in range(50)]
+
+# the file FileHandler returns, and what's in it
+FILE_PATH = None
+FILE_DATA = ''.join([chr(i % 251) for i in range(200000)])
+
+# started in __main__:  one server using chunked encoding, and one configured without it
+CHUNKING_PORT = None
+NONCHUNKING_PORT = None
+
+def start_servers():
+
+    global CHUNKING_PORT, NONCHUNKING_PORT
+
+    from tornado.web import Application, RequestHandler
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+
+    class StreamHandler (RequestHandler):
+
+        def initialize(self):
+            self.repo = None
+
+        def get(self):
+            resp = response(self)
+            resp.return_stream("application/octet-stream", iter(STREAM_DATA))
+            # as the ActionHandler does
+            self._auto_finish = not resp._streaming
+
+    class PlainHandler (RequestHandler):
+
+        def initialize(self):
+            self.repo = None
+
+        def get(self):
+            resp = response(self)
+            resp.reply("plain", "text/plain")
+
+    class FileHandler (RequestHandler):
+
+        def initialize(self):
+            self.repo = None
+
+        def get(self):
+            resp = response(self)
+            resp.return_file("application/octet-stream", FILE_PATH)
+            self._auto_finish = not resp._streaming
+
+    handlers = [(r"/stream", StreamHandler), (r"/plain", PlainHandler), (r"/file", FileHandler)]
+    CHUNKING_PORT = TestSupport.find_unused_port()
+    HTTPServer(Application(handlers)).listen(CHUNKING_PORT, "127.0.0.1")
+    NONCHUNKING_PORT = TestSupport.find_unused_port()
+    HTTPServer(Application(handlers, transforms=[])).listen(NONCHUNKING_PORT, "127.0.0.1")
+    t = threading.Thread(target=IOLoop.instance().start)
+    t.setDaemon(True)
+    t.start()
+
+class HTTP10Connection (httplib.HTTPConnection):
+    _http_vsn = 10
+    _http_vsn_str = 'HTTP/1.0'
+
+class ResponseTest(unittest.TestCase):
+
+    def get(self, conn, path, headers={}):
+        conn.request("GET", path, headers=headers)
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def connect(self, port, connection_class=httplib.HTTPConnection):
+        conn = connection_class("127.0.0.1", port)
+        conn.connect()
+        # don't wait forever for a response which never ends
+        conn.sock.settimeout(10)
+        return conn
+
+class ReturnStreamTest(ResponseTest):
+
+    def test_chunked(self):
+        conn = self.connect(CHUNKING_PORT)
+        resp, data = self.get(conn, "/stream")
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(resp.getheader("transfer-encoding"), "chunked")
+        self.failUnlessEqual(data, ''.join(STREAM_DATA))
+        # the connection is kept open for the next request
+        sock = conn.sock
+        resp, data = self.get(conn, "/plain")
+        self.failUnlessEqual(data, "plain")
+        self.failUnless(conn.sock is sock)
+        conn.close()
+
+    def test_not_chunked(self):
+        conn = self.connect(NONCHUNKING_PORT)
+        resp, data = self.get(conn, "/stream")
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(resp.getheader("transfer-encoding"), None)
+        self.failUnlessEqual(resp.getheader("connection"), "close")
+        self.failUnlessEqual(data, ''.join(STREAM_DATA))
+        # the end of the data was marked by closing the connection
+        self.failUnless(conn.sock is None)
+        conn.close()
+
+    def test_http_1_0(self):
+        conn = self.connect(CHUNKING_PORT, HTTP10Connection)
+        resp, data = self.get(conn, "/stream")
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(resp.getheader("transfer-encoding"), None)
+        self.failUnlessEqual(data, ''.join(STREAM_DATA))
+        conn.close()
+
+class ReturnFileTest(ResponseTest):
+
+    def setUp(self):
+        global FILE_PATH
+        fd, FILE_PATH = tempfile.mkstemp()
+        os.write(fd, FILE_DATA)
+        os.close(fd)
+        self.mtime = time.time() - 3600
+        os.utime(FILE_PATH, (self.mtime, self.mtime))
+        self.conn = self.connect(CHUNKING_PORT)
+
+    def tearDown(self):
+        self.conn.close()
+        os.unlink(FILE_PATH)
+
+    def test_whole_file(self):
+        resp, data = self.get(self.conn, "/file")
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(data, FILE_DATA)
+        self.failUnlessEqual(resp.getheader("content-length"), str(len(FILE_DATA)))
+        self.failUnlessEqual(resp.getheader("accept-ranges"), "bytes")
+        self.failUnless(resp.getheader("etag"))
+
+    def test_range(self):
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=1000-1999"})
+        self.failUnlessEqual(resp.status, 206)
+        self.failUnlessEqual(data, FILE_DATA[1000:2000])
+        self.failUnlessEqual(resp.getheader("content-range"), "bytes 1000-1999/%d" % len(FILE_DATA))
+        # ranges are sent with a length, so the connection can be used again
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=150000-"})
+        self.failUnlessEqual(resp.status, 206)
+        self.failUnlessEqual(data, FILE_DATA[150000:])
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=-10"})
+        self.failUnlessEqual(data, FILE_DATA[-10:])
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=199990-300000"})
+        self.failUnlessEqual(data, FILE_DATA[199990:])
+
+    def test_unsatisfiable_range(self):
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=300000-"})
+        self.failUnlessEqual(resp.status, 416)
+        self.failUnlessEqual(resp.getheader("content-range"), "bytes */%d" % len(FILE_DATA))
+
+    def test_ignored_range(self):
+        # a malformed range is ignored
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=20-10"})
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(data, FILE_DATA)
+
+    def test_if_range(self):
+        resp, data = self.get(self.conn, "/file")
+        etag = resp.getheader("etag")
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=0-9", "If-Range" : etag})
+        self.failUnlessEqual(resp.status, 206)
+        self.failUnlessEqual(data, FILE_DATA[:10])
+        # a stale validator gets the whole (changed) file
+        resp, data = self.get(self.conn, "/file", {"Range" : "bytes=0-9", "If-Range" : '"stale"'})
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(data, FILE_DATA)
+
+    def test_not_modified(self):
+        resp, data = self.get(self.conn, "/file")
+        etag = resp.getheader("etag")
+        resp, data = self.get(self.conn, "/file", {"If-None-Match" : etag})
+        self.failUnlessEqual(resp.status, 304)
+        self.failUnlessEqual(data, "")
+        resp, data = self.get(self.conn, "/file", {"If-None-Match" : '"other", ' + etag})
+        self.failUnlessEqual(resp.status, 304)
+        resp, data = self.get(self.conn, "/file", {"If-None-Match" : '"other"'})
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(data, FILE_DATA)
+
+    def test_if_modified_since(self):
+        resp, data = self.get(self.conn, "/file", {"If-Modified-Since" : email.utils.formatdate(self.mtime + 60, usegmt=True)})
+        self.failUnlessEqual(resp.status, 304)
+        resp, data = self.get(self.conn, "/file", {"If-Modified-Since" : email.utils.formatdate(self.mtime - 60, usegmt=True)})
+        self.failUnlessEqual(resp.status, 200)
+        self.failUnlessEqual(data, FILE_DATA)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+    # Tornado logs each error response
+    logging.getLogger().setLevel(logging.ERROR)
+
+    from uplib.tornadoHandler import response
+
+    start_servers()
+    unittest.main(argv=sys.argv[:1])
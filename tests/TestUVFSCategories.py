@@ -0,0 +1,172 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+
+import sys, os, tempfile, shutil, unittest
+import TestSupport
+
+class FakeDocument:
+
+    def __init__(self, directory, doc_id, title):
+        self.id = doc_id
+        self.directory = os.path.join(directory, doc_id)
+        os.makedirs(os.path.join(self.directory, "originals"))
+        fp = open(os.path.join(self.directory, "originals", "original.pdf"), "wb")
+        fp.write("%PDF " + doc_id)
+        fp.close()
+        self.metadata = { "title" : title, "apparent-mime-type" : "application/pdf", "page-count" : "3" }
+
+    def originals_path(self):
+        return os.path.join(self.directory, "originals")
+
+    def icon_path(self):
+        return os.path.join(self.directory, "thumbnails", "first.png")
+
+    def original_name(self):
+        return None
+
+    def get_metadata(self, name=None):
+        if name:
+            return self.metadata.get(name)
+        return self.metadata
+
+    def sha_hash(self):
+        return "hash-" + self.id
+
+class FakeRepository:
+
+    def __init__(self, directory, categories):
+        self.categories = categories
+        self.docs = {}
+        for ids in categories.values():
+            for doc_id in ids:
+                if (doc_id not in self.docs) and (not doc_id.startswith("gone")):
+                    self.docs[doc_id] = FakeDocument(directory, doc_id, "Title of " + doc_id)
+
+    def get_categories_with_docs(self):
+        return self.categories
+
+    def valid_doc_id(self, doc_id):
+        return doc_id in self.docs
+
+    def get_document(self, doc_id):
+        return self.docs[doc_id]
+
+class FakeResponse:
+
+    def reply(self, message, content_type=None):
+        self.message = message
+        self.content_type = content_type
+
+class MetadataForCategoriesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.repo = FakeRepository(self.directory, { "work" : ["d1", "d2"],
+                                                     "work/reports" : ["d2", "d3"],
+                                                     "work/reports/annual" : ["d3"],
+                                                     "workshop" : ["d4"],
+                                                     "home" : ["d5", "gone1"],
+                                                     "old" : ["gone2"] })
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def call(self, **params):
+        response = FakeResponse()
+        metadata_for_categories(self.repo, response, params)
+        self.failUnlessEqual(response.content_type, "text/plain")
+        categories = {}
+        metadata = []
+        for line in response.message.split('\n'):
+            if line.startswith('category\t'):
+                junk, name, ids = line.split('\t')
+                categories[name] = ids.split()
+            elif line:
+                metadata.append(line)
+        return categories, metadata
+
+    def ids(self, metadata):
+        return [line.split(',')[0][len("id "):] for line in metadata]
+
+    def test_all(self):
+        categories, metadata = self.call()
+        # a category whose documents are all gone isn't listed
+        self.failUnlessEqual(categories, { "work" : ["d1", "d2"], "work/reports" : ["d2", "d3"],
+                                           "work/reports/annual" : ["d3"], "workshop" : ["d4"],
+                                           "home" : ["d5"] })
+        # each document's metadata appears once
+        self.failUnlessEqual(self.ids(metadata), ["d1", "d2", "d3", "d4", "d5"])
+        self.failUnless("sha-hash hash-d1," in metadata[0])
+        self.failUnless("pagecount 3," in metadata[0])
+        self.failUnless(metadata[0].endswith("filename Title of d1"))
+
+    def test_named(self):
+        categories, metadata = self.call(category="Work")
+        self.failUnlessEqual(categories, { "work" : ["d1", "d2"] })
+        self.failUnlessEqual(self.ids(metadata), ["d1", "d2"])
+        categories, metadata = self.call(category=["work", "home"])
+        self.failUnlessEqual(sorted(categories.keys()), ["home", "work"])
+        # a category asked for is listed, even if it's empty
+        categories, metadata = self.call(category=["old", "nonesuch"])
+        self.failUnlessEqual(categories, { "old" : [], "nonesuch" : [] })
+        self.failUnlessEqual(metadata, [])
+
+    def test_subcategories(self):
+        categories, metadata = self.call(category="work", subcategories="true")
+        # "workshop" isn't below "work"
+        self.failUnlessEqual(categories, { "work" : ["d1", "d2"], "work/reports" : ["d2", "d3"],
+                                           "work/reports/annual" : ["d3"] })
+        self.failUnlessEqual(self.ids(metadata), ["d1", "d2", "d3"])
+
+    def test_children(self):
+        categories, metadata = self.call(category="work", subcategories="children")
+        # just one level down
+        self.failUnlessEqual(categories, { "work" : ["d1", "d2"], "work/reports" : ["d2", "d3"] })
+        self.failUnlessEqual(self.ids(metadata), ["d1", "d2", "d3"])
+        categories, metadata = self.call(category="work/reports", subcategories="children", known="d2 d3")
+        self.failUnlessEqual(categories, { "work/reports" : ["d2", "d3"], "work/reports/annual" : ["d3"] })
+        self.failUnlessEqual(metadata, [])
+        # an intermediate level with nothing tagged is still listed when asked for
+        categories, metadata = self.call(category="home/empty", subcategories="children")
+        self.failUnlessEqual(categories, { "home/empty" : [] })
+
+    def test_known(self):
+        categories, metadata = self.call(category="work", subcategories="true", known="d2 d9")
+        self.failUnlessEqual(categories["work/reports"], ["d2", "d3"])
+        self.failUnlessEqual(self.ids(metadata), ["d1", "d3"])
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    # the UVFS extension is installed with the other site extensions
+    sys.path.insert(0, os.path.join(os.environ["UPLIB_LIB"], "site-extensions"))
+    import UVFS
+    from UVFS import metadata_for_categories
+    # on the Mac, the metadata includes Finder icons made from the page images; these documents have none
+    UVFS.icns = lambda doc: 'eNoDAAAAAAE='
+
+    unittest.main(argv=sys.argv[:1])
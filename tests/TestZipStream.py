@@ -0,0 +1,135 @@
+#
+# This file is part of the "UpLib 1.7.11" release.
+# Copyright (C) 2003-2011  Palo Alto Research Center, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys, os, re, random, tempfile, shutil, zipfile, unittest
+from StringIO import StringIO
+import TestSupport
+
+class ZipStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = {}
+        r = random.Random(17)
+        self.add("metadata.txt", "title: A Test\n")
+        self.add("empty.txt", "")
+        # larger than a chunk, and not very compressible
+        self.add("originals/big.bin", ''.join([chr(r.randint(0, 255)) for i in range(100000)]))
+        self.add("thumbnails/1.png", "\x89PNG" * 5000)
+        self.add("thumbnails/skip.tmp", "excluded")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, name, data):
+        path = os.path.join(self.directory, *name.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        fp = open(path, "wb")
+        fp.write(data)
+        fp.close()
+        self.files[name] = data
+
+    def stream(self, **kwargs):
+        return ''.join(zipup_stream(self.directory, CHUNKSIZE=4096, **kwargs))
+
+    def check_archive(self, data, expected):
+        zf = zipfile.ZipFile(StringIO(data))
+        try:
+            self.failUnlessEqual(zf.testzip(), None)
+            contents = dict([(name, zf.read(name)) for name in zf.namelist()])
+        finally:
+            zf.close()
+        self.failUnlessEqual(sorted(contents.keys()), sorted(expected.keys()))
+        for name in expected:
+            self.failUnlessEqual(contents[name], expected[name], "member %s differs" % name)
+
+    def test_stored(self):
+        self.check_archive(self.stream(), self.files)
+
+    def test_deflated(self):
+        data = self.stream(COMPRESSION=zipfile.ZIP_DEFLATED)
+        self.check_archive(data, self.files)
+        self.failUnless(len(data) < len(self.stream()))
+
+    def test_same_members_as_zipup(self):
+        excludes = re.compile(r".*\.tmp$")
+        path = zipup(self.directory, SORTED=True, EXCLUDES=excludes)
+        try:
+            zf = zipfile.ZipFile(path)
+            names = zf.namelist()
+            zf.close()
+        finally:
+            os.unlink(path)
+        zf = zipfile.ZipFile(StringIO(self.stream(SORTED=True, EXCLUDES=excludes)))
+        self.failUnlessEqual(zf.namelist(), names)
+        zf.close()
+        self.failUnless("originals/big.bin" in names)
+        self.failIf("thumbnails/skip.tmp" in names)
+
+    def test_length(self):
+        # the length is figured without reading the files, for a Content-Length
+        self.failUnlessEqual(zipup_stream_length(self.directory), len(self.stream()))
+        excludes = re.compile(r".*\.tmp$")
+        self.failUnlessEqual(zipup_stream_length(self.directory, SORTED=True, EXCLUDES=excludes),
+                             len(self.stream(SORTED=True, EXCLUDES=excludes)))
+
+    def test_length_with_filefunc(self):
+        # FILEFUNC may substitute another file for a member, or leave it out
+        fd, other = tempfile.mkstemp()
+        os.write(fd, "title: Something Else, and longer\n")
+        os.close(fd)
+        def filefunc (path):
+            if path.endswith("metadata.txt"):
+                return other
+            elif path.endswith(".png"):
+                return None
+            return path
+        try:
+            data = self.stream(FILEFUNC=filefunc)
+            self.failUnlessEqual(zipup_stream_length(self.directory, FILEFUNC=filefunc), len(data))
+            expected = self.files.copy()
+            expected["metadata.txt"] = "title: Something Else, and longer\n"
+            del expected["thumbnails/1.png"]
+            self.check_archive(data, expected)
+        finally:
+            os.unlink(other)
+
+    def test_empty_directory(self):
+        empty = tempfile.mkdtemp()
+        try:
+            data = ''.join(zipup_stream(empty))
+            self.check_archive(data, {})
+            self.failUnlessEqual(zipup_stream_length(empty), len(data))
+        finally:
+            os.rmdir(empty)
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 3:
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    if not TestSupport.setup_uplib(sys.argv[1], sys.argv[2]):
+        sys.stderr.write("Usage:  python %s UPLIB_HOME UPLIB_VERSION\n" % sys.argv[0])
+        sys.exit(1)
+    os.environ["UPLIB_VERBOSITY"] = "0"
+
+    from uplib.plibUtil import zipup, zipup_stream, zipup_stream_length
+
+    unittest.main(argv=sys.argv[:1])